@@ -0,0 +1,119 @@
+from hashlib import sha256
+from pathlib import Path
+from threading import Lock
+from cryptography.x509 import load_pem_x509_certificates
+from .cache import LRUCache
+import jwt
+import logging
+import time
+
+
+logger = logging.getLogger("expenses-tracker")
+
+
+class SigningKeyProvider:
+    """
+    Keeps the Auth0 public keys parsed in memory. The path can be a single
+    PEM file or a directory with one PEM file per key (the file name is used
+    as the key id), and it's only read again when its modification time
+    changes, so the keys can be rotated without restarting the process
+    """
+
+    def __init__(self, path: str, check_interval: float = 60):
+        self.path = Path(path)
+        self.check_interval = check_interval
+        self._keys: dict[str, object] = {}
+        self._mtime: float | None = None
+        self._next_check = 0.0
+        self._lock = Lock()
+
+    def get_keys(self) -> dict[str, object]:
+        now = time.monotonic()
+        if self._mtime is not None and now < self._next_check:
+            return self._keys
+        with self._lock:
+            self._next_check = now + self.check_interval
+            mtime = self._get_mtime()
+            if mtime != self._mtime:
+                self._keys = self._load_keys()
+                self._mtime = mtime
+        return self._keys
+
+    def get_key(self, kid: str | None = None):
+        keys = self.get_keys()
+        if kid and kid in keys:
+            return keys[kid]
+        return next(iter(keys.values()))
+
+    def _pem_files(self) -> list[Path]:
+        if self.path.is_dir():
+            return sorted(self.path.glob("*.pem"))
+        return [self.path]
+
+    def _get_mtime(self) -> float:
+        # The directory mtime only changes when files are added or removed,
+        # so the files themselves are checked too
+        mtimes = [file.stat().st_mtime for file in self._pem_files()]
+        if self.path.is_dir():
+            mtimes.append(self.path.stat().st_mtime)
+        return max(mtimes)
+
+    def _load_keys(self) -> dict[str, object]:
+        logger.info(f"Loading signing keys from {self.path}")
+        keys = {}
+        for file in self._pem_files():
+            certificates = load_pem_x509_certificates(file.read_bytes())
+            for index, certificate in enumerate(certificates):
+                kid = file.stem if index == 0 else f"{file.stem}-{index}"
+                keys[kid] = certificate.public_key()
+        if not keys:
+            raise ValueError(f"No signing keys found in {self.path}")
+        return keys
+
+
+class VerifiedTokenCache(LRUCache):
+    """
+    Bounded LRU cache of already verified tokens. Entries are keyed by the
+    hash of the token and never outlive the ttl nor the exp claim of the
+    token
+    """
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> dict | None:
+        return super().get(self._key(token))
+
+    def set(self, token: str, claims: dict):
+        exp = claims.get("exp")
+        super().set(
+            self._key(token),
+            claims,
+            expires_at=exp if isinstance(exp, (int, float)) else None,
+        )
+
+
+def decode_token(
+    token: str,
+    key_provider: SigningKeyProvider,
+    token_cache: VerifiedTokenCache,
+    audience: list[str],
+) -> dict:
+    """
+    Returns the claims of the token, verifying it only if it hasn't been
+    verified before. pyjwt takes care of the validation of the exp date of
+    the token and the cache never keeps a token after its exp date
+    """
+    claims = token_cache.get(token)
+    if claims is not None:
+        return claims
+    kid = jwt.get_unverified_header(token).get("kid")
+    claims = jwt.decode(
+        token,
+        key=key_provider.get_key(kid),
+        algorithms=["RS256"],
+        audience=audience,
+    )
+    token_cache.set(token, claims)
+    return claims
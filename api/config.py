@@ -4,7 +4,20 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 class Settings(BaseSettings):
     auth0_certificate_url: str = ""
     auth0_audience: list[str] = []
+    auth0_key_check_interval: float = 60
+    auth0_token_cache_size: int = 1024
+    auth0_token_cache_ttl: float = 300
+    user_cache_size: int = 1024
+    user_cache_ttl: float = 60
+    cycle_cache_ttl: float = 300
     sqlite_database_url: str = ""
+    database_echo: bool = True
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    database_pool_timeout: float = 30
+    database_pool_pre_ping: bool = True
+    expenses_bulk_max_items: int = 5000
+    statement_import_batch_size: int = 500
     log_level: str = "DEBUG"
 
     model_config = SettingsConfigDict(env_file=".env")
@@ -1,6 +1,17 @@
 from functools import lru_cache
-from sqlmodel import SQLModel, create_engine
+from threading import Lock
+from sqlalchemy import Engine, inspect
+from sqlalchemy.pool import QueuePool
+from sqlmodel import Session, SQLModel, create_engine
 from . import config
+from .models import BudgetTotals, CycleTotals, SavingTypeTotals
+from .totals import rebuild_totals
+import logging
+
+
+logger = logging.getLogger("expenses-tracker")
+_engines: dict[str, Engine] = {}
+_engines_lock = Lock()
 
 
 @lru_cache
@@ -8,11 +19,78 @@ def get_settings():
     return config.Settings()
 
 
-sqlite_url = f"sqlite:///{get_settings().sqlite_database_url}"
-connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, echo=True, connect_args=connect_args)
+def get_database_url() -> str:
+    return f"sqlite:///{get_settings().sqlite_database_url}"
+
+
+def get_engine(database_url: str | None = None) -> Engine:
+    """
+    Returns the process-wide engine for the given url (the configured
+    database by default), creating it with a connection pool the first time
+    it's requested so every session of the process shares the same pool
+    """
+    database_url = database_url or get_database_url()
+    engine = _engines.get(database_url)
+    if engine:
+        return engine
+    with _engines_lock:
+        # Another thread could have created the engine while we were waiting
+        # for the lock
+        if database_url not in _engines:
+            settings = get_settings()
+            _engines[database_url] = create_engine(
+                database_url,
+                echo=settings.database_echo,
+                connect_args={"check_same_thread": False},
+                poolclass=QueuePool,
+                pool_size=settings.database_pool_size,
+                max_overflow=settings.database_max_overflow,
+                pool_timeout=settings.database_pool_timeout,
+                pool_pre_ping=settings.database_pool_pre_ping,
+            )
+        return _engines[database_url]
+
+
+def dispose_engines(close: bool = True):
+    """
+    Closes every pooled connection and forgets the registered engines. In a
+    forked process the connections of the parent are just dropped, without
+    closing them, by passing close as False
+    """
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose(close=close)
+        _engines.clear()
+
+
+def create_missing_indexes(engine: Engine):
+    """
+    create_all only creates the indexes of the tables it creates, so the
+    indexes added to existing tables have to be created one by one
+    """
+    with engine.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
 
 
 def create_db_and_tables():
-    print(f"Creating tables in {sqlite_url}")
+    logger.info(f"Creating tables in {get_database_url()}")
+    engine = get_engine()
+    existing_tables = set(inspect(engine).get_table_names())
     SQLModel.metadata.create_all(engine)
+    create_missing_indexes(engine)
+    # The totals of an existing database have to be computed once when
+    # their tables are created, from then on they're kept up to date
+    totals_tables = {
+        CycleTotals.__tablename__,
+        BudgetTotals.__tablename__,
+        SavingTypeTotals.__tablename__,
+    }
+    if existing_tables and not totals_tables <= existing_tables:
+        with Session(engine) as session:
+            rebuild_totals(session)
+
+
+if __name__ == "__main__":
+    create_db_and_tables()
@@ -1,11 +1,13 @@
+from datetime import datetime, time, timedelta
 from functools import lru_cache
-from pathlib import Path
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from api.models import User
-from sqlmodel import Session, create_engine, select
+from api.models import User, CurrentUser, Cycle
+from sqlmodel import Session, select
 from . import config
-from cryptography.x509 import load_pem_x509_certificate
+from .database import get_engine
+from .auth import SigningKeyProvider, VerifiedTokenCache, decode_token
+from .cache import LRUCache
 import jwt
 
 
@@ -19,11 +21,57 @@ def get_settings():
     return config.Settings()
 
 
+@lru_cache
+def get_key_provider():
+    settings = get_settings()
+    return SigningKeyProvider(
+        settings.auth0_certificate_url,
+        check_interval=settings.auth0_key_check_interval,
+    )
+
+
+@lru_cache
+def get_token_cache():
+    settings = get_settings()
+    return VerifiedTokenCache(
+        maxsize=settings.auth0_token_cache_size,
+        ttl=settings.auth0_token_cache_ttl,
+    )
+
+
+@lru_cache
+def get_user_cache():
+    settings = get_settings()
+    return LRUCache(
+        maxsize=settings.user_cache_size, ttl=settings.user_cache_ttl
+    )
+
+
+def invalidate_cached_user(auth0_id: str):
+    get_user_cache().invalidate(auth0_id)
+
+
+@lru_cache
+def get_active_cycle_cache():
+    settings = get_settings()
+    return LRUCache(
+        maxsize=settings.user_cache_size, ttl=settings.cycle_cache_ttl
+    )
+
+
+def invalidate_active_cycle(user_id: int | None = None):
+    """
+    Removes the cached active cycle of the user, or of every user if no
+    user is given
+    """
+    if user_id is None:
+        get_active_cycle_cache().clear()
+    else:
+        get_active_cycle_cache().invalidate(user_id)
+
+
 def get_session():
-    sqlite_url = f"sqlite:///{get_settings().sqlite_database_url}"
-    connect_args = {"check_same_thread": False}
-    engine = create_engine(sqlite_url, echo=True, connect_args=connect_args)
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         yield session
 
 
@@ -44,14 +92,10 @@ async def get_current_user(
     )
     settings = get_settings()
     try:
-        # pyjwt takes care of the validation of the exp date of the token
-        cert_obj = load_pem_x509_certificate(
-            Path(settings.auth0_certificate_url).read_bytes()
-        )
-        payload = jwt.decode(
+        payload = decode_token(
             token,
-            key=cert_obj.public_key(),
-            algorithms=["RS256"],
+            key_provider=get_key_provider(),
+            token_cache=get_token_cache(),
             audience=settings.auth0_audience,
         )
         auth0_id = payload.get("sub")
@@ -59,13 +103,19 @@ async def get_current_user(
             raise credentials_exception
     except jwt.ExpiredSignatureError:
         raise credentials_exception
+    user_cache = get_user_cache()
+    current_user = user_cache.get(auth0_id)
+    if current_user is not None:
+        return current_user
     # Check if the user exists
     statement = select(User).where(User.auth0_id == auth0_id)
     results = session.exec(statement)
     user = results.first()
     if user is None:
         raise credentials_exception
-    return user
+    current_user = CurrentUser.model_validate(user)
+    user_cache.set(auth0_id, current_user)
+    return current_user
 
 
 async def get_current_active_user(
@@ -74,3 +124,42 @@ async def get_current_active_user(
     if not current_user.is_active:
         raise HTTPException(status_code=401, detail="Inactive user")
     return current_user
+
+
+def get_cycle_id(
+    session: Session, user_id: int, cycle_id: int | None = None
+) -> int:
+    """
+    Returns the id of the given cycle if it belongs to the user, or the id
+    of the active cycle of the user if no cycle is given. The active cycle
+    is resolved from memory after the first lookup, until the end of its
+    last day, as the rollover that replaces it runs in another process
+    """
+    cycle_cache = get_active_cycle_cache()
+    active_cycle_id = cycle_cache.get(user_id)
+    if active_cycle_id is not None and cycle_id in (None, active_cycle_id):
+        return active_cycle_id
+    cycle_stmt = select(Cycle.id, Cycle.end_date).where(
+        Cycle.user_id == user_id
+    )
+    if cycle_id:
+        cycle_stmt = cycle_stmt.where(Cycle.id == cycle_id)
+    else:
+        cycle_stmt = cycle_stmt.where(Cycle.is_active == 1)
+    cycle = session.exec(cycle_stmt).first()
+    if not cycle:
+        raise HTTPException(status_code=404, detail="Cycle not found")
+    cycle_db_id, end_date = cycle
+    expires_at = datetime.combine(end_date + timedelta(days=1), time())
+    # A cycle past its end is about to be replaced, so it isn't cached
+    if not cycle_id and expires_at > datetime.now():
+        cycle_cache.set(user_id, cycle_db_id, expires_at.timestamp())
+    return cycle_db_id
+
+
+async def resolve_cycle(
+    cycle_id: int | None = None,
+    current_user: User = Depends(get_current_active_user),
+    session: Session = Depends(get_session),
+) -> int:
+    return get_cycle_id(session, current_user.id, cycle_id)
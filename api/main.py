@@ -14,6 +14,8 @@ from api.routers import (
     incomes,
     savings,
     cycles,
+    export,
+    imports,
 )
 from api.database import create_db_and_tables
 from api.log_config import LogConfig
@@ -53,6 +55,8 @@ app.include_router(incomes.router)
 app.include_router(savings.router)
 app.include_router(sandbox.router)
 app.include_router(cycles.router)
+app.include_router(export.router)
+app.include_router(imports.router)
 
 handler = Mangum(app, lifespan="on")
 
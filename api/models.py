@@ -1,5 +1,6 @@
 from sqlmodel import Field, SQLModel, AutoString, Relationship
-from pydantic import EmailStr
+from sqlalchemy import Index
+from pydantic import ConfigDict, EmailStr
 from datetime import datetime, date
 from enum import Enum
 
@@ -9,6 +10,7 @@ class SourceEnum(str, Enum):
     email = "Email"
     bot = "Bot"
     recurrent = "Recurrent"
+    statement = "Statement"
 
 
 class SavingMovementEnum(str, Enum):
@@ -16,6 +18,23 @@ class SavingMovementEnum(str, Enum):
     outcome = "Outcome"
 
 
+class ExportFormatEnum(str, Enum):
+    csv = "csv"
+    ndjson = "ndjson"
+
+
+class StatementFormatEnum(str, Enum):
+    csv = "csv"
+    ofx = "ofx"
+
+
+class ImportStatusEnum(str, Enum):
+    pending = "Pending"
+    running = "Running"
+    done = "Done"
+    failed = "Failed"
+
+
 class BaseModel(SQLModel):
     id: int | None = Field(default=None, primary_key=True)
     created_at: datetime = Field(default_factory=datetime.now, nullable=False)
@@ -53,6 +72,24 @@ class UserCreate(UserBase):
     pass
 
 
+class CurrentUser(SQLModel):
+    """
+    Immutable snapshot of the authenticated user. It isn't attached to any
+    session, so it can be kept in memory between requests
+    """
+    model_config = ConfigDict(frozen=True)
+
+    id: int
+    email: str
+    name: str
+    auth0_id: str
+    is_active: bool
+    start_cycle_day: int
+    end_cycle_day: int
+    created_at: datetime
+    updated_at: datetime
+
+
 class SavingType(BaseModel, table=True):
     description: str
     user_id: int = Field(foreign_key='user.id')
@@ -62,6 +99,13 @@ class SavingType(BaseModel, table=True):
         Relationship(back_populates="saving_type")
 
 
+Index(
+    "ix_savingtype_user_id_description",
+    SavingType.user_id,
+    SavingType.description,
+)
+
+
 class SavingTypePublic(SQLModel):
     id: int
     description: str
@@ -168,6 +212,10 @@ class Cycle(BaseModel, table=True):
     budgets: list["Budget"] = Relationship(back_populates='cycle')
 
 
+Index("ix_cycle_user_id_is_active", Cycle.user_id, Cycle.is_active)
+Index("ix_cycle_user_id_end_date", Cycle.user_id, Cycle.end_date)
+
+
 class CyclePublic(SQLModel):
     id: int
     description: str
@@ -184,6 +232,9 @@ class Budget(BaseModel, table=True):
     expenses: list["Expense"] = Relationship(back_populates="budget")
 
 
+Index("ix_budget_cycle_id", Budget.cycle_id)
+
+
 class BudgetPublic(SQLModel):
     id: int
     description: str
@@ -233,6 +284,11 @@ class Income(IncomeBase, BaseModel, table=True):
     cycle: Cycle = Relationship(back_populates="incomes")
 
 
+Index(
+    "ix_income_cycle_id_created_at", Income.cycle_id, Income.created_at.desc()
+)
+
+
 class IncomeCreate(IncomeBase):
     cycle_id: int | None = None
     create_recurrent_income: bool = False
@@ -261,10 +317,22 @@ class Expense(ExpenseBase, BaseModel, table=True):
     cycle: Cycle = Relationship(back_populates="expenses")
 
 
+Index(
+    "ix_expense_cycle_id_date_expense",
+    Expense.cycle_id,
+    Expense.date_expense.desc(),
+)
+Index("ix_expense_cycle_id_budget_id", Expense.cycle_id, Expense.budget_id)
+Index("ix_expense_budget_id", Expense.budget_id)
+
+
 class ExpenseCreate(ExpenseBase):
     cycle_id: int | None = None
     budget_id: int | None = None
     create_recurrent_expense: bool = False
+    # Only used by the bulk endpoint, sending the same key again returns
+    # the expense already created instead of creating another one
+    idempotency_key: str | None = None
 
 
 class ExpensePublic(ExpenseBase):
@@ -274,6 +342,28 @@ class ExpensePublic(ExpenseBase):
     is_recurrent_expense: bool
 
 
+class ExpenseIdempotencyKey(SQLModel, table=True):
+    """
+    Idempotency keys of the created expenses, so the clients can send an
+    expense or a batch again when they don't know if it was created
+    """
+    user_id: int = Field(foreign_key='user.id', primary_key=True)
+    idempotency_key: str = Field(primary_key=True)
+    expense_id: int
+
+
+class ExpenseBulkResult(SQLModel):
+    index: int
+    id: int | None = None
+    detail: str | None = None
+
+
+class ExpenseBulkResponse(SQLModel):
+    created: int
+    failed: int
+    results: list[ExpenseBulkResult]
+
+
 class ExpenseUpdate(SQLModel):
     description: str | None = None
     val_expense: float | None = None
@@ -299,6 +389,12 @@ class Saving(SavingBase, BaseModel, table=True):
     cycle: Cycle = Relationship(back_populates="savings")
 
 
+Index(
+    "ix_saving_cycle_id_created_at", Saving.cycle_id, Saving.created_at.desc()
+)
+Index("ix_saving_saving_type_id", Saving.saving_type_id)
+
+
 class SavingCreate(SavingBase):
     description: str
     cycle_id: int | None = None
@@ -340,11 +436,66 @@ class GroupedSavings(SQLModel):
     last_saving: datetime | None = None
 
 
+class StatementImportBase(SQLModel):
+    filename: str
+    statement_format: StatementFormatEnum
+    status: ImportStatusEnum = ImportStatusEnum.pending
+    rows_read: int = 0
+    expenses_created: int = 0
+    incomes_created: int = 0
+    duplicates: int = 0
+    failed: int = 0
+    detail: str = ''
+
+
+class StatementImport(StatementImportBase, BaseModel, table=True):
+    """Progress of the import of a bank statement"""
+    user_id: int = Field(foreign_key='user.id')
+
+
+class StatementImportPublic(StatementImportBase):
+    id: int
+    created_at: datetime
+    updated_at: datetime
+
+
+class SavingTypeTotals(SQLModel, table=True):
+    """
+    Running balance of each saving type, kept up to date by api.totals
+    every time a saving or a saving outcome is written
+    """
+    saving_type_id: int = Field(foreign_key='savingtype.id', primary_key=True)
+    total_global: float = 0
+    saving_count: int = 0
+    recurrent_count: int = 0
+    last_saving: datetime | None = None
+
+
 class CycleExpensesStatus(SQLModel):
-    total_recurrent_expenses: float
-    total_expenses: float
-    total_incomes: float
-    total_savings: float
+    total_recurrent_expenses: float = 0
+    total_expenses: float = 0
+    total_incomes: float = 0
+    total_savings: float = 0
+
+
+class CycleTotals(CycleExpensesStatus, table=True):
+    """
+    Totals of the movements of each cycle, kept up to date by api.totals
+    every time an expense, income or saving is written
+    """
+    cycle_id: int = Field(foreign_key='cycle.id', primary_key=True)
+
+
+class BudgetTotals(SQLModel, table=True):
+    """
+    Spent value and number of expenses of each budget of a cycle, kept up to
+    date by api.totals. The expenses without budget are kept with the
+    budget id 0
+    """
+    cycle_id: int = Field(foreign_key='cycle.id', primary_key=True)
+    budget_id: int = Field(primary_key=True)
+    total_spent: float = 0
+    expense_count: int = 0
 
 
 class CycleSimpleList(SQLModel):
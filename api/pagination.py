@@ -0,0 +1,66 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from fastapi import HTTPException, Response
+from sqlalchemy import and_, or_
+from sqlmodel.sql.expression import SelectOfScalar
+import binascii
+import json
+
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(sort_value: datetime, row_id: int) -> str:
+    raw_cursor = json.dumps([sort_value.isoformat(), row_id])
+    return urlsafe_b64encode(raw_cursor.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        raw_sort_value, row_id = json.loads(urlsafe_b64decode(cursor))
+        if not isinstance(row_id, int):
+            raise ValueError
+        return datetime.fromisoformat(raw_sort_value), row_id
+    except (binascii.Error, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def paginate(
+    stmt: SelectOfScalar,
+    sort_column,
+    id_column,
+    commons: dict,
+    cursor: str | None = None,
+) -> SelectOfScalar:
+    """
+    Sorts the statement from the newest to the oldest row and returns the
+    requested page. When a cursor is given the page starts right after the
+    row it points to (keyset pagination) and skip is ignored, otherwise the
+    page is selected with skip/limit
+    """
+    stmt = stmt.order_by(sort_column.desc(), id_column.desc())
+    if cursor:
+        sort_value, row_id = decode_cursor(cursor)
+        stmt = stmt.where(
+            or_(
+                sort_column < sort_value,
+                and_(sort_column == sort_value, id_column < row_id),
+            )
+        )
+    else:
+        stmt = stmt.offset(commons["skip"])
+    return stmt.limit(commons["limit"])
+
+
+def set_next_cursor(
+    response: Response, rows: list, sort_field: str, limit: int
+):
+    """
+    Adds the cursor of the next page to the response headers when the page
+    is full, as there could be more rows after it
+    """
+    if rows and len(rows) >= limit:
+        last_row = rows[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(
+            getattr(last_row, sort_field), last_row.id
+        )
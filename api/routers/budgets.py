@@ -3,72 +3,61 @@ from api.dependencies import (
     get_current_active_user,
     get_session,
     common_parameters,
+    resolve_cycle,
 )
-from api.models import User, Budget, Cycle, Expense, BudgetWithTotal
+from api.models import User, Budget, BudgetTotals, Cycle, BudgetWithTotal
 from sqlmodel import Session, select, col
 from sqlalchemy import func, and_, desc
+from api.totals import get_unbudgeted_totals
 from typing import Annotated
 
 
 router = APIRouter(prefix="/budgets", tags=["Budgets"])
 CommonsDep = Annotated[dict, Depends(common_parameters)]
+CycleDep = Annotated[int, Depends(resolve_cycle)]
 
 
 @router.get("", response_model=list[BudgetWithTotal])
 async def read_budgets(
     commons: CommonsDep,
+    cycle_id: CycleDep,
     current_user: User = Depends(get_current_active_user),
-    cycle_id: int | None = None,
     session: Session = Depends(get_session),
 ):
-    cycle_stmt = select(Cycle).where(Cycle.user_id == current_user.id)
-    if cycle_id:
-        cycle_stmt = cycle_stmt.where(Cycle.id == cycle_id)
-    else:
-        cycle_stmt = cycle_stmt.where(Cycle.is_active == 1)
-    cycle_db = session.exec(cycle_stmt).first()
-    if not cycle_db:
-        raise HTTPException(status_code=404, detail="Cycle not found")
 
-    total_spent = func.coalesce(func.sum(Expense.val_expense), 0).label("total_spent")
-    total_expenses_records = func.coalesce(func.count(Expense.id), 0).label(
-        "total_expenses_records"
-    )
+    # The spent values are maintained by api.totals on every expense change,
+    # so they're read instead of aggregated from the expenses
     stmt = (
-        select(Budget, total_spent, total_expenses_records)
-        .where(Budget.cycle_id == cycle_db.id)
+        select(Budget, BudgetTotals.total_spent)
+        .where(Budget.cycle_id == cycle_id)
         .outerjoin(
-            Expense,
+            BudgetTotals,
             and_(
-                col(Expense.budget_id) == col(Budget.id),
-                col(Expense.cycle_id) == cycle_db.id,
+                col(BudgetTotals.budget_id) == col(Budget.id),
+                col(BudgetTotals.cycle_id) == cycle_id,
             ),
         )
-        .group_by(col(Budget.id))
-        .order_by(desc("total_expenses_records"))
+        .order_by(desc(func.coalesce(BudgetTotals.expense_count, 0)))
         .offset(commons["skip"])
         .limit(commons["limit"])
     )
     rows = session.exec(stmt).all()
 
-    unbudgeted_stmt = select(func.sum(Expense.val_expense)).where(
-        and_(
-            col(Expense.cycle_id) == cycle_db.id,
-            col(Expense.budget_id) == None,
-        )
-    )
-    unbudgeted_total = session.exec(unbudgeted_stmt).one()
+    unbudgeted_totals = get_unbudgeted_totals(session, cycle_id)
     result = []
-    if unbudgeted_total:
+    # The count decides, as adding and removing expenses can leave a float
+    # residue in the total
+    if unbudgeted_totals.expense_count > 0:
+        cycle_db = session.get(Cycle, cycle_id)
         result.append(
             BudgetWithTotal(
                 id=0,
                 description="Sin ppto.",
                 val_budget=0,
-                cycle_id=cycle_db.id,
+                cycle_id=cycle_id,
                 created_at=cycle_db.created_at,
                 updated_at=cycle_db.updated_at,
-                total_spent=float(unbudgeted_total or 0),
+                total_spent=float(unbudgeted_totals.total_spent or 0),
             )
         )
 
@@ -83,7 +72,7 @@ async def read_budgets(
                 updated_at=budget.updated_at,
                 total_spent=float(spent or 0),
             )
-            for budget, spent, _ in rows
+            for budget, spent in rows
         ]
     )
 
@@ -102,6 +91,9 @@ async def delete_budget(
     cycle = session.get(Cycle, budget.cycle_id)
     if not cycle or cycle.user_id != current_user.id:
         raise HTTPException(status_code=403, detail="Budget not found")
+    budget_totals = session.get(BudgetTotals, (budget.cycle_id, budget_id))
+    if budget_totals:
+        session.delete(budget_totals)
     session.delete(budget)
     session.commit()
     return {"ok": True}
@@ -1,20 +1,30 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
 from api.dependencies import (
     get_current_active_user,
     get_session,
+    get_settings,
+    get_cycle_id,
     common_parameters,
+    resolve_cycle,
 )
 from api.models import (
     User,
-    Expense,
     Cycle,
+    Expense,
     ExpenseCreate,
+    ExpenseBulkResult,
+    ExpenseBulkResponse,
+    ExpenseIdempotencyKey,
     Budget,
     ExpensePublic,
     ExpenseUpdate,
     RecurrentExpense,
 )
-from sqlmodel import Session, select
+from sqlmodel import Session, select, insert, col
+from sqlalchemy.exc import IntegrityError
+from api.pagination import paginate, set_next_cursor
+from api.totals import apply_expense, apply_expenses
+from sqlalchemy.orm import joinedload
 from typing import Annotated
 import logging
 
@@ -22,62 +32,63 @@ import logging
 logger = logging.getLogger("expenses-tracker")
 router = APIRouter(prefix="/expenses", tags=["Expenses"])
 CommonsDep = Annotated[dict, Depends(common_parameters)]
+CycleDep = Annotated[int, Depends(resolve_cycle)]
 
 
 @router.get("", response_model=list[ExpensePublic])
 async def read_expenses(
     commons: CommonsDep,
-    cycle_id: int | None = None,
+    cycle_id: CycleDep,
+    response: Response,
     budget_id: int | None = None,
+    cursor: str | None = None,
     current_user: User = Depends(get_current_active_user),
     session: Session = Depends(get_session),
 ):
     logger.info(f"Reading expenses for user {current_user.id}")
-    cycle_stmt = select(Cycle).where(Cycle.user_id == current_user.id)
-    if cycle_id:
-        cycle_stmt = cycle_stmt.where(Cycle.id == cycle_id)
-    else:
-        cycle_stmt = cycle_stmt.where(Cycle.is_active == 1)
-
-    cycle_db = session.exec(cycle_stmt).first()
-    if not cycle_db:
-        raise HTTPException(status_code=404, detail="Cycle not found")
-
+    # The budget and the cycle are loaded in the same query to avoid one
+    # lazy load per expense when the response is serialized
+    stmt = (
+        select(Expense)
+        .options(joinedload(Expense.budget), joinedload(Expense.cycle))
+        .where(Expense.cycle_id == cycle_id)
+    )
     if budget_id == 0:
-        stmt = (
-            select(Expense)
-            .where(Expense.cycle_id == cycle_db.id)
-            .where(Expense.budget_id.is_(None))
-            .order_by(Expense.date_expense.desc())
-            .offset(commons["skip"])
-            .limit(commons["limit"])
-        )
+        stmt = stmt.where(Expense.budget_id.is_(None))
     elif budget_id:
         budget_stmt = (
             select(Budget)
-            .where(Budget.cycle_id == cycle_db.id)
+            .where(Budget.cycle_id == cycle_id)
             .where(Budget.id == budget_id)
         )
         budget_db = session.exec(budget_stmt).first()
         if not budget_db:
             raise HTTPException(status_code=404, detail="Budget not found")
-        stmt = (
-            select(Expense)
-            .where(Expense.cycle_id == cycle_db.id)
-            .where(Expense.budget_id == budget_db.id)
-            .order_by(Expense.date_expense.desc())
-            .offset(commons["skip"])
-            .limit(commons["limit"])
-        )
-    else:
-        stmt = (
-            select(Expense)
-            .where(Expense.cycle_id == cycle_db.id)
-            .order_by(Expense.date_expense.desc())
-            .offset(commons["skip"])
-            .limit(commons["limit"])
+        stmt = stmt.where(Expense.budget_id == budget_db.id)
+    stmt = paginate(
+        stmt, Expense.date_expense, Expense.id, commons, cursor=cursor
+    )
+    expenses = session.exec(stmt).all()
+    set_next_cursor(response, expenses, "date_expense", commons["limit"])
+    return expenses
+
+
+def _get_known_idempotency_keys(
+    session: Session, user_id: int, idempotency_keys: set[str]
+) -> dict[str, int]:
+    """Ids of the expenses already created with the given keys"""
+    if not idempotency_keys:
+        return {}
+    return dict(session.exec(
+        select(
+            ExpenseIdempotencyKey.idempotency_key,
+            ExpenseIdempotencyKey.expense_id,
         )
-    return session.exec(stmt).all()
+        .where(ExpenseIdempotencyKey.user_id == user_id)
+        .where(col(ExpenseIdempotencyKey.idempotency_key).in_(
+            idempotency_keys
+        ))
+    ).all())
 
 
 @router.post("", response_model=ExpensePublic, status_code=201)
@@ -86,24 +97,27 @@ async def create_expense(
     current_user: User = Depends(get_current_active_user),
     session: Session = Depends(get_session),
     expense: ExpenseCreate,
+    response: Response,
 ):
+    """
+    Creates an expense. When its idempotency key was already sent, the
+    expense created then is returned instead of creating it again
+    """
     logger.info(f"Creating expense: {expense}")
-    cycle_stmt = select(Cycle).where(Cycle.user_id == current_user.id)
-    if expense.cycle_id:
-        cycle_stmt = cycle_stmt.where(Cycle.id == expense.cycle_id)
-    else:
-        cycle_stmt = cycle_stmt.where(Cycle.is_active == 1)
-
-    cycle_db = session.exec(cycle_stmt).first()
-
-    if not cycle_db:
-        raise HTTPException(status_code=404, detail="Cycle not found")
+    key = expense.idempotency_key
+    known_keys = _get_known_idempotency_keys(
+        session, current_user.id, {key} if key else set()
+    )
+    if key in known_keys:
+        response.status_code = 200
+        return session.get(Expense, known_keys[key])
+    cycle_id = get_cycle_id(session, current_user.id, expense.cycle_id)
 
     if expense.budget_id:
         budget_stmt = (
             select(Budget)
             .where(Budget.id == expense.budget_id)
-            .where(Budget.cycle_id == cycle_db.id)
+            .where(Budget.cycle_id == cycle_id)
         )
         if not session.exec(budget_stmt).first():
             raise HTTPException(status_code=404, detail="Budget not found")
@@ -120,12 +134,33 @@ async def create_expense(
             expense,
             update={
                 "user_id": current_user.id,
-                "cycle_id": cycle_db.id,
+                "cycle_id": cycle_id,
                 "is_recurrent_expense": expense.create_recurrent_expense,
             },
         )
         session.add(db_expense)
+        if key:
+            session.flush()
+            session.add(ExpenseIdempotencyKey(
+                user_id=current_user.id,
+                idempotency_key=key,
+                expense_id=db_expense.id,
+            ))
+        apply_expense(session, db_expense)
         session.commit()
+    except IntegrityError as e:
+        session.rollback()
+        # A concurrent request with the same key created the expense first
+        known_keys = _get_known_idempotency_keys(
+            session, current_user.id, {key} if key else set()
+        )
+        if key not in known_keys:
+            logger.error(f"Error creating expense: {e}")
+            raise HTTPException(
+                status_code=500, detail="Error creating expense"
+            )
+        response.status_code = 200
+        return session.get(Expense, known_keys[key])
     except Exception as e:
         logger.error(f"Error creating expense: {e}")
         raise HTTPException(status_code=500, detail="Error creating expense")
@@ -134,6 +169,188 @@ async def create_expense(
     return db_expense
 
 
+@router.post("/bulk", response_model=ExpenseBulkResponse)
+def create_expenses_bulk(
+    *,
+    current_user: User = Depends(get_current_active_user),
+    session: Session = Depends(get_session),
+    expenses: list[ExpenseCreate],
+):
+    """
+    Creates many expenses at once. The cycles and budgets of all of them
+    are resolved with one query each and the valid expenses are inserted
+    in a single transaction, the result of each expense is returned in the
+    order they were sent. The expenses with an idempotency key already sent
+    aren't created again, their result has the id of the first one
+    """
+    logger.info(f"Creating {len(expenses)} expenses in bulk")
+    if len(expenses) > get_settings().expenses_bulk_max_items:
+        raise HTTPException(status_code=413, detail="Too many expenses")
+    try:
+        return _create_expenses_bulk(session, current_user, expenses)
+    except IntegrityError:
+        # A concurrent request committed some of the idempotency keys
+        # first, so the expenses are resolved again to return their ids
+        logger.info("Idempotency keys created concurrently, retrying")
+    try:
+        return _create_expenses_bulk(session, current_user, expenses)
+    except IntegrityError as e:
+        logger.error(f"Error creating expenses in bulk: {e}")
+        raise HTTPException(status_code=500, detail="Error creating expenses")
+
+
+def _create_expenses_bulk(
+    session: Session, current_user: User, expenses: list[ExpenseCreate]
+) -> ExpenseBulkResponse:
+    cycle_ids = {
+        expense.cycle_id for expense in expenses if expense.cycle_id
+    }
+    user_cycle_ids = set(session.exec(
+        select(Cycle.id)
+        .where(Cycle.user_id == current_user.id)
+        .where(col(Cycle.id).in_(cycle_ids))
+    ).all()) if cycle_ids else set()
+    active_cycle_id = None
+    if any(not expense.cycle_id for expense in expenses):
+        try:
+            active_cycle_id = get_cycle_id(session, current_user.id)
+        except HTTPException:
+            # Only the expenses without cycle fail
+            pass
+    budget_ids = {
+        expense.budget_id for expense in expenses if expense.budget_id
+    }
+    budget_cycles = dict(session.exec(
+        select(Budget.id, Budget.cycle_id)
+        .where(col(Budget.id).in_(budget_ids))
+    ).all()) if budget_ids else {}
+
+    known_keys = _get_known_idempotency_keys(session, current_user.id, {
+        expense.idempotency_key for expense in expenses
+        if expense.idempotency_key
+    })
+
+    results = []
+    db_expenses = []
+    db_keys = []
+    created_results = []
+    # Results of the expenses repeated in the request, with the result of
+    # the first one
+    repeated_results = []
+    new_keys = {}
+    recurrent_expenses = []
+    for index, expense in enumerate(expenses):
+        if expense.idempotency_key in known_keys:
+            # Already created by a previous request
+            results.append(ExpenseBulkResult(
+                index=index, id=known_keys[expense.idempotency_key]
+            ))
+            continue
+        if expense.idempotency_key in new_keys:
+            result = ExpenseBulkResult(index=index)
+            repeated_results.append(
+                (result, new_keys[expense.idempotency_key])
+            )
+            results.append(result)
+            continue
+        if expense.cycle_id:
+            cycle_id = (
+                expense.cycle_id if expense.cycle_id in user_cycle_ids
+                else None
+            )
+        else:
+            cycle_id = active_cycle_id
+        if not cycle_id:
+            results.append(
+                ExpenseBulkResult(index=index, detail="Cycle not found")
+            )
+            continue
+        budget_cycle_id = budget_cycles.get(expense.budget_id)
+        if expense.budget_id and budget_cycle_id != cycle_id:
+            results.append(
+                ExpenseBulkResult(index=index, detail="Budget not found")
+            )
+            continue
+        if expense.create_recurrent_expense:
+            recurrent_expenses.append(RecurrentExpense(
+                description=expense.description,
+                val_expense=expense.val_expense,
+                user_id=current_user.id or 0,
+            ))
+        db_expenses.append(Expense.model_validate(
+            expense,
+            update={
+                "cycle_id": cycle_id,
+                "is_recurrent_expense": expense.create_recurrent_expense,
+            },
+        ))
+        db_keys.append(expense.idempotency_key)
+        result = ExpenseBulkResult(index=index)
+        if expense.idempotency_key:
+            new_keys[expense.idempotency_key] = result
+        created_results.append(result)
+        results.append(result)
+
+    if db_expenses:
+        try:
+            if recurrent_expenses:
+                session.exec(
+                    insert(RecurrentExpense),
+                    params=[
+                        recurrent_expense.model_dump(exclude={"id"})
+                        for recurrent_expense in recurrent_expenses
+                    ],
+                )
+            # SQLite assigns the ids in the order the rows are inserted and
+            # the write lock is held until commit, so the sorted ids match
+            # the order of the expenses. Asking SQLAlchemy to sort them
+            # would insert one row per statement
+            expense_ids = sorted(session.exec(
+                insert(Expense).returning(Expense.id),
+                params=[
+                    db_expense.model_dump(exclude={"id"})
+                    for db_expense in db_expenses
+                ],
+                # Keeps the expenses without budget in the same batch
+                execution_options={"render_nulls": True},
+            ).scalars().all())
+            if new_keys:
+                session.exec(
+                    insert(ExpenseIdempotencyKey),
+                    params=[
+                        {
+                            "user_id": current_user.id,
+                            "idempotency_key": idempotency_key,
+                            "expense_id": expense_id,
+                        }
+                        for idempotency_key, expense_id in zip(
+                            db_keys, expense_ids
+                        )
+                        if idempotency_key
+                    ],
+                )
+            apply_expenses(session, db_expenses)
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            raise
+        except Exception as e:
+            logger.error(f"Error creating expenses in bulk: {e}")
+            raise HTTPException(
+                status_code=500, detail="Error creating expenses"
+            )
+        for result, expense_id in zip(created_results, expense_ids):
+            result.id = expense_id
+        for result, first_result in repeated_results:
+            result.id = first_result.id
+
+    return ExpenseBulkResponse(
+        created=len(db_expenses),
+        failed=len([result for result in results if result.detail]),
+        results=results,
+    )
+
+
 @router.patch("/{expense_id}", response_model=ExpensePublic)
 def update_expense(
     *,
@@ -150,13 +367,7 @@ def update_expense(
         raise HTTPException(status_code=404, detail="Expense not found")
 
     if expense.cycle_id:
-        db_cycle = session.exec(
-            select(Cycle)
-            .where(Cycle.user_id == current_user.id)
-            .where(Cycle.id == expense.cycle_id)
-        ).first()
-        if not db_cycle:
-            raise HTTPException(status_code=404, detail="Cycle not found")
+        get_cycle_id(session, current_user.id, expense.cycle_id)
 
     if (
         expense.budget_id
@@ -175,8 +386,10 @@ def update_expense(
     # could lead to data inconsistency
     if expense.cycle_id and expense.cycle_id != db_expense.cycle_id:
         expense_data["budget_id"] = None
+    apply_expense(session, db_expense, -1)
     db_expense.sqlmodel_update(expense_data)
     session.add(db_expense)
+    apply_expense(session, db_expense)
     session.commit()
     session.refresh(db_expense)
     return db_expense
@@ -197,5 +410,6 @@ def delete_expense(
         raise HTTPException(status_code=404, detail="Expense not found")
 
     session.delete(db_expense)
+    apply_expense(session, db_expense, -1)
     session.commit()
     return {"detail": "Expense deleted"}
@@ -0,0 +1,185 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import StreamingResponse
+from api.dependencies import get_current_active_user, get_session
+from api.models import (
+    User,
+    Cycle,
+    Expense,
+    Income,
+    Saving,
+    Budget,
+    SavingType,
+    ExportFormatEnum,
+)
+from sqlmodel import Session, select
+from sqlalchemy import Engine, literal, null
+from datetime import date, datetime
+from enum import Enum
+import csv
+import io
+import json
+import logging
+
+
+logger = logging.getLogger("expenses-tracker")
+router = APIRouter(prefix="/export", tags=["Export"])
+EXPORT_BATCH_SIZE = 500
+EXPORT_COLUMNS = [
+    "type",
+    "id",
+    "cycle_id",
+    "cycle",
+    "date",
+    "description",
+    "value",
+    "budget",
+    "saving_type",
+    "categories",
+    "source",
+    "movement_type",
+    "is_recurrent",
+]
+MEDIA_TYPES = {
+    ExportFormatEnum.csv: "text/csv",
+    ExportFormatEnum.ndjson: "application/x-ndjson",
+}
+
+
+def _export_statements(
+    user_id: int, from_date: date | None, to_date: date | None
+) -> list:
+    """
+    One statement per kind of movement, all of them with the columns of the
+    export in the same order
+    """
+    conditions = [Cycle.user_id == user_id]
+    if from_date:
+        conditions.append(Cycle.start_date >= from_date)
+    if to_date:
+        conditions.append(Cycle.start_date <= to_date)
+    expenses = (
+        select(
+            literal("expense"),
+            Expense.id,
+            Expense.cycle_id,
+            Cycle.description,
+            Expense.date_expense,
+            Expense.description,
+            Expense.val_expense,
+            Budget.description,
+            null(),
+            Expense.categories,
+            Expense.source,
+            null(),
+            Expense.is_recurrent_expense,
+        )
+        .select_from(Expense)
+        .join(Cycle, Cycle.id == Expense.cycle_id)
+        .outerjoin(Budget, Budget.id == Expense.budget_id)
+        .order_by(Expense.id)
+    )
+    incomes = (
+        select(
+            literal("income"),
+            Income.id,
+            Income.cycle_id,
+            Cycle.description,
+            Income.date_income,
+            Income.description,
+            Income.val_income,
+            null(),
+            null(),
+            null(),
+            null(),
+            null(),
+            Income.is_recurrent_income,
+        )
+        .select_from(Income)
+        .join(Cycle, Cycle.id == Income.cycle_id)
+        .order_by(Income.id)
+    )
+    savings = (
+        select(
+            literal("saving"),
+            Saving.id,
+            Saving.cycle_id,
+            Cycle.description,
+            Saving.date_saving,
+            Saving.movement_description,
+            Saving.val_saving,
+            null(),
+            SavingType.description,
+            null(),
+            null(),
+            Saving.movement_type,
+            Saving.is_recurrent_saving,
+        )
+        .select_from(Saving)
+        .join(Cycle, Cycle.id == Saving.cycle_id)
+        .join(SavingType, SavingType.id == Saving.saving_type_id)
+        .order_by(Saving.id)
+    )
+    return [
+        stmt.where(*conditions) for stmt in (expenses, incomes, savings)
+    ]
+
+
+def _export_value(value):
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def _format_rows(rows, export_format: ExportFormatEnum) -> str:
+    rows = [[_export_value(value) for value in row] for row in rows]
+    if export_format == ExportFormatEnum.ndjson:
+        return "".join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n" for row in rows
+        )
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def stream_export(
+    bind: Engine, statements: list, export_format: ExportFormatEnum
+):
+    """
+    Yields the export in chunks of EXPORT_BATCH_SIZE rows, fetching them
+    from the database cursor as they are sent so the memory used doesn't
+    depend on the number of rows. It uses its own session, as the one of
+    the request is closed before the response is streamed
+    """
+    if export_format == ExportFormatEnum.csv:
+        yield _format_rows([EXPORT_COLUMNS], export_format)
+    with Session(bind) as session:
+        for stmt in statements:
+            result = session.exec(
+                stmt.execution_options(yield_per=EXPORT_BATCH_SIZE)
+            )
+            for rows in result.partitions():
+                yield _format_rows(rows, export_format)
+
+
+@router.get("")
+def export_movements(
+    export_format: ExportFormatEnum = ExportFormatEnum.csv,
+    from_date: date | None = None,
+    to_date: date | None = None,
+    current_user: User = Depends(get_current_active_user),
+    session: Session = Depends(get_session),
+):
+    """
+    Exports all the expenses, incomes and savings of the user, or only the
+    ones of the cycles starting between from_date and to_date
+    """
+    logger.info(f"Exporting movements of user {current_user.id}")
+    statements = _export_statements(current_user.id, from_date, to_date)
+    filename = f"expenses-tracker-export.{export_format.value}"
+    return StreamingResponse(
+        stream_export(session.get_bind(), statements, export_format),
+        media_type=MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
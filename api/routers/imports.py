@@ -0,0 +1,100 @@
+from fastapi import (
+    APIRouter, BackgroundTasks, Depends, HTTPException, UploadFile
+)
+from api.dependencies import (
+    get_current_active_user,
+    get_session,
+    get_settings,
+)
+from api.models import (
+    User,
+    StatementImport,
+    StatementImportPublic,
+    StatementFormatEnum,
+)
+from api.statements import run_statement_import
+from sqlmodel import Session
+from pathlib import Path
+import logging
+import os
+import shutil
+import tempfile
+
+
+logger = logging.getLogger("expenses-tracker")
+router = APIRouter(prefix="/imports", tags=["Imports"])
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _run_import_and_remove_file(bind, import_id: int, path: str, batch_size):
+    try:
+        run_statement_import(bind, import_id, path, batch_size)
+    finally:
+        os.remove(path)
+
+
+@router.post("", response_model=StatementImportPublic, status_code=202)
+def import_statement(
+    *,
+    file: UploadFile,
+    background_tasks: BackgroundTasks,
+    statement_format: StatementFormatEnum | None = None,
+    current_user: User = Depends(get_current_active_user),
+    session: Session = Depends(get_session),
+):
+    """
+    Receives a CSV or OFX bank statement and imports its movements in the
+    background. The format is taken from the file extension when it's not
+    given. The progress can be followed with GET /imports/{import_id}
+    """
+    filename = file.filename or ""
+    if not statement_format:
+        try:
+            statement_format = StatementFormatEnum(
+                Path(filename).suffix.lstrip(".").lower()
+            )
+        except ValueError:
+            raise HTTPException(
+                status_code=400, detail="Unsupported statement format"
+            )
+    logger.info(f"Importing {statement_format.value} statement {filename}")
+    # The uploaded file is closed with the request, so it's copied in
+    # chunks to a file that lives until the import finishes
+    statement_file = tempfile.NamedTemporaryFile(
+        suffix=f".{statement_format.value}", delete=False
+    )
+    try:
+        with statement_file:
+            shutil.copyfileobj(file.file, statement_file, UPLOAD_CHUNK_SIZE)
+        statement_import = StatementImport(
+            filename=filename,
+            statement_format=statement_format,
+            user_id=current_user.id,
+        )
+        session.add(statement_import)
+        session.commit()
+        session.refresh(statement_import)
+        background_tasks.add_task(
+            _run_import_and_remove_file,
+            session.get_bind(),
+            statement_import.id,
+            statement_file.name,
+            get_settings().statement_import_batch_size,
+        )
+    except Exception:
+        # The background task removes the file only once it's added
+        os.remove(statement_file.name)
+        raise
+    return statement_import
+
+
+@router.get("/{import_id}", response_model=StatementImportPublic)
+def read_statement_import(
+    import_id: int,
+    current_user: User = Depends(get_current_active_user),
+    session: Session = Depends(get_session),
+):
+    statement_import = session.get(StatementImport, import_id)
+    if not statement_import or statement_import.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Import not found")
+    return statement_import
@@ -1,17 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
 from api.dependencies import (
     get_current_active_user,
     get_session,
+    get_cycle_id,
     common_parameters,
+    resolve_cycle,
 )
 from api.models import (
     User,
     RecurrentIncome,
     Income,
-    Cycle,
     IncomeCreate,
     IncomeUpdate,
 )
+from api.pagination import paginate, set_next_cursor
+from api.totals import apply_income
 from sqlmodel import Session, select
 from typing import Annotated
 import logging
@@ -20,30 +23,29 @@ import logging
 logger = logging.getLogger("expenses-tracker")
 router = APIRouter(prefix="/incomes", tags=["Incomes"])
 CommonsDep = Annotated[dict, Depends(common_parameters)]
+CycleDep = Annotated[int, Depends(resolve_cycle)]
 
 
 @router.get("", response_model=list[Income])
 async def read_incomes(
     commons: CommonsDep,
-    cycle_id: int | None = None,
+    cycle_id: CycleDep,
+    response: Response,
+    cursor: str | None = None,
     current_user: User = Depends(get_current_active_user),
     session: Session = Depends(get_session),
 ):
     logger.info(f"Reading incomes for user {current_user.id}")
-    cycle_stmt = select(Cycle).where(Cycle.user_id == current_user.id)
-    if cycle_id:
-        cycle_stmt = cycle_stmt.where(Cycle.id == cycle_id)
-    else:
-        cycle_stmt = cycle_stmt.where(Cycle.is_active == 1)
-    cycle_db = session.exec(cycle_stmt).first()
-    stmt = (
-        select(Income)
-        .where(Income.cycle_id == cycle_db.id)
-        .order_by(Income.created_at.desc())
-        .offset(commons["skip"])
-        .limit(commons["limit"])
+    stmt = paginate(
+        select(Income).where(Income.cycle_id == cycle_id),
+        Income.created_at,
+        Income.id,
+        commons,
+        cursor=cursor,
     )
-    return session.exec(stmt).all()
+    incomes = session.exec(stmt).all()
+    set_next_cursor(response, incomes, "created_at", commons["limit"])
+    return incomes
 
 
 @router.post("", response_model=Income, status_code=201)
@@ -54,16 +56,7 @@ async def create_income(
     income: IncomeCreate,
 ):
     logger.info(f"Creating income: {income}")
-    cycle_stmt = select(Cycle).where(Cycle.user_id == current_user.id)
-    if income.cycle_id:
-        cycle_stmt = cycle_stmt.where(Cycle.id == income.cycle_id)
-    else:
-        cycle_stmt = cycle_stmt.where(Cycle.is_active == 1)
-
-    cycle_db = session.exec(cycle_stmt).first()
-
-    if not cycle_db:
-        raise HTTPException(status_code=404, detail="Cycle not found")
+    cycle_id = get_cycle_id(session, current_user.id, income.cycle_id)
 
     try:
         if income.create_recurrent_income:
@@ -76,11 +69,12 @@ async def create_income(
         db_income = Income.model_validate(
             income,
             update={
-                "cycle_id": cycle_db.id,
+                "cycle_id": cycle_id,
                 "is_recurrent_income": income.create_recurrent_income,
             },
         )
         session.add(db_income)
+        apply_income(session, db_income)
         session.commit()
     except Exception as e:
         logger.error(f"Error creating income: {e}")
@@ -102,17 +96,13 @@ async def update_income(
     if not db_income or db_income.cycle.user_id != current_user.id:
         raise HTTPException(status_code=404, detail="Income not found")
     if income.cycle_id:
-        db_cycle = session.exec(
-            select(Cycle)
-            .where(Cycle.user_id == current_user.id)
-            .where(Cycle.id == income.cycle_id)
-        ).first()
-        if not db_cycle:
-            raise HTTPException(status_code=404, detail="Cycle not found")
+        get_cycle_id(session, current_user.id, income.cycle_id)
     try:
         income_data = income.model_dump(exclude_unset=True, exclude_none=True)
+        apply_income(session, db_income, -1)
         db_income.sqlmodel_update(income_data)
         session.add(db_income)
+        apply_income(session, db_income)
         session.commit()
     except Exception as e:
         logger.error(f"Error updating income: {e}")
@@ -135,5 +125,6 @@ async def delete_income(
         raise HTTPException(status_code=404, detail="Income not found")
 
     session.delete(db_income)
+    apply_income(session, db_income, -1)
     session.commit()
     return {"detail": "Income deleted"}
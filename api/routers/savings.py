@@ -1,14 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
 from api.dependencies import (
     get_current_active_user,
     get_session,
+    get_cycle_id,
     common_parameters,
+    resolve_cycle,
 )
 from api.models import (
     User,
     RecurrentSaving,
     Saving,
-    Cycle,
     SavingCreate,
     SavingUpdate,
     SavingPublic,
@@ -16,8 +17,14 @@ from api.models import (
     SavingOutcomeCreate,
     SavingMovementEnum,
     GroupedSavings,
+    Cycle,
+    SavingTypeTotals,
 )
-from sqlmodel import Session, select, text
+from sqlmodel import Session, select
+from sqlalchemy import desc, func
+from api.pagination import paginate, set_next_cursor
+from api.totals import apply_saving, signed_saving_value
+from sqlalchemy.orm import joinedload
 from typing import Annotated
 import logging
 
@@ -25,31 +32,29 @@ import logging
 logger = logging.getLogger("expenses-tracker")
 router = APIRouter(prefix="/savings", tags=["Savings"])
 CommonsDep = Annotated[dict, Depends(common_parameters)]
+CycleDep = Annotated[int, Depends(resolve_cycle)]
 
 
 @router.get("", response_model=list[SavingPublic])
 async def read_savings(
     commons: CommonsDep,
-    cycle_id: int | None = None,
+    cycle_id: CycleDep,
+    response: Response,
+    cursor: str | None = None,
     current_user: User = Depends(get_current_active_user),
     session: Session = Depends(get_session),
 ):
     logger.info(f"Reading savings for user {current_user.id}")
-    cycle_stmt = select(Cycle).where(Cycle.user_id == current_user.id)
-    if cycle_id:
-        cycle_stmt = cycle_stmt.where(Cycle.id == cycle_id)
-    else:
-        cycle_stmt = cycle_stmt.where(Cycle.is_active == 1)
-    cycle_db = session.exec(cycle_stmt).first()
     stmt = (
         select(Saving)
-        .where(Saving.cycle_id == cycle_db.id)
+        .options(joinedload(Saving.saving_type), joinedload(Saving.cycle))
+        .where(Saving.cycle_id == cycle_id)
         .where(Saving.movement_type == SavingMovementEnum.income)
-        .order_by(Saving.created_at.desc())
-        .offset(commons["skip"])
-        .limit(commons["limit"])
     )
-    return session.exec(stmt).all()
+    stmt = paginate(stmt, Saving.created_at, Saving.id, commons, cursor=cursor)
+    savings = session.exec(stmt).all()
+    set_next_cursor(response, savings, "created_at", commons["limit"])
+    return savings
 
 
 @router.get("/grouped-savings", response_model=list[GroupedSavings])
@@ -58,28 +63,37 @@ async def read_grouped_savings(
     session: Session = Depends(get_session),
 ):
     logger.info(f"Reading grouped savings for user {current_user.id}")
-    stmt = text(
-        f"""select st.id,
-                st.description,
-                max(s.is_recurrent_saving) as is_recurrent_saving,
-                sum(case s.movement_type
-                    when 'outcome' then s.val_saving * -1
-                    else s.val_saving * 1 end) as total_global,
-                sum(case
-                    when c.is_active == 1 and s.movement_type == 'income'
-                        then s.val_saving
-                    when c.is_active == 1 and s.movement_type == 'outcome'
-                        then s.val_saving * -1
-                    else 0 end) as total_last_month,
-                max(case s.movement_type
-                    when 'income' then s.date_saving
-                    else null end) as last_saving
-            from saving s
-            join savingtype st on s.saving_type_id = st.id
-            join cycle c on s.cycle_id = c.id
-            where st.user_id = {str(current_user.id)}
-            group by st.description
-            order by 6 desc"""
+    # The global balances are maintained by api.totals, so only the savings
+    # of the active cycle are aggregated here
+    current_cycle = (
+        select(
+            Saving.saving_type_id,
+            func.sum(signed_saving_value()).label("total"),
+        )
+        .join(Cycle)
+        .where(Cycle.user_id == current_user.id)
+        .where(Cycle.is_active == 1)
+        .group_by(Saving.saving_type_id)
+        .subquery()
+    )
+    stmt = (
+        select(
+            SavingType.id,
+            SavingType.description,
+            (SavingTypeTotals.recurrent_count > 0)
+            .label("is_recurrent_saving"),
+            SavingTypeTotals.total_global,
+            func.coalesce(current_cycle.c.total, 0).label("total_last_month"),
+            SavingTypeTotals.last_saving,
+        )
+        .join(SavingTypeTotals)
+        .outerjoin(
+            current_cycle,
+            current_cycle.c.saving_type_id == SavingType.id,
+        )
+        .where(SavingType.user_id == current_user.id)
+        .where(SavingTypeTotals.saving_count > 0)
+        .order_by(desc(SavingTypeTotals.last_saving))
     )
     return session.exec(stmt).all()
 
@@ -92,16 +106,7 @@ async def create_saving(
     saving: SavingCreate,
 ):
     logger.info(f"Creating saving: {saving}")
-    cycle_stmt = select(Cycle).where(Cycle.user_id == current_user.id)
-    if saving.cycle_id:
-        cycle_stmt = cycle_stmt.where(Cycle.id == saving.cycle_id)
-    else:
-        cycle_stmt = cycle_stmt.where(Cycle.is_active == 1)
-
-    cycle_db = session.exec(cycle_stmt).first()
-
-    if not cycle_db:
-        raise HTTPException(status_code=404, detail="Cycle not found")
+    cycle_id = get_cycle_id(session, current_user.id, saving.cycle_id)
 
     try:
         saving_type = session.exec(
@@ -130,11 +135,12 @@ async def create_saving(
         db_saving = Saving(
             val_saving=saving.val_saving,
             date_saving=saving.date_saving,
-            cycle=cycle_db,
+            cycle_id=cycle_id,
             is_recurrent_saving=saving.create_recurrent_saving,
             saving_type=saving_type,
         )
         session.add(db_saving)
+        apply_saving(session, db_saving)
         session.commit()
     except Exception as e:
         logger.error(f"Error creating saving: {e}")
@@ -151,16 +157,9 @@ async def create_saving_outcome(
     saving_outcome: SavingOutcomeCreate,
 ):
     logger.info(f"Creating saving outcome: {saving_outcome}")
-    cycle_stmt = select(Cycle).where(Cycle.user_id == current_user.id)
-    if saving_outcome.cycle_id:
-        cycle_stmt = cycle_stmt.where(Cycle.id == saving_outcome.cycle_id)
-    else:
-        cycle_stmt = cycle_stmt.where(Cycle.is_active == 1)
-
-    cycle_db = session.exec(cycle_stmt).first()
-
-    if not cycle_db:
-        raise HTTPException(status_code=404, detail="Cycle not found")
+    cycle_id = get_cycle_id(
+        session, current_user.id, saving_outcome.cycle_id
+    )
 
     saving_type = session.exec(
         select(SavingType).where(
@@ -174,13 +173,14 @@ async def create_saving_outcome(
         db_saving = Saving(
             val_saving=saving_outcome.val_outcome,
             date_saving=saving_outcome.date_outcome,
-            cycle=cycle_db,
+            cycle_id=cycle_id,
             is_recurrent_saving=False,
             saving_type=saving_type,
             movement_type=SavingMovementEnum.outcome,
             movement_description=saving_outcome.description,
         )
         session.add(db_saving)
+        apply_saving(session, db_saving)
         session.commit()
     except Exception as e:
         logger.error(f"Error creating saving outcome: {e}")
@@ -203,13 +203,7 @@ async def update_saving(
     if not db_saving or db_saving.cycle.user_id != current_user.id:
         raise HTTPException(status_code=404, detail="Saving not found")
     if saving.cycle_id:
-        db_cycle = session.exec(
-            select(Cycle)
-            .where(Cycle.user_id == current_user.id)
-            .where(Cycle.id == saving.cycle_id)
-        ).first()
-        if not db_cycle:
-            raise HTTPException(status_code=404, detail="Cycle not found")
+        get_cycle_id(session, current_user.id, saving.cycle_id)
     try:
         saving_data = saving.model_dump(exclude_unset=True, exclude_none=True)
         if new_description := saving_data.get("description"):
@@ -217,8 +211,10 @@ async def update_saving(
             saving_type.description = new_description
             session.add(saving_type)
         saving_data.pop("description", None)
+        apply_saving(session, db_saving, -1)
         db_saving.sqlmodel_update(saving_data)
         session.add(db_saving)
+        apply_saving(session, db_saving)
         session.commit()
     except Exception as e:
         logger.error(f"Error updating saving: {e}")
@@ -241,5 +237,6 @@ async def delete_saving(
         raise HTTPException(status_code=404, detail="Saving not found")
 
     session.delete(db_saving)
+    apply_saving(session, db_saving, -1)
     session.commit()
     return {"detail": "Saving deleted"}
@@ -1,5 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException
-from api.dependencies import get_current_active_user, get_session
+from api.dependencies import (
+    get_current_active_user, get_session, invalidate_cached_user
+)
 from sqlmodel import Session, select
 from api.models import UserCreate, User, Cycle
 from api.exceptions import IntegrityException
@@ -35,6 +37,7 @@ async def create_user(
             session.add(db_user)
             session.commit()
             session.refresh(db_user)
+            invalidate_cached_user(db_user.auth0_id)
             new_user = db_user.model_copy()
             logger.info(f"User created: {new_user}. Creating cycles")
             create_cycles(session, new_user.id)
@@ -59,3 +62,19 @@ async def create_user(
             create_cycles(session, existing_user.id)
             return current_user
     return HTTPException(status_code=400, detail="User already exists")
+
+
+@router.delete("/me")
+async def deactivate_user(
+    current_user: User = Depends(get_current_active_user),
+    session: Session = Depends(get_session),
+):
+    logger.info(f"Deactivating user {current_user.id}")
+    db_user = session.get(User, current_user.id)
+    if not db_user:
+        raise HTTPException(status_code=404, detail="User not found")
+    db_user.is_active = False
+    session.add(db_user)
+    session.commit()
+    invalidate_cached_user(db_user.auth0_id)
+    return {"detail": "User deactivated"}
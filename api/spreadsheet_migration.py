@@ -1,148 +1,200 @@
-from api.models import Expense, Cycle, Budget, Income
+from api.models import Expense, Cycle, Budget, Income, SourceEnum
+from api.totals import rebuild_totals
 from datetime import datetime, date, timedelta
 from api import utils
-from sqlmodel import Session, create_engine
-import pandas as pd
-import locale
+from sqlmodel import Session, insert
+import logging
 import numpy as np
+import pandas as pd
+import sys
+
+
+logger = logging.getLogger("expenses-tracker")
+MONTHS = [
+    "enero", "febrero", "marzo", "abril", "mayo", "junio", "julio",
+    "agosto", "septiembre", "octubre", "noviembre", "diciembre",
+]
+FIRST_ROW = 7
+SALIDAS_BUDGET = "Salidas"
+BUDGETS = [SALIDAS_BUDGET, "Mercado", "Gasolina", "General"]
+GENERAL_BUDGETS = {"gasolina": "Gasolina", "mercado": "Mercado"}
+GENERAL_BUDGET = "General"
+
+
+def parse_sheet_name(sheet_name: str) -> date | None:
+    """
+    Returns the first day of the month of a sheet named like "Enero 2024",
+    or None for the sheets that aren't months
+    """
+    try:
+        month, year = sheet_name.strip().lower().split()
+        return date(int(year), MONTHS.index(month) + 1, 1)
+    except ValueError:
+        return None
+
+
+def _extract_block(
+    sheet: pd.DataFrame,
+    description_column: int,
+    value_column: int,
+    stop_value: str | None = None,
+) -> pd.DataFrame:
+    """
+    Returns the description and value columns of the sheet from the first
+    row of the movements until the first empty description or the one with
+    the stop value, so a block without its stop row doesn't take the empty
+    rows below it
+    """
+    if sheet.shape[1] <= value_column:
+        return pd.DataFrame(columns=["description", "value"])
+    block = sheet.iloc[FIRST_ROW:, [description_column, value_column]]
+    block.columns = ["description", "value"]
+    descriptions = block["description"]
+    end = descriptions.isna()
+    if stop_value:
+        end |= descriptions.eq(stop_value)
+    end = end.to_numpy()
+    if end.any():
+        block = block.iloc[:end.argmax()]
+    return block.reset_index(drop=True)
+
+
+def classify_general_expenses(descriptions: pd.Series) -> np.ndarray:
+    lowered = descriptions.astype(str).str.lower()
+    return np.select(
+        [
+            lowered.str.contains(keyword, regex=False)
+            for keyword in GENERAL_BUDGETS
+        ],
+        list(GENERAL_BUDGETS.values()),
+        default=GENERAL_BUDGET,
+    )
+
+
+def extract_sheet(sheet: pd.DataFrame) -> dict:
+    """
+    Extracts the income, the recurrent expenses and the expenses (with the
+    name of their budget) of a month sheet
+    """
+    recurrent = _extract_block(sheet, 1, 2, stop_value="Total")
+    salidas = _extract_block(sheet, 4, 5)
+    general = _extract_block(sheet, 7, 8)
+    expenses = pd.concat([
+        recurrent.assign(is_recurrent_expense=True, budget=None),
+        salidas.assign(is_recurrent_expense=False, budget=SALIDAS_BUDGET),
+        general.assign(
+            is_recurrent_expense=False,
+            budget=classify_general_expenses(general["description"]),
+        ),
+    ], ignore_index=True)
+    return {"income": float(sheet.iloc[0, 2]), "expenses": expenses}
+
+
+def import_sheet(
+    session: Session, user_id: int, month: date, sheet: pd.DataFrame
+) -> int:
+    """
+    Creates the cycle of the month with its budgets, income and expenses,
+    with one bulk insert per table. Returns the id of the new cycle
+    """
+    extracted = extract_sheet(sheet)
+    now = datetime.now()
+    date_cycle = datetime(month.year, month.month, 1) + timedelta(hours=5)
+    cycle = Cycle(
+        description=f"{MONTHS[month.month - 1][:3].capitalize()} {month.year}",
+        start_date=utils.get_first_day_month(month),
+        end_date=utils.get_last_day_month(month),
+        is_active=False,
+        is_recurrent_incomes_created=True,
+        is_recurrent_expenses_created=True,
+        is_recurrent_savings_created=True,
+        is_recurrent_budgets_created=True,
+        user_id=user_id,
+    )
+    session.add(cycle)
+    session.flush()
+    budget_ids = dict(session.exec(
+        insert(Budget).returning(Budget.description, Budget.id),
+        params=[
+            {
+                "description": description,
+                "val_budget": 0,
+                "cycle_id": cycle.id,
+                "created_at": now,
+                "updated_at": now,
+            }
+            for description in BUDGETS
+        ],
+    ).all())
+    session.add(Income(
+        description="Salario",
+        val_income=extracted["income"],
+        date_income=date_cycle,
+        cycle_id=cycle.id,
+    ))
+    expenses = extracted["expenses"]
+    if not expenses.empty:
+        budget_id = expenses["budget"].map(budget_ids)
+        expenses = pd.DataFrame({
+            "description": expenses["description"].astype(str),
+            "val_expense": expenses["value"].astype(float),
+            "date_expense": np.where(
+                expenses["is_recurrent_expense"],
+                date_cycle,
+                date_cycle + timedelta(hours=1),
+            ),
+            "source": SourceEnum.app,
+            "categories": "",
+            "is_recurrent_expense": expenses["is_recurrent_expense"],
+            "budget_id": budget_id.astype("Int64").astype(object).where(
+                budget_id.notna(), None
+            ),
+            "cycle_id": cycle.id,
+            "created_at": now,
+            "updated_at": now,
+        })
+        session.exec(
+            insert(Expense),
+            params=expenses.to_dict("records"),
+            execution_options={"render_nulls": True},
+        )
+    return cycle.id
+
+
+def import_workbook(session: Session, path: str, user_id: int) -> dict:
+    """
+    Imports every month sheet of the workbook as a closed cycle of the
+    user. The workbook is read once, each sheet is committed on its own and
+    the totals of the new cycles are computed at the end
+    """
+    started_at = datetime.now()
+    sheets = pd.read_excel(path, sheet_name=None)
+    cycle_ids = []
+    for sheet_name, sheet in sheets.items():
+        month = parse_sheet_name(sheet_name)
+        if not month:
+            logger.info(f"Skipping sheet {sheet_name}")
+            continue
+        logger.info(f"Importing sheet {sheet_name}")
+        try:
+            cycle_ids.append(import_sheet(session, user_id, month, sheet))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+    if cycle_ids:
+        rebuild_totals(session, cycle_ids)
+    report = {
+        "cycles": len(cycle_ids),
+        "duration": (datetime.now() - started_at).total_seconds(),
+    }
+    logger.info(f"Workbook imported: {report}")
+    return report
 
 
-locale.setlocale(locale.LC_ALL, 'es_ES.UTF-8')
-sqlite_url = "sqlite:////home/jairo/Documents/database.db"
-connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, echo=True, connect_args=connect_args)
-
-with Session(engine) as session:
-    for year in range(2022, 2025):
-        for month in range(1, 13):
-            try:
-                print("Processing", year, month)
-                date_cycle = datetime.strptime(f'{1}/{month}/{year}', '%d/%m/%Y')
-                date_cycle = date_cycle + timedelta(hours=5)
-                cycle = Cycle(
-                    description=date_cycle.strftime('%b %Y').capitalize(),
-                    start_date=utils.get_first_day_month(date(year, month, 1)),
-                    end_date=utils.get_last_day_month(date(year, month, 1)),
-                    is_active=False,
-                    is_recurrent_incomes_created=True,
-                    is_recurrent_expenses_created=True,
-                    is_recurrent_savings_created=True,
-                    is_recurrent_budgets_created=True,
-                    user_id=8
-                )
-                session.add(cycle)
-                budget_salidas = Budget(
-                    description="Salidas",
-                    val_budget=0,
-                    cycle=cycle,
-                )
-                session.add(budget_salidas)
-                budget_mercado = Budget(
-                    description="Mercado",
-                    val_budget=0,
-                    cycle=cycle,
-                )
-                session.add(budget_mercado)
-                budget_gasolina = Budget(
-                    description="Gasolina",
-                    val_budget=0,
-                    cycle=cycle,
-                )
-                session.add(budget_gasolina)
-                budget_general = Budget(
-                    description="General",
-                    val_budget=0,
-                    cycle=cycle,
-                )
-                session.add(budget_general)
-                # Extract incomes
-                expenses = pd.read_excel(
-                    '~/Downloads/Presupuestos.xlsx',
-                    sheet_name=f'{date_cycle.strftime('%B').capitalize()} {year}'
-                )
-                income = Income(
-                    description="Salario",
-                    val_income=expenses.iloc[0, 2],
-                    date_income=date_cycle,
-                    cycle=cycle,
-                )
-                session.add(income)
-                re_row = 7
-                # Extract recurrent expenses
-                while True:
-                    description = expenses.iloc[re_row, 1]
-                    value = expenses.iloc[re_row, 2]
-                    if description == "Total":
-                        break
-                    re_row += 1
-                    expense = Expense(
-                        description=description,
-                        val_expense=value,
-                        date_expense=date_cycle,
-                        cycle=cycle,
-                        is_recurrent_expense=True,
-                        budget_id=None
-                    )
-                    session.add(expense)
-                if year == 2024 and month >= 3:
-                    karen_expense = Expense(
-                        description="Mesada Karen",
-                        val_expense=1300000,
-                        date_expense=date_cycle,
-                        cycle=cycle,
-                        is_recurrent_expense=True,
-                        budget_id=None
-                    )
-                    session.add(karen_expense)
-                # Extract expenses
-                sa_expenses_row = 7
-                while True:
-                    description = expenses.iloc[sa_expenses_row, 4]
-                    value = expenses.iloc[sa_expenses_row, 5]
-                    if description is np.nan:
-                        break
-                    sa_expenses_row += 1
-                    expense = Expense(
-                        description=description,
-                        val_expense=value,
-                        date_expense=date_cycle + timedelta(hours=1),
-                        cycle=cycle,
-                        is_recurrent_expense=False,
-                        budget=budget_salidas
-                    )
-                    session.add(expense)
-                # Extract general expenses
-                general_expenses_row = 7
-                print("Processing general expenses")
-                while True:
-                    print("Processing row", general_expenses_row)
-                    try:
-                        description = expenses.iloc[general_expenses_row, 7]
-                        value = expenses.iloc[general_expenses_row, 8]
-                    except IndexError:
-                        break
-                    if description is np.nan:
-                        break
-                    general_expenses_row += 1
-                    selected_budget = None
-                    if "gasolina" in description.lower():
-                        selected_budget = budget_gasolina
-                    elif "mercado" in description.lower():
-                        selected_budget = budget_mercado
-                    else:
-                        selected_budget = budget_general
-                    expense = Expense(
-                        description=description,
-                        val_expense=value,
-                        date_expense=date_cycle + timedelta(hours=1),
-                        cycle=cycle,
-                        is_recurrent_expense=False,
-                        budget=selected_budget
-                    )
-                    session.add(expense)
-                session.commit()
-            except ValueError as ex:
-                print(ex)
-                if "not found" in str(ex):
-                    continue
-                raise ex
+if __name__ == "__main__":
+    from api.database import get_engine
+    if len(sys.argv) != 3:
+        sys.exit("Usage: python -m api.spreadsheet_migration FILE USER_ID")
+    with Session(get_engine()) as session:
+        import_workbook(session, sys.argv[1], int(sys.argv[2]))
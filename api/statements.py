@@ -0,0 +1,369 @@
+from api.models import (
+    Cycle,
+    Expense,
+    Income,
+    User,
+    SourceEnum,
+    StatementFormatEnum,
+    StatementImport,
+    ImportStatusEnum,
+)
+from api.tasks import create_cycles
+from api.totals import apply_expenses, apply_incomes
+from api import utils
+from sqlmodel import Session, select, insert, col, func
+from bisect import bisect_right, insort
+from collections import Counter
+from datetime import date, datetime
+from itertools import batched
+from typing import Iterable, Iterator, NamedTuple, TextIO
+import csv
+import logging
+import re
+
+
+logger = logging.getLogger("expenses-tracker")
+OFX_TAG = re.compile(r"<(/?)(\w+)>([^<\r\n]*)")
+
+
+class StatementRow(NamedTuple):
+    date: datetime
+    description: str
+    amount: float
+    # Id of the transaction given by the bank (FITID of OFX statements)
+    transaction_id: str | None = None
+
+
+class InvalidStatementRow(NamedTuple):
+    error: str
+
+
+def parse_csv_statement(
+    file: TextIO,
+) -> Iterator[StatementRow | InvalidStatementRow]:
+    """
+    Reads a CSV statement with date, description and amount columns one
+    row at a time. Negative amounts are expenses and positive amounts are
+    incomes
+    """
+    reader = csv.DictReader(file)
+    reader.fieldnames = [
+        field.strip().lower() for field in reader.fieldnames or []
+    ]
+    for row in reader:
+        try:
+            yield StatementRow(
+                date=datetime.fromisoformat(row["date"].strip()),
+                description=row["description"].strip(),
+                amount=float(row["amount"]),
+            )
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            yield InvalidStatementRow(error=f"Invalid row {row}: {e}")
+
+
+def _parse_ofx_date(value: str) -> datetime:
+    # YYYYMMDD, optionally followed by HHMMSS, milliseconds and timezone
+    if len(value) >= 14 and value[8:14].isdigit():
+        return datetime.strptime(value[:14], "%Y%m%d%H%M%S")
+    return datetime.strptime(value[:8], "%Y%m%d")
+
+
+def parse_ofx_statement(
+    file: TextIO,
+) -> Iterator[StatementRow | InvalidStatementRow]:
+    """
+    Reads the transactions (STMTTRN) of an OFX statement line by line. Both
+    the SGML (OFX 1.x, without closing tags) and the XML versions are
+    supported
+    """
+    transaction = None
+    for line in file:
+        for closing, tag, value in OFX_TAG.findall(line):
+            tag = tag.upper()
+            if tag == "STMTTRN":
+                if not closing:
+                    transaction = {}
+                    continue
+                if transaction is None:
+                    continue
+                try:
+                    yield StatementRow(
+                        date=_parse_ofx_date(transaction["DTPOSTED"]),
+                        description=(
+                            transaction.get("NAME")
+                            or transaction.get("MEMO", "")
+                        ),
+                        amount=float(transaction["TRNAMT"].replace(",", ".")),
+                        transaction_id=transaction.get("FITID"),
+                    )
+                except (KeyError, ValueError) as e:
+                    yield InvalidStatementRow(
+                        error=f"Invalid transaction {transaction}: {e}"
+                    )
+                transaction = None
+            elif transaction is not None and not closing and value.strip():
+                transaction[tag] = value.strip()
+
+
+STATEMENT_PARSERS = {
+    StatementFormatEnum.csv: parse_csv_statement,
+    StatementFormatEnum.ofx: parse_ofx_statement,
+}
+
+
+class CycleResolver:
+    """
+    Finds the cycle of the user that contains a date, creating it when the
+    user doesn't have it. Only the cycles that already ended are created
+    closed and without recurrent objects. The current cycle is created by
+    the rollover instead, so it's active and gets its recurrent objects
+    """
+
+    def __init__(self, session: Session, user: User):
+        self.session = session
+        self.user = user
+        self._load_cycles()
+
+    def _load_cycles(self):
+        self.cycles = sorted(
+            tuple(cycle) for cycle in self.session.exec(
+                select(Cycle.start_date, Cycle.end_date, Cycle.id)
+                .where(Cycle.user_id == self.user.id)
+            )
+        )
+
+    def _find_cycle_id(self, day) -> int | None:
+        # Last cycle starting on or before the day
+        index = bisect_right(self.cycles, (day, date.max)) - 1
+        if index >= 0 and self.cycles[index][1] >= day:
+            return self.cycles[index][2]
+        return None
+
+    def get_cycle_id(self, date_: datetime) -> int | None:
+        """
+        Returns the id of the cycle of the date, or None when it's after the
+        current cycle
+        """
+        day = date_.date()
+        cycle_id = self._find_cycle_id(day)
+        if cycle_id:
+            return cycle_id
+        start_date, end_date = utils.get_cycle_dates(
+            day, self.user.start_cycle_day, self.user.end_cycle_day
+        )
+        # The dates between two cycles go to the next one, which may exist
+        cycle_id = self._find_cycle_id(start_date)
+        if cycle_id:
+            return cycle_id
+        if end_date >= date.today():
+            create_cycles(self.session, self.user.id)
+            self._load_cycles()
+            return self._find_cycle_id(day)
+        cycle = Cycle(
+            description=start_date.strftime('%B, %Y'),
+            start_date=start_date,
+            end_date=end_date,
+            is_active=False,
+            is_recurrent_incomes_created=True,
+            is_recurrent_expenses_created=True,
+            is_recurrent_savings_created=True,
+            is_recurrent_budgets_created=True,
+            user_id=self.user.id,
+        )
+        self.session.add(cycle)
+        self.session.flush()
+        insort(self.cycles, (start_date, end_date, cycle.id))
+        return cycle.id
+
+
+def _existing_movements(
+    session: Session, model, cycle_ids: set[int], date_column, value_column,
+    rows: list[StatementRow],
+) -> Counter:
+    """
+    Number of movements already stored by key (date, value, description) in
+    the cycles and dates of the rows
+    """
+    dates = [row.date for row in rows]
+    return Counter({
+        (date_, value, description): count
+        for date_, value, description, count in session.exec(
+            select(date_column, value_column, model.description, func.count())
+            .where(col(model.cycle_id).in_(cycle_ids))
+            .where(col(date_column).between(min(dates), max(dates)))
+            .group_by(date_column, value_column, model.description)
+        )
+    })
+
+
+class StatementDeduplicator:
+    """
+    Tells which rows of a statement are already stored. Equal rows are
+    compared by count, so two equal transactions of the same day are both
+    imported, while importing the statement again imports nothing. Rows
+    with the same transaction id are the same transaction
+    """
+
+    def __init__(self):
+        self.occurrences: Counter = Counter()
+        self.created: Counter = Counter()
+        self.transaction_ids: set = set()
+
+    def is_duplicate(self, model, row: StatementRow, existing: Counter):
+        if row.transaction_id:
+            if (model, row.transaction_id) in self.transaction_ids:
+                return True
+            self.transaction_ids.add((model, row.transaction_id))
+        key = (row.date, abs(row.amount), row.description)
+        self.occurrences[model, key] += 1
+        # The movements created by this import are already stored too
+        stored_before = existing[key] - self.created[model, key]
+        if self.occurrences[model, key] <= stored_before:
+            return True
+        self.created[model, key] += 1
+        return False
+
+
+def import_statement_rows(
+    session: Session,
+    statement_import: StatementImport,
+    rows: Iterable[StatementRow | InvalidStatementRow],
+    batch_size: int = 500,
+):
+    """
+    Imports the rows of a statement in batches of batch_size rows. Each
+    batch is assigned to the cycles of its dates, de-duplicated against the
+    movements already stored, inserted and committed together with the
+    progress of the import
+    """
+    user = session.get(User, statement_import.user_id)
+    cycles = CycleResolver(session, user)
+    deduplicator = StatementDeduplicator()
+    for batch in batched(rows, batch_size):
+        valid_rows = []
+        cycle_ids = {}
+        for row in batch:
+            if isinstance(row, InvalidStatementRow):
+                logger.warning(row.error)
+                statement_import.failed += 1
+                continue
+            if not row.amount:
+                statement_import.failed += 1
+                continue
+            cycle_ids[row] = cycles.get_cycle_id(row.date)
+            if not cycle_ids[row]:
+                logger.warning(f"No cycle for the statement row {row}")
+                statement_import.failed += 1
+                continue
+            valid_rows.append(row)
+        statement_import.rows_read += len(batch)
+        if valid_rows:
+            expenses = _new_movements(
+                session, statement_import, deduplicator, Expense,
+                Expense.date_expense, Expense.val_expense, cycle_ids,
+                [row for row in valid_rows if row.amount < 0],
+            )
+            incomes = _new_movements(
+                session, statement_import, deduplicator, Income,
+                Income.date_income, Income.val_income, cycle_ids,
+                [row for row in valid_rows if row.amount > 0],
+            )
+            if expenses:
+                session.exec(
+                    insert(Expense),
+                    params=[
+                        expense.model_dump(exclude={"id"})
+                        for expense in expenses
+                    ],
+                    execution_options={"render_nulls": True},
+                )
+                apply_expenses(session, expenses)
+            if incomes:
+                session.exec(
+                    insert(Income),
+                    params=[
+                        income.model_dump(exclude={"id"})
+                        for income in incomes
+                    ],
+                )
+                apply_incomes(session, incomes)
+            statement_import.expenses_created += len(expenses)
+            statement_import.incomes_created += len(incomes)
+        statement_import.updated_at = datetime.now()
+        session.add(statement_import)
+        session.commit()
+        logger.info(
+            f"Statement import {statement_import.id}: "
+            f"{statement_import.rows_read} rows read"
+        )
+
+
+def _new_movements(
+    session: Session,
+    statement_import: StatementImport,
+    deduplicator: StatementDeduplicator,
+    model,
+    date_column,
+    value_column,
+    cycle_ids: dict,
+    rows: list[StatementRow],
+) -> list:
+    if not rows:
+        return []
+    existing = _existing_movements(
+        session, model, {cycle_ids[row] for row in rows}, date_column,
+        value_column, rows,
+    )
+    movements = []
+    for row in rows:
+        if deduplicator.is_duplicate(model, row, existing):
+            statement_import.duplicates += 1
+            continue
+        if model is Expense:
+            movements.append(Expense(
+                description=row.description,
+                val_expense=abs(row.amount),
+                date_expense=row.date,
+                source=SourceEnum.statement,
+                cycle_id=cycle_ids[row],
+            ))
+        else:
+            movements.append(Income(
+                description=row.description,
+                val_income=row.amount,
+                date_income=row.date,
+                cycle_id=cycle_ids[row],
+            ))
+    return movements
+
+
+def run_statement_import(
+    bind, import_id: int, path: str, batch_size: int = 500
+):
+    """
+    Background task that imports a statement file saved on disk, keeping
+    the progress in its StatementImport row. It uses its own session, as the
+    one of the request is closed when the task runs
+    """
+    with Session(bind) as session:
+        statement_import = session.get(StatementImport, import_id)
+        statement_import.status = ImportStatusEnum.running
+        session.add(statement_import)
+        session.commit()
+        parser = STATEMENT_PARSERS[statement_import.statement_format]
+        try:
+            with open(
+                path, newline="", encoding="utf-8-sig", errors="replace"
+            ) as file:
+                import_statement_rows(
+                    session, statement_import, parser(file), batch_size
+                )
+            statement_import.status = ImportStatusEnum.done
+        except Exception as e:
+            logger.error(f"Error importing statement {import_id}: {e}")
+            session.rollback()
+            statement_import.status = ImportStatusEnum.failed
+            statement_import.detail = str(e)
+        statement_import.updated_at = datetime.now()
+        session.add(statement_import)
+        session.commit()
@@ -1,199 +1,444 @@
-from api import config
+from api.database import get_engine, dispose_engines
+from api.dependencies import invalidate_active_cycle
 from api.models import (
     Cycle, User, RecurrentIncome, Income, RecurrentExpense, Expense,
-    SourceEnum, RecurrentSaving, Saving, Budget, RecurrentBudget
+    SourceEnum, RecurrentSaving, Saving, Budget, RecurrentBudget,
+    SavingMovementEnum
 )
-from sqlmodel import Session, create_engine, select, update
+from sqlmodel import Session, select, update, insert, col
+from sqlalchemy import exists, func, literal, true
+from sqlalchemy.orm import aliased
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date, datetime
 from logging.config import dictConfig
 from api.log_config import LogConfig
 from api import utils
+from api.totals import (
+    update_budget_totals_from_select,
+    update_cycle_totals_from_select,
+    update_saving_type_totals_from_select,
+)
 import logging
+import sys
+import time
 
 
 dictConfig(LogConfig().model_dump())
 logger = logging.getLogger("expenses-tracker")
-db_session = None
+UserRange = tuple[int, int]
 
 
 def get_session() -> Session:
-    global db_session
-    if db_session:
-        return db_session
-    sqlite_url = f"sqlite:///{config.Settings().sqlite_database_url}"
-    connect_args = {"check_same_thread": False}
-    engine = create_engine(sqlite_url, echo=True, connect_args=connect_args)
-    with Session(engine) as session:
-        db_session = session
-        return db_session
+    return Session(get_engine())
+
+
+def get_user_ranges(session: Session, shard_count: int) -> list[UserRange]:
+    """
+    Splits the ids of the users in shard_count contiguous and inclusive
+    ranges of (almost) the same length
+    """
+    min_id, max_id = session.exec(
+        select(func.min(User.id), func.max(User.id))
+    ).one()
+    if min_id is None:
+        return []
+    shard_size = -(-(max_id - min_id + 1) // shard_count)
+    return [
+        (start, min(start + shard_size - 1, max_id))
+        for start in range(min_id, max_id + 1, shard_size)
+    ]
+
+
+def _in_user_range(user_id_column, user_range: UserRange | None) -> list:
+    if not user_range:
+        return []
+    return [col(user_id_column).between(*user_range)]
 
 
-def create_cycles(session: Session, user_id: int = 0):
+def create_cycles(
+    session: Session, user_id: int = 0, user_range: UserRange | None = None
+) -> dict:
     """
-    Function that iterates over all (or one) active users and start creating
-    new cycles (if necessary) and disable old cycles
+    Function that creates a new cycle for all (or one) active users without
+    a current cycle and disables their old cycles. It works over all the
+    users at once with a fixed number of statements and it can be run again
+    safely, as the users that already have a current cycle are skipped
     """
-    statement = select(User).where(User.is_active == 1)
+    started_at = time.perf_counter()
+    today = date.today()
+    current_cycle = aliased(Cycle)
+    conditions = [
+        User.is_active == 1,
+        ~exists().where(current_cycle.user_id == User.id).where(
+            current_cycle.end_date >= today
+        ),
+    ]
     if user_id:
-        statement = statement.where(User.id == user_id)
-    for user in session.exec(statement).all():
-        current_cycle = session.exec(
-            select(Cycle)
-            .where(Cycle.user_id == user.id)
-            .where(Cycle.end_date >= datetime.now().strftime('%Y-%m-%d'))
-        ).first()
-        if current_cycle:
-            continue
-        cycle = Cycle(
-            description=datetime.now().strftime('%B, %Y'),
-            start_date=utils.get_first_day_month(date.today()),
-            end_date=utils.get_last_day_month(date.today()),
-            user_id=user.id or 0
+        conditions.append(User.id == user_id)
+    conditions.extend(_in_user_range(User.id, user_range))
+    users = session.exec(
+        select(User.id, User.start_cycle_day, User.end_cycle_day)
+        .where(*conditions)
+    ).all()
+    new_cycles = []
+    for user_id_, start_cycle_day, end_cycle_day in users:
+        start_date, end_date = utils.get_cycle_dates(
+            today, start_cycle_day, end_cycle_day
         )
-        session.exec(
-            update(Cycle)
-            .where(Cycle.user_id == user.id)
-            .where(Cycle.is_active == 1)
-            .values(is_active=0)
-        )
-        session.add(cycle)
+        new_cycles.append({
+            "description": start_date.strftime('%B, %Y'),
+            "start_date": start_date,
+            "end_date": end_date,
+            "is_active": True,
+            "user_id": user_id_,
+        })
+    deactivated = 0
+    try:
+        if new_cycles:
+            deactivated = session.exec(
+                update(Cycle)
+                .where(Cycle.is_active == 1)
+                .where(
+                    col(Cycle.user_id).in_(select(User.id).where(*conditions))
+                )
+                .values(is_active=0)
+            ).rowcount
+            session.exec(insert(Cycle), params=new_cycles)
         session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    for new_cycle in new_cycles:
+        invalidate_active_cycle(new_cycle["user_id"])
+    report = {
+        "created": len(new_cycles),
+        "deactivated": deactivated,
+        "duration": round(time.perf_counter() - started_at, 3),
+    }
+    logger.info(f"Cycles rollover: {report}")
+    return report
+
+
+def _pending_cycles(created_flag, user_range: UserRange | None = None):
+    """
+    Conditions of the active cycles whose recurrent objects (identified by
+    the given flag) haven't been created yet
+    """
+    return (
+        Cycle.is_active == 1,
+        created_flag == 0,
+        *_in_user_range(Cycle.user_id, user_range),
+    )
+
+
+def _create_from_select(
+    session: Session,
+    model,
+    columns: dict,
+    source_stmt,
+    created_flag,
+    user_range: UserRange | None = None,
+    totals: dict | None = None,
+    budget_totals: tuple | None = None,
+    saving_type_totals: tuple | None = None,
+) -> int:
+    """
+    Inserts the rows returned by the source statement (one per recurrent
+    object and pending cycle) with a single INSERT ... SELECT and flags the
+    pending cycles as processed with a single UPDATE, so the number of
+    statements doesn't depend on the number of cycles or users. The given
+    totals (cycle totals field -> value column) are added to the cycles, and
+    the budget totals (budget id column, value column) to their budgets and
+    the saving type totals (saving type id column, value column, date
+    column) to their saving types
+    """
+    source_stmt = source_stmt.where(
+        *_pending_cycles(created_flag, user_range)
+    )
+    result = session.exec(
+        insert(model).from_select(
+            list(columns),
+            source_stmt.with_only_columns(*columns.values()),
+        )
+    )
+    if totals:
+        update_cycle_totals_from_select(
+            session,
+            list(totals),
+            source_stmt.with_only_columns(
+                Cycle.id, *[func.sum(value) for value in totals.values()]
+            ).group_by(Cycle.id),
+        )
+    if budget_totals:
+        budget_id, value = budget_totals
+        update_budget_totals_from_select(
+            session,
+            source_stmt.with_only_columns(
+                Cycle.id, budget_id, func.sum(value), func.count()
+            ).group_by(Cycle.id, budget_id),
+        )
+    if saving_type_totals:
+        saving_type_id, value, date_ = saving_type_totals
+        update_saving_type_totals_from_select(
+            session,
+            source_stmt.with_only_columns(
+                saving_type_id,
+                func.sum(value),
+                func.count(),
+                func.count(),
+                func.max(date_),
+            ).group_by(saving_type_id),
+        )
+    session.exec(
+        update(Cycle)
+        .where(*_pending_cycles(created_flag, user_range))
+        .values({created_flag: True})
+    )
+    return result.rowcount
+
+
+def _now_column(model, field: str):
+    return literal(datetime.now(), model.__table__.c[field].type)
 
 
-def create_recurrent_incomes(session: Session):
+def create_recurrent_incomes(
+    session: Session,
+    commit: bool = True,
+    user_range: UserRange | None = None,
+) -> int:
     """
     Function intended to create all of the recurrent incomes configured
     in the recurrentIncome table
     """
-    statement = (
-        select(Cycle)
-        .where(Cycle.is_active == 1)
-        .where(Cycle.is_recurrent_incomes_created == 0)
+    created = _create_from_select(
+        session,
+        Income,
+        {
+            "description": RecurrentIncome.description,
+            "val_income": RecurrentIncome.val_income,
+            "date_income": _now_column(Income, "date_income"),
+            "is_recurrent_income": true(),
+            "cycle_id": Cycle.id,
+            "created_at": _now_column(Income, "created_at"),
+            "updated_at": _now_column(Income, "updated_at"),
+        },
+        select(Cycle.id)
+        .join(RecurrentIncome, RecurrentIncome.user_id == Cycle.user_id)
+        .where(RecurrentIncome.enabled == 1),
+        Cycle.is_recurrent_incomes_created,
+        user_range,
+        totals={"total_incomes": RecurrentIncome.val_income},
     )
-    for cycle in session.exec(statement).all():
-        recurrent_incomes_stmt = (
-            select(RecurrentIncome)
-            .where(RecurrentIncome.enabled == 1)
-            .where(RecurrentIncome.user_id == cycle.user_id)
-        )
-        for re_income in session.exec(recurrent_incomes_stmt):
-            income = Income(
-                description=re_income.description,
-                val_income=re_income.val_income,
-                date_income=datetime.now(),
-                is_recurrent_income=True,
-                cycle_id=cycle.id or 0
-            )
-            session.add(income)
-        cycle.is_recurrent_incomes_created = True
-        session.add(cycle)
+    if commit:
         session.commit()
+    return created
 
 
-def create_recurrent_expenses(session: Session):
+def create_recurrent_expenses(
+    session: Session,
+    commit: bool = True,
+    user_range: UserRange | None = None,
+) -> int:
     """
     Function intended to create all of the recurrent expenses configured
     in the recurrentExpense table
     """
-    statement = (
-        select(Cycle)
-        .where(Cycle.is_active == 1)
-        .where(Cycle.is_recurrent_expenses_created == 0)
+    created = _create_from_select(
+        session,
+        Expense,
+        {
+            "description": RecurrentExpense.description,
+            "val_expense": RecurrentExpense.val_expense,
+            "date_expense": _now_column(Expense, "date_expense"),
+            "is_recurrent_expense": true(),
+            "source": literal(
+                SourceEnum.recurrent, Expense.__table__.c.source.type
+            ),
+            "categories": RecurrentExpense.categories,
+            "cycle_id": Cycle.id,
+            "created_at": _now_column(Expense, "created_at"),
+            "updated_at": _now_column(Expense, "updated_at"),
+        },
+        select(Cycle.id)
+        .join(RecurrentExpense, RecurrentExpense.user_id == Cycle.user_id)
+        .where(RecurrentExpense.enabled == 1),
+        Cycle.is_recurrent_expenses_created,
+        user_range,
+        totals={"total_recurrent_expenses": RecurrentExpense.val_expense},
+        # The recurrent expenses are created without budget
+        budget_totals=(literal(0), RecurrentExpense.val_expense),
     )
-    for cycle in session.exec(statement).all():
-        recurrent_expenses_stmt = (
-            select(RecurrentExpense)
-            .where(RecurrentExpense.enabled == 1)
-            .where(RecurrentExpense.user_id == cycle.user_id)
-        )
-        for re_expense in session.exec(recurrent_expenses_stmt):
-            expense = Expense(
-                description=re_expense.description,
-                val_expense=re_expense.val_expense,
-                date_expense=datetime.now(),
-                is_recurrent_expense=True,
-                source=SourceEnum.recurrent,
-                categories=re_expense.categories,
-                cycle_id=cycle.id or 0
-            )
-            session.add(expense)
-        cycle.is_recurrent_expenses_created = True
-        session.add(cycle)
+    if commit:
         session.commit()
+    return created
 
 
-def create_recurrent_savings(session: Session):
+def create_recurrent_savings(
+    session: Session,
+    commit: bool = True,
+    user_range: UserRange | None = None,
+) -> int:
     """
     Function intended to create all of the recurrent savings configured
     in the recurrentSaving table
     """
-    statement = (
-        select(Cycle)
-        .where(Cycle.is_active == 1)
-        .where(Cycle.is_recurrent_savings_created == 0)
+    date_saving = _now_column(Saving, "date_saving")
+    created = _create_from_select(
+        session,
+        Saving,
+        {
+            "val_saving": RecurrentSaving.val_saving,
+            "date_saving": date_saving,
+            "movement_type": literal(
+                SavingMovementEnum.income,
+                Saving.__table__.c.movement_type.type,
+            ),
+            "movement_description": literal(""),
+            "is_recurrent_saving": true(),
+            "cycle_id": Cycle.id,
+            "saving_type_id": RecurrentSaving.saving_type_id,
+            "created_at": _now_column(Saving, "created_at"),
+            "updated_at": _now_column(Saving, "updated_at"),
+        },
+        select(Cycle.id)
+        .join(RecurrentSaving, RecurrentSaving.user_id == Cycle.user_id)
+        .where(RecurrentSaving.enabled == 1),
+        Cycle.is_recurrent_savings_created,
+        user_range,
+        totals={"total_savings": RecurrentSaving.val_saving},
+        saving_type_totals=(
+            RecurrentSaving.saving_type_id,
+            RecurrentSaving.val_saving,
+            date_saving,
+        ),
     )
-    for cycle in session.exec(statement).all():
-        recurrent_savings_stmt = (
-            select(RecurrentSaving)
-            .where(RecurrentSaving.enabled == 1)
-            .where(RecurrentSaving.user_id == cycle.user_id)
-        )
-        for re_saving in session.exec(recurrent_savings_stmt):
-            saving = Saving(
-                val_saving=re_saving.val_saving,
-                date_saving=datetime.now(),
-                is_recurrent_saving=True,
-                cycle_id=cycle.id or 0,
-                saving_type_id=re_saving.saving_type_id
-            )
-            session.add(saving)
-        cycle.is_recurrent_savings_created = True
-        session.add(cycle)
+    if commit:
         session.commit()
+    return created
 
 
-def create_recurrent_budgets(session: Session):
+def create_recurrent_budgets(
+    session: Session,
+    commit: bool = True,
+    user_range: UserRange | None = None,
+) -> int:
     """
     Function intended to create all of the recurrent budgets configured
     in the recurrentBudget table
     """
-    statement = (
-        select(Cycle)
-        .where(Cycle.is_active == 1)
-        .where(Cycle.is_recurrent_budgets_created == 0)
+    created = _create_from_select(
+        session,
+        Budget,
+        {
+            "description": RecurrentBudget.description,
+            "val_budget": RecurrentBudget.val_budget,
+            "cycle_id": Cycle.id,
+            "created_at": _now_column(Budget, "created_at"),
+            "updated_at": _now_column(Budget, "updated_at"),
+        },
+        select(Cycle.id)
+        .join(RecurrentBudget, RecurrentBudget.user_id == Cycle.user_id)
+        .where(RecurrentBudget.is_enabled == 1),
+        Cycle.is_recurrent_budgets_created,
+        user_range,
     )
-    for cycle in session.exec(statement).all():
-        recurrent_budgets_stmt = (
-            select(RecurrentBudget)
-            .where(RecurrentBudget.is_enabled == 1)
-            .where(RecurrentBudget.user_id == cycle.user_id)
-        )
-        for re_budget in session.exec(recurrent_budgets_stmt):
-            budget = Budget(
-                description=re_budget.description,
-                val_budget=re_budget.val_budget,
-                cycle_id=cycle.id or 0
-            )
-            session.add(budget)
-        cycle.is_recurrent_budgets_created = True
-        session.add(cycle)
+    if commit:
+        session.commit()
+    return created
+
+
+def create_recurrent_objects(
+    session: Session, user_range: UserRange | None = None
+):
+    """
+    Creates the recurrent incomes, expenses, savings and budgets of every
+    pending cycle (of the users in the range, if given) in a single
+    transaction
+    """
+    try:
+        totals = {
+            "incomes": create_recurrent_incomes(
+                session, commit=False, user_range=user_range
+            ),
+            "expenses": create_recurrent_expenses(
+                session, commit=False, user_range=user_range
+            ),
+            "savings": create_recurrent_savings(
+                session, commit=False, user_range=user_range
+            ),
+            "budgets": create_recurrent_budgets(
+                session, commit=False, user_range=user_range
+            ),
+        }
         session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    logger.info(f"Recurrent objects created: {totals}")
+    return totals
+
+
+def run_shard(user_range: UserRange | None = None) -> dict:
+    """
+    Creates the cycles and recurrent objects of the users in the given
+    range (of every user without it), using its own session. The ranges
+    are computed once by the caller and not by each shard, so the users
+    that sign up while the shards run can't move the ranges between them
+    """
+    with get_session() as session:
+        if user_range:
+            logger.info(
+                f"Running shard of users {user_range[0]}-{user_range[1]}"
+            )
+        return {
+            "cycles": create_cycles(session, user_range=user_range),
+            "recurrent_objects": create_recurrent_objects(
+                session, user_range=user_range
+            ),
+        }
+
+
+def _init_shard_worker():
+    # The pooled connections inherited from the parent process can't be
+    # used by the workers
+    dispose_engines(close=False)
+
+
+def run_sharded(shard_count: int, max_workers: int | None = None) -> list:
+    """
+    Local driver that computes the user ranges once and runs every shard in
+    its own process
+    """
+    with get_session() as session:
+        user_ranges = get_user_ranges(session, shard_count)
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=_init_shard_worker
+    ) as executor:
+        return list(executor.map(run_shard, user_ranges))
 
 
 def lambda_handler(event, context):
+    """
+    Runs the shard of the user_range of the event ([first_id, last_id]).
+    An event with just a shard_count greater than 1 returns the user ranges
+    to run, so the orchestrator invokes one shard per range. Without any of
+    them every user is processed at once
+    """
     logger.info("Creating recurrent objects...")
-    session = get_session()
-    create_cycles(session)
-    create_recurrent_incomes(session)
-    create_recurrent_expenses(session)
-    create_recurrent_savings(session)
-    create_recurrent_budgets(session)
+    event = event or {}
+    if event.get("user_range"):
+        first_id, last_id = event["user_range"]
+        return run_shard((int(first_id), int(last_id)))
+    shard_count = int(event.get("shard_count", 1))
+    if shard_count > 1:
+        with get_session() as session:
+            return {"user_ranges": get_user_ranges(session, shard_count)}
+    return run_shard()
 
 
 if __name__ == '__main__':
-    session = get_session()
-    create_cycles(session)
-    create_recurrent_incomes(session)
-    create_recurrent_expenses(session)
-    create_recurrent_savings(session)
-    create_recurrent_budgets(session)
+    shard_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    if shard_count > 1:
+        run_sharded(shard_count)
+    else:
+        run_shard()
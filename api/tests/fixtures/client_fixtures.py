@@ -1,6 +1,8 @@
 from fastapi.testclient import TestClient
 from sqlmodel import Session
-from ...dependencies import get_session, get_current_active_user
+from ...dependencies import (
+    get_session, get_current_active_user, get_active_cycle_cache
+)
 from ...main import app
 from ...models import User
 import pytest
@@ -24,6 +26,10 @@ def client_fixture(session: Session):
     app.dependency_overrides[get_current_active_user] = \
         get_current_active_user_override
 
+    # The active cycles are cached per user id and every test builds a new
+    # database for the same users
+    get_active_cycle_cache().clear()
     client = TestClient(app)
     yield client
     app.dependency_overrides.clear()
+    get_active_cycle_cache().clear()
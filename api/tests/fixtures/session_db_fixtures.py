@@ -1,5 +1,6 @@
 from sqlmodel import Session, SQLModel, create_engine
 from sqlmodel.pool import StaticPool
+from sqlalchemy import event
 import pytest
 
 
@@ -13,3 +14,17 @@ def session_fixture():
     SQLModel.metadata.create_all(engine)
     with Session(engine) as session:
         yield session
+
+
+@pytest.fixture(name="queries")
+def queries_fixture(session: Session):
+    """Collects every statement executed against the test database"""
+    statements = []
+
+    def collect_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", collect_statement)
+    yield statements
+    event.remove(engine, "before_cursor_execute", collect_statement)
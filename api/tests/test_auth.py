@@ -0,0 +1,151 @@
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from datetime import datetime, timedelta
+from unittest import mock
+from ..auth import SigningKeyProvider, VerifiedTokenCache, decode_token
+import jwt
+import os
+import pytest
+import time
+
+
+AUDIENCE = ["https://domain.auth0"]
+
+
+def write_certificate(path):
+    """Creates a self-signed certificate and returns its private key"""
+    private_key = rsa.generate_private_key(
+        public_exponent=65537, key_size=2048
+    )
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "auth0")])
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(private_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(datetime(2024, 1, 1))
+        .not_valid_after(datetime(2124, 1, 1))
+        .sign(private_key, hashes.SHA256())
+    )
+    path.write_bytes(certificate.public_bytes(serialization.Encoding.PEM))
+    return private_key
+
+
+def build_token(private_key, kid=None, exp=None, sub="auth0|1"):
+    return jwt.encode(
+        {
+            "sub": sub,
+            "aud": AUDIENCE,
+            "exp": exp or int(time.time()) + 3600,
+        },
+        private_key,
+        algorithm="RS256",
+        headers={"kid": kid} if kid else None,
+    )
+
+
+@pytest.fixture(name="certificate")
+def certificate_fixture(tmp_path):
+    path = tmp_path / "certificate.pem"
+    return path, write_certificate(path)
+
+
+def test_key_provider_loads_once(certificate):
+    path, _ = certificate
+    provider = SigningKeyProvider(str(path), check_interval=0)
+    with mock.patch(
+        "api.auth.load_pem_x509_certificates",
+        wraps=x509.load_pem_x509_certificates,
+    ) as load_mock:
+        provider.get_key()
+        provider.get_key()
+    assert load_mock.call_count == 1
+
+
+def test_key_provider_reloads_on_mtime_change(certificate):
+    path, _ = certificate
+    provider = SigningKeyProvider(str(path), check_interval=0)
+    old_key = provider.get_key()
+    write_certificate(path)
+    os.utime(path, (time.time() + 10, time.time() + 10))
+    assert provider.get_key() != old_key
+
+
+def test_key_provider_directory_selects_kid(tmp_path):
+    write_certificate(tmp_path / "old.pem")
+    private_key = write_certificate(tmp_path / "new.pem")
+    provider = SigningKeyProvider(str(tmp_path))
+    token = build_token(private_key, kid="new")
+    claims = decode_token(token, provider, VerifiedTokenCache(), AUDIENCE)
+    assert claims["sub"] == "auth0|1"
+
+
+def test_decode_token_uses_cache(certificate):
+    path, private_key = certificate
+    provider = SigningKeyProvider(str(path))
+    cache = VerifiedTokenCache()
+    token = build_token(private_key)
+    decode_token(token, provider, cache, AUDIENCE)
+    with mock.patch("api.auth.jwt.decode") as decode_mock:
+        claims = decode_token(token, provider, cache, AUDIENCE)
+    decode_mock.assert_not_called()
+    assert claims["sub"] == "auth0|1"
+
+
+def test_decode_token_invalid_audience(certificate):
+    path, private_key = certificate
+    provider = SigningKeyProvider(str(path))
+    token = build_token(private_key)
+    with pytest.raises(jwt.InvalidAudienceError):
+        decode_token(token, provider, VerifiedTokenCache(), ["other"])
+
+
+def test_token_cache_respects_exp():
+    cache = VerifiedTokenCache(ttl=300)
+    cache.set("token", {"sub": "auth0|1", "exp": time.time() - 1})
+    assert cache.get("token") is None
+
+
+def test_token_cache_evicts_least_recently_used():
+    cache = VerifiedTokenCache(maxsize=2)
+    cache.set("token1", {"sub": "1"})
+    cache.set("token2", {"sub": "2"})
+    cache.get("token1")
+    cache.set("token3", {"sub": "3"})
+    assert cache.get("token2") is None
+    assert cache.get("token1") == {"sub": "1"}
+    assert cache.get("token3") == {"sub": "3"}
+
+
+def test_token_cache_expired_ttl():
+    cache = VerifiedTokenCache(ttl=60)
+    cache.set("token", {"sub": "1"})
+    with mock.patch("api.auth.time.time", return_value=time.time() + 61):
+        assert cache.get("token") is None
+
+
+def test_decode_expired_token(certificate):
+    path, private_key = certificate
+    token = build_token(private_key, exp=int(time.time()) - 10)
+    with pytest.raises(jwt.ExpiredSignatureError):
+        decode_token(
+            token, SigningKeyProvider(str(path)), VerifiedTokenCache(),
+            AUDIENCE
+        )
+
+
+def test_token_cache_disabled():
+    cache = VerifiedTokenCache(maxsize=0)
+    cache.set("token", {"sub": "1"})
+    assert cache.get("token") is None
+
+
+def test_expired_token_ttl_respected_over_long_ttl():
+    cache = VerifiedTokenCache(ttl=timedelta(days=1).total_seconds())
+    exp = time.time() + 5
+    cache.set("token", {"sub": "1", "exp": exp})
+    with mock.patch("api.auth.time.time", return_value=exp + 1):
+        assert cache.get("token") is None
@@ -1,7 +1,7 @@
-from sqlmodel import Session
+from sqlmodel import Session, select
 from fastapi.testclient import TestClient
 from datetime import datetime
-from ..models import Budget, Cycle
+from ..models import Budget, BudgetTotals, Cycle
 import pytest
 
 
@@ -60,3 +60,70 @@ def test_read_budgets_limit(client: TestClient, budgets):
     assert response.status_code == 200
     assert len(data) == 1
     assert "total_spent" in data[0]
+
+
+def create_expense(client: TestClient, **data):
+    response = client.post("/expenses/", json={
+        "description": "Expense", "date_expense": "2021-01-10", **data
+    })
+    assert response.status_code == 201
+    return response.json()["id"]
+
+
+def test_read_budgets_with_expenses(client: TestClient, budgets):
+    create_expense(client, val_expense=10, budget_id=2)
+    create_expense(client, val_expense=20, budget_id=2)
+    create_expense(client, val_expense=30, budget_id=1)
+    create_expense(client, val_expense=5)
+    response = client.get("/budgets/")
+    data = response.json()
+
+    assert response.status_code == 200
+    assert [budget["id"] for budget in data] == [0, 2, 1]
+    assert [budget["total_spent"] for budget in data] == [5, 30, 30]
+
+
+def test_read_budgets_without_unbudgeted_expenses(
+    client: TestClient, session: Session, budgets
+):
+    expense_ids = [
+        create_expense(client, val_expense=value) for value in [0.1, 0.2]
+    ]
+    for expense_id in expense_ids:
+        client.delete(f"/expenses/{expense_id}")
+    session.expire_all()
+    # The float total can keep a residue once every expense is removed
+    assert session.get(BudgetTotals, (1, 0)).total_spent != 0
+    data = client.get("/budgets/").json()
+    assert [budget["id"] for budget in data] == [1, 2]
+
+
+def test_budget_totals_follow_expense_changes(
+    client: TestClient, session: Session, budgets
+):
+    expense_id = create_expense(client, val_expense=10, budget_id=1)
+    client.patch(f"/expenses/{expense_id}", json={
+        "val_expense": 15, "budget_id": 2, "cycle_id": 1
+    })
+    assert session.get(BudgetTotals, (1, 1)).expense_count == 0
+    assert session.get(BudgetTotals, (1, 2)).total_spent == 15
+    # Moving the expense to another cycle leaves it without budget
+    client.patch(f"/expenses/{expense_id}", json={"cycle_id": 2})
+    session.expire_all()
+    assert session.get(BudgetTotals, (1, 2)).total_spent == 0
+    assert session.get(BudgetTotals, (2, 0)).total_spent == 15
+    client.delete(f"/expenses/{expense_id}")
+    session.expire_all()
+    assert session.get(BudgetTotals, (2, 0)).expense_count == 0
+
+
+def test_delete_budget_removes_its_totals(
+    client: TestClient, session: Session, budgets
+):
+    create_expense(client, val_expense=10, budget_id=1)
+    response = client.delete("/budgets/1")
+    assert response.status_code == 200
+    budget_totals = session.exec(
+        select(BudgetTotals).where(BudgetTotals.budget_id == 1)
+    ).all()
+    assert budget_totals == []
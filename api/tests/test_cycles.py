@@ -0,0 +1,177 @@
+from sqlmodel import Session
+from fastapi.testclient import TestClient
+from fastapi import HTTPException
+from datetime import datetime
+from unittest import mock
+from freezegun import freeze_time
+from ..models import Cycle, CycleTotals, Expense, Income
+from ..dependencies import get_cycle_id, get_active_cycle_cache
+from ..totals import rebuild_cycle_totals
+from .. import tasks
+import pytest
+
+
+@pytest.fixture(name="cycles")
+def cycle_fixture(session: Session):
+    cycle_1 = Cycle(
+        id=1,
+        description="Cycle 1",
+        start_date=datetime(2021, 1, 1),
+        end_date=datetime(2021, 1, 31),
+        is_active=True,
+        user_id=1,
+    )
+    cycle_2 = Cycle(
+        id=2,
+        description="Cycle 2",
+        start_date=datetime(2021, 2, 1),
+        end_date=datetime(2021, 2, 28),
+        is_active=False,
+        user_id=1,
+    )
+    cycle_3 = Cycle(
+        id=3,
+        description="Cycle 3",
+        start_date=datetime(2021, 2, 1),
+        end_date=datetime(2021, 2, 28),
+        is_active=True,
+        user_id=2,
+    )
+    session.add(cycle_1)
+    session.add(cycle_2)
+    session.add(cycle_3)
+    session.commit()
+
+
+@pytest.fixture(name="movements")
+def movements_fixture(session: Session, cycles):
+    session.add(Expense(
+        description="Expense 1", val_expense=100, cycle_id=1,
+        is_recurrent_expense=True
+    ))
+    session.add(Expense(description="Expense 2", val_expense=200, cycle_id=1))
+    session.add(Expense(description="Expense 3", val_expense=300, cycle_id=2))
+    session.add(Income(description="Income 1", val_income=1000, cycle_id=1))
+    session.commit()
+    rebuild_cycle_totals(session)
+
+
+@pytest.fixture(name="cycle_cache")
+def cycle_cache_fixture():
+    cycle_cache = get_active_cycle_cache()
+    cycle_cache.clear()
+    yield cycle_cache
+    cycle_cache.clear()
+
+
+def test_cycle_status(client: TestClient, movements):
+    response = client.get("/cycles/cycle-status")
+    assert response.status_code == 200
+    assert response.json() == {
+        "total_recurrent_expenses": 100,
+        "total_expenses": 200,
+        "total_incomes": 1000,
+        "total_savings": 0,
+    }
+
+
+def test_cycle_status_given_cycle(client: TestClient, movements):
+    response = client.get("/cycles/cycle-status?cycle_id=2")
+    assert response.status_code == 200
+    assert response.json()["total_expenses"] == 300
+
+
+def test_cycle_status_other_user_cycle(client: TestClient, movements):
+    response = client.get("/cycles/cycle-status?cycle_id=3")
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Cycle not found"
+
+
+@freeze_time("2021-01-15")
+def test_active_cycle_is_cached(session: Session, cycles, cycle_cache):
+    assert get_cycle_id(session, 1) == 1
+    with mock.patch.object(session, "exec") as exec_mock:
+        assert get_cycle_id(session, 1) == 1
+        assert get_cycle_id(session, 1, 1) == 1
+    exec_mock.assert_not_called()
+    assert cycle_cache.stats()["hits"] == 2
+
+
+def test_active_cycle_expires_after_its_end(
+    session: Session, cycles, cycle_cache
+):
+    """
+    Test that the cached active cycle is resolved again once its last day
+    has passed, as the rollover doesn't run in the process of the API
+    """
+    with freeze_time("2021-01-31 23:59:59") as frozen_time:
+        assert get_cycle_id(session, 1) == 1
+        assert cycle_cache.get(1) == 1
+        frozen_time.tick()
+        assert cycle_cache.get(1) is None
+        # The cycle isn't cached again until the rollover replaces it
+        assert get_cycle_id(session, 1) == 1
+        assert cycle_cache.get(1) is None
+
+
+def test_given_cycle_is_validated(session: Session, cycles, cycle_cache):
+    assert get_cycle_id(session, 1, 2) == 2
+    with pytest.raises(HTTPException):
+        get_cycle_id(session, 1, 3)
+    assert cycle_cache.get(1) is None
+
+
+def test_create_cycles_invalidates_active_cycle(
+    session: Session, users, cycles, cycle_cache
+):
+    assert get_cycle_id(session, 1) == 1
+    tasks.create_cycles(session)
+    assert get_cycle_id(session, 1) != 1
+
+
+def test_cycle_status_without_movements(client: TestClient, cycles):
+    response = client.get("/cycles/cycle-status")
+    assert response.status_code == 200
+    assert response.json()["total_expenses"] == 0
+
+
+def test_cycle_status_follows_movements(client: TestClient, movements):
+    response = client.post("/expenses/", json={
+        "description": "Expense 4", "val_expense": 50, "cycle_id": 1
+    })
+    expense_id = response.json()["id"]
+    client.post("/incomes/", json={
+        "description": "Income 2", "val_income": 10, "cycle_id": 1
+    })
+    client.post("/savings/", json={
+        "description": "Saving", "val_saving": 30, "cycle_id": 1
+    })
+    client.patch(f"/expenses/{expense_id}", json={"val_expense": 70})
+    client.delete("/expenses/2")
+    response = client.get("/cycles/cycle-status")
+    assert response.json() == {
+        "total_recurrent_expenses": 100,
+        "total_expenses": 70,
+        "total_incomes": 1010,
+        "total_savings": 30,
+    }
+
+
+def test_cycle_status_expense_moved_between_cycles(
+    client: TestClient, movements
+):
+    client.patch("/expenses/2", json={"cycle_id": 2})
+    active_status = client.get("/cycles/cycle-status").json()
+    other_status = client.get("/cycles/cycle-status?cycle_id=2").json()
+    assert active_status["total_expenses"] == 0
+    assert other_status["total_expenses"] == 500
+
+
+def test_rebuild_cycle_totals_fixes_drift(session: Session, movements):
+    cycle_totals = session.get(CycleTotals, 1)
+    cycle_totals.total_expenses = 1
+    session.add(cycle_totals)
+    session.commit()
+    assert rebuild_cycle_totals(session, [1]) == 1
+    assert session.get(CycleTotals, 1).total_expenses == 200
+    assert session.get(CycleTotals, 2).total_expenses == 300
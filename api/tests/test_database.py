@@ -0,0 +1,85 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.pool import QueuePool
+from sqlmodel import Session, SQLModel
+from datetime import date
+from unittest import mock
+from ..models import (
+    BudgetTotals, Cycle, CycleTotals, Expense, SavingTypeTotals
+)
+from .. import database
+import pytest
+
+
+@pytest.fixture(name="engines")
+def engines_fixture():
+    yield
+    database.dispose_engines()
+
+
+def test_get_engine_reuses_engine(engines):
+    engine = database.get_engine("sqlite://")
+    assert database.get_engine("sqlite://") is engine
+
+
+def test_get_engine_is_pooled(engines):
+    engine = database.get_engine("sqlite://")
+    settings = database.get_settings()
+    assert isinstance(engine.pool, QueuePool)
+    assert engine.pool.size() == settings.database_pool_size
+
+
+def test_get_engine_different_urls(engines, tmp_path):
+    engine = database.get_engine("sqlite://")
+    other_engine = database.get_engine(f"sqlite:///{tmp_path}/other.db")
+    assert engine is not other_engine
+
+
+def test_dispose_engines(engines):
+    engine = database.get_engine("sqlite://")
+    database.dispose_engines()
+    assert database.get_engine("sqlite://") is not engine
+
+
+def test_create_missing_indexes(engines):
+    engine = database.get_engine("sqlite://")
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE expense (id INTEGER PRIMARY KEY, cycle_id INTEGER, "
+            "budget_id INTEGER, date_expense DATETIME)"
+        ))
+    SQLModel.metadata.create_all(engine)
+    database.create_missing_indexes(engine)
+    # Running it again over an up to date database shouldn't fail
+    database.create_missing_indexes(engine)
+    indexes = {
+        index["name"] for index in inspect(engine).get_indexes("expense")
+    }
+    assert "ix_expense_cycle_id_date_expense" in indexes
+    assert "ix_expense_cycle_id_budget_id" in indexes
+
+
+def test_create_db_and_tables_builds_totals(engines, tmp_path):
+    database_url = f"sqlite:///{tmp_path}/existing.db"
+    engine = database.get_engine(database_url)
+    SQLModel.metadata.create_all(engine, tables=[
+        table for table in SQLModel.metadata.sorted_tables
+        if table.name not in {
+            CycleTotals.__tablename__,
+            BudgetTotals.__tablename__,
+            SavingTypeTotals.__tablename__,
+        }
+    ])
+    with Session(engine) as session:
+        session.add(Cycle(
+            id=1, description="Cycle", start_date=date(2024, 1, 1),
+            end_date=date(2024, 1, 31), user_id=1
+        ))
+        session.add(Expense(description="Expense", val_expense=10, cycle_id=1))
+        session.commit()
+    with mock.patch.object(
+        database, "get_database_url", return_value=database_url
+    ):
+        database.create_db_and_tables()
+    with Session(engine) as session:
+        assert session.get(CycleTotals, 1).total_expenses == 10
+        assert session.get(BudgetTotals, (1, 0)).total_spent == 10
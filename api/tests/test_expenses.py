@@ -1,6 +1,9 @@
 from sqlmodel import Session, select
 from fastapi.testclient import TestClient
-from ..models import Expense, Cycle, Budget, RecurrentExpense
+from ..models import (
+    Expense, Cycle, Budget, BudgetTotals, CycleTotals, RecurrentExpense
+)
+from unittest import mock
 from datetime import datetime
 import pytest
 
@@ -180,6 +183,46 @@ def test_create_recurrent_expense(
     assert recurrent_expenses.val_expense == 400
 
 
+def test_create_expense_idempotency_key(
+    client: TestClient, session: Session, expenses, cycles
+):
+    req_data = {
+        "description": "Expense 4",
+        "val_expense": 400,
+        "cycle_id": 1,
+        "idempotency_key": "a",
+    }
+    response = client.post("/expenses/", json=req_data)
+    assert response.status_code == 201
+    expenses_count = len(session.exec(select(Expense)).all())
+    # Sending the expense again returns the one already created
+    repeated = client.post("/expenses/", json=req_data)
+    assert repeated.status_code == 200
+    assert repeated.json()["id"] == response.json()["id"]
+    assert len(session.exec(select(Expense)).all()) == expenses_count
+
+
+def test_create_expense_idempotency_key_created_concurrently(
+    client: TestClient, session: Session, expenses, cycles
+):
+    """
+    Test that a request that doesn't see the key of a concurrent one, which
+    commits first, returns the expense of that request
+    """
+    req_data = {"description": "Expense 4", "val_expense": 400,
+                "cycle_id": 1, "idempotency_key": "a"}
+    expense_id = client.post("/expenses/", json=req_data).json()["id"]
+    expenses_count = len(session.exec(select(Expense)).all())
+    with mock.patch(
+        "api.routers.expenses._get_known_idempotency_keys",
+        side_effect=[{}, {"a": expense_id}],
+    ):
+        response = client.post("/expenses/", json=req_data)
+    assert response.status_code == 200
+    assert response.json()["id"] == expense_id
+    assert len(session.exec(select(Expense)).all()) == expenses_count
+
+
 def test_create_expense_cycle_not_found(client: TestClient, expenses, budgets):
     req_data = {
         "description": "Expense 4",
@@ -329,4 +372,158 @@ def test_read_expenses_with_budget(client: TestClient, expenses, budgets):
     assert response.status_code == 200
     data = response.json()
     assert len(data) == 1
-    assert data[0]["id"] == 2
\ No newline at end of file
+    assert data[0]["id"] == 2
+
+
+def test_read_expenses_constant_queries(
+    client: TestClient, session: Session, expenses, budgets, queries
+):
+    for index in range(10):
+        session.add(Expense(
+            description=f"Expense {index}",
+            val_expense=10,
+            cycle_id=1,
+            budget_id=1 + index % 2,
+        ))
+    session.commit()
+    session.expunge_all()
+    queries.clear()
+    response = client.get("/expenses/")
+    assert response.status_code == 200
+    assert len(response.json()) == 12
+    # One query to resolve the active cycle and one to read the expenses
+    assert len(queries) == 2
+
+
+def test_read_expenses_cursor_pagination(
+    client: TestClient, session: Session, expenses
+):
+    for index in range(4):
+        session.add(Expense(
+            description=f"Expense {index}",
+            val_expense=10,
+            date_expense=datetime(2021, 1, 3),
+            cycle_id=1,
+        ))
+    session.commit()
+    response = client.get("/expenses/?limit=4")
+    first_page = response.json()
+    next_cursor = response.headers["X-Next-Cursor"]
+    response = client.get(f"/expenses/?limit=4&cursor={next_cursor}")
+    second_page = response.json()
+    assert response.status_code == 200
+    assert "X-Next-Cursor" not in response.headers
+    assert len(first_page) == 4
+    assert len(second_page) == 2
+    ids = [expense["id"] for expense in first_page + second_page]
+    assert len(set(ids)) == 6
+    assert second_page[-1]["id"] == 1
+
+
+def test_read_expenses_invalid_cursor(client: TestClient, expenses):
+    response = client.get("/expenses/?cursor=invalid")
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor"
+
+
+def test_create_expenses_bulk(
+    client: TestClient, session: Session, budgets, queries
+):
+    req_data = [
+        {"description": "Bulk 1", "val_expense": 10, "budget_id": 1},
+        {"description": "Bulk 2", "val_expense": 20, "cycle_id": 2},
+        {"description": "Bulk 3", "val_expense": 30, "cycle_id": 3},
+        {"description": "Bulk 4", "val_expense": 40, "budget_id": 3},
+        {
+            "description": "Bulk 5",
+            "val_expense": 50,
+            "create_recurrent_expense": True,
+        },
+    ]
+    queries.clear()
+    response = client.post("/expenses/bulk", json=req_data)
+    # One query for the cycles, the active cycle and the budgets, one insert
+    # per table and one upsert per totals table, whatever the number of
+    # expenses
+    assert len(queries) == 7
+    assert response.status_code == 200
+    data = response.json()
+    assert data["created"] == 3
+    assert data["failed"] == 2
+    assert [result["detail"] for result in data["results"]] == [
+        None, None, "Cycle not found", "Budget not found", None
+    ]
+    ids = [result["id"] for result in data["results"]]
+    assert session.get(Expense, ids[0]).budget_id == 1
+    assert session.get(Expense, ids[1]).cycle_id == 2
+    assert session.get(Expense, ids[4]).is_recurrent_expense
+    assert session.exec(
+        select(RecurrentExpense)
+        .where(RecurrentExpense.description == "Bulk 5")
+    ).one()
+    assert session.get(CycleTotals, 1).total_expenses == 10
+    assert session.get(CycleTotals, 1).total_recurrent_expenses == 50
+    assert session.get(BudgetTotals, (1, 1)).total_spent == 10
+    assert session.get(BudgetTotals, (2, 0)).expense_count == 1
+
+
+def test_create_expenses_bulk_idempotency_keys(
+    client: TestClient, session: Session, budgets
+):
+    req_data = [
+        {"description": "Bulk 1", "val_expense": 10, "idempotency_key": "a"},
+        {"description": "Bulk 2", "val_expense": 20, "idempotency_key": "b"},
+        {"description": "Bulk 1", "val_expense": 10, "idempotency_key": "a"},
+        {"description": "Bulk 3", "val_expense": 30},
+    ]
+    data = client.post("/expenses/bulk", json=req_data).json()
+    assert data["created"] == 3
+    assert data["failed"] == 0
+    ids = [result["id"] for result in data["results"]]
+    assert ids[0] == ids[2]
+    expenses_count = len(session.exec(select(Expense)).all())
+    # Sending the batch again only creates the expense without key
+    data = client.post("/expenses/bulk", json=req_data).json()
+    assert data["created"] == 1
+    assert [result["id"] for result in data["results"]][:3] == ids[:3]
+    assert len(session.exec(select(Expense)).all()) == expenses_count + 1
+
+
+def test_create_expenses_bulk_idempotency_keys_created_concurrently(
+    client: TestClient, session: Session, budgets
+):
+    """
+    Test that a batch that doesn't see the keys of a concurrent one, which
+    commits first, returns its ids and creates the rest
+    """
+    req_data = [
+        {"description": "Bulk 1", "val_expense": 10, "idempotency_key": "a"},
+    ]
+    expense_id = client.post("/expenses/bulk", json=req_data).json()[
+        "results"
+    ][0]["id"]
+    expenses_count = len(session.exec(select(Expense)).all())
+    req_data.append(
+        {"description": "Bulk 2", "val_expense": 20, "idempotency_key": "b"}
+    )
+    with mock.patch(
+        "api.routers.expenses._get_known_idempotency_keys",
+        side_effect=[{}, {"a": expense_id}],
+    ):
+        response = client.post("/expenses/bulk", json=req_data)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["created"] == 1
+    assert data["results"][0]["id"] == expense_id
+    assert len(session.exec(select(Expense)).all()) == expenses_count + 1
+
+
+def test_create_expenses_bulk_too_many(client: TestClient, cycles):
+    req_data = [{"description": "Bulk", "val_expense": 10}] * 3
+    with mock.patch(
+        "api.routers.expenses.get_settings",
+        return_value=mock.Mock(expenses_bulk_max_items=2),
+    ):
+        response = client.post("/expenses/bulk", json=req_data)
+    assert response.status_code == 413
+    assert response.json()["detail"] == "Too many expenses"
@@ -0,0 +1,92 @@
+from sqlmodel import Session
+from fastapi.testclient import TestClient
+from ..models import (
+    Cycle, Expense, Income, Saving, SavingType, Budget, ExportFormatEnum
+)
+from ..routers import export
+from datetime import datetime
+from unittest import mock
+import csv
+import io
+import json
+import pytest
+
+
+@pytest.fixture(name="movements")
+def movements_fixture(session: Session):
+    session.add(Cycle(
+        id=1,
+        description="Cycle 1",
+        start_date=datetime(2021, 1, 1),
+        end_date=datetime(2021, 1, 31),
+        is_active=False,
+        user_id=1,
+    ))
+    session.add(Cycle(
+        id=2,
+        description="Cycle 2",
+        start_date=datetime(2021, 2, 1),
+        end_date=datetime(2021, 2, 28),
+        is_active=True,
+        user_id=1,
+    ))
+    session.add(Cycle(
+        id=3,
+        description="Cycle 3",
+        start_date=datetime(2021, 2, 1),
+        end_date=datetime(2021, 2, 28),
+        is_active=True,
+        user_id=2,
+    ))
+    session.add(Budget(id=1, description="Food", val_budget=100, cycle_id=1))
+    session.add(SavingType(id=1, description="Travel", user_id=1))
+    session.add(Expense(
+        description="Lunch",
+        val_expense=10,
+        date_expense=datetime(2021, 1, 5),
+        cycle_id=1,
+        budget_id=1,
+    ))
+    session.add(Expense(description="Taxi", val_expense=20, cycle_id=2))
+    session.add(Expense(description="Other", val_expense=30, cycle_id=3))
+    session.add(Income(description="Salary", val_income=1000, cycle_id=2))
+    session.add(Saving(val_saving=100, cycle_id=2, saving_type_id=1))
+    session.commit()
+
+
+def test_export_csv(client: TestClient, movements):
+    response = client.get("/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert [row["type"] for row in rows] == [
+        "expense", "expense", "income", "saving"
+    ]
+    assert rows[0]["description"] == "Lunch"
+    assert rows[0]["budget"] == "Food"
+    assert rows[0]["date"] == "2021-01-05T00:00:00"
+    assert rows[1]["source"] == "App"
+    assert rows[3]["saving_type"] == "Travel"
+    assert rows[3]["movement_type"] == "Income"
+
+
+def test_export_ndjson_cycle_range(client: TestClient, movements):
+    response = client.get(
+        "/export?export_format=ndjson&from_date=2021-02-01"
+    )
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [(row["type"], row["value"]) for row in rows] == [
+        ("expense", 20), ("income", 1000), ("saving", 100)
+    ]
+    assert all(row["cycle_id"] == 2 for row in rows)
+
+
+def test_export_streams_in_batches(session: Session, movements):
+    statements = export._export_statements(1, None, None)
+    with mock.patch.object(export, "EXPORT_BATCH_SIZE", 1):
+        chunks = list(export.stream_export(
+            session.get_bind(), statements, ExportFormatEnum.ndjson
+        ))
+    assert len(chunks) == 4
+    assert all(chunk.count("\n") == 1 for chunk in chunks)
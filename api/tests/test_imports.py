@@ -0,0 +1,251 @@
+from sqlmodel import Session, select
+from fastapi.testclient import TestClient
+from ..models import (
+    Cycle, CycleTotals, Expense, Income, SourceEnum, StatementImport,
+    StatementFormatEnum, ImportStatusEnum, User
+)
+from ..statements import (
+    CycleResolver, StatementRow, import_statement_rows, parse_csv_statement,
+    parse_ofx_statement
+)
+from ..routers import imports
+from ..tasks import create_cycles
+from datetime import date, datetime
+from freezegun import freeze_time
+import io
+import pytest
+
+
+CSV_STATEMENT = """Date,Description,Amount
+2021-01-05,Market,-100.5
+2021-01-06,Salary,2000
+2021-01-07,Broken,abc
+2021-03-02,Taxi,-20
+"""
+OFX_STATEMENT = """OFXHEADER:100
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>
+<STMTTRN>
+<TRNTYPE>DEBIT
+<DTPOSTED>20210110120000[-5:EST]
+<TRNAMT>-35.00
+<FITID>1
+<NAME>Restaurant
+</STMTTRN>
+<STMTTRN>
+<TRNTYPE>CREDIT
+<DTPOSTED>20210111
+<TRNAMT>500
+<FITID>2
+<MEMO>Transfer
+</STMTTRN>
+</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+"""
+
+
+@pytest.fixture(name="cycles")
+def cycle_fixture(session: Session, users):
+    session.add(Cycle(
+        id=1,
+        description="Cycle 1",
+        start_date=datetime(2021, 1, 1),
+        end_date=datetime(2021, 1, 31),
+        is_active=True,
+        user_id=1,
+    ))
+    session.commit()
+
+
+def upload(client: TestClient, content: str, filename: str):
+    return client.post(
+        "/imports", files={"file": (filename, content.encode())}
+    )
+
+
+def test_import_csv_statement(
+    client: TestClient, session: Session, cycles
+):
+    response = upload(client, CSV_STATEMENT, "statement.csv")
+    assert response.status_code == 202
+    # The test client runs the background task before returning
+    response = client.get(f"/imports/{response.json()['id']}")
+    data = response.json()
+    assert data["status"] == ImportStatusEnum.done
+    assert data["rows_read"] == 4
+    assert data["expenses_created"] == 2
+    assert data["incomes_created"] == 1
+    assert data["failed"] == 1
+    market = session.exec(
+        select(Expense).where(Expense.description == "Market")
+    ).one()
+    assert market.val_expense == 100.5
+    assert market.cycle_id == 1
+    assert market.source == SourceEnum.statement
+    taxi = session.exec(
+        select(Expense).where(Expense.description == "Taxi")
+    ).one()
+    assert taxi.cycle.start_date == datetime(2021, 3, 1).date()
+    assert not taxi.cycle.is_active
+    assert session.get(CycleTotals, 1).total_expenses == 100.5
+    assert session.get(CycleTotals, 1).total_incomes == 2000
+
+
+def test_import_statement_skips_duplicates(
+    client: TestClient, session: Session, cycles
+):
+    upload(client, CSV_STATEMENT, "statement.csv")
+    response = upload(client, CSV_STATEMENT, "statement.csv")
+    data = client.get(f"/imports/{response.json()['id']}").json()
+    assert data["duplicates"] == 3
+    assert data["expenses_created"] == 0
+    assert len(session.exec(select(Expense)).all()) == 2
+    assert len(session.exec(select(Income)).all()) == 1
+
+
+def test_import_ofx_statement(client: TestClient, session: Session, cycles):
+    response = upload(client, OFX_STATEMENT, "statement.ofx")
+    data = client.get(f"/imports/{response.json()['id']}").json()
+    assert data["expenses_created"] == 1
+    assert data["incomes_created"] == 1
+    income = session.exec(select(Income)).one()
+    assert income.description == "Transfer"
+    assert income.date_income == datetime(2021, 1, 11)
+
+
+def test_import_statement_in_batches(session: Session, cycles):
+    statement_import = StatementImport(
+        filename="statement.csv",
+        statement_format=StatementFormatEnum.csv,
+        user_id=1,
+    )
+    session.add(statement_import)
+    session.commit()
+    rows = parse_ofx_statement(io.StringIO(OFX_STATEMENT))
+    import_statement_rows(session, statement_import, rows, batch_size=1)
+    assert statement_import.rows_read == 2
+    assert statement_import.expenses_created == 1
+
+
+@pytest.mark.parametrize("batch_size", [1, 500])
+def test_import_statement_equal_transactions(
+    session: Session, cycles, batch_size
+):
+    """
+    Equal transactions of the same statement are all imported, while the
+    ones of a statement imported again are duplicates
+    """
+    content = (
+        "Date,Description,Amount\n"
+        "2021-01-05,Coffee,-5\n"
+        "2021-01-05,Coffee,-5\n"
+    )
+    for expected_created, expected_duplicates in [(2, 0), (0, 2)]:
+        statement_import = StatementImport(
+            filename="statement.csv",
+            statement_format=StatementFormatEnum.csv,
+            user_id=1,
+        )
+        session.add(statement_import)
+        session.commit()
+        import_statement_rows(
+            session, statement_import,
+            parse_csv_statement(io.StringIO(content)), batch_size,
+        )
+        assert statement_import.expenses_created == expected_created
+        assert statement_import.duplicates == expected_duplicates
+    assert len(session.exec(select(Expense)).all()) == 2
+
+
+def test_import_ofx_statement_repeated_fitid(session: Session, cycles):
+    transaction = (
+        "<STMTTRN><DTPOSTED>20210110<TRNAMT>-35.00<FITID>{fitid}"
+        "<NAME>Restaurant</STMTTRN>\n"
+    )
+    content = "".join(
+        transaction.format(fitid=fitid) for fitid in ["1", "2", "1"]
+    )
+    statement_import = StatementImport(
+        filename="statement.ofx",
+        statement_format=StatementFormatEnum.ofx,
+        user_id=1,
+    )
+    session.add(statement_import)
+    session.commit()
+    import_statement_rows(
+        session, statement_import, parse_ofx_statement(io.StringIO(content))
+    )
+    assert statement_import.expenses_created == 2
+    assert statement_import.duplicates == 1
+
+
+def test_cycle_resolver_dates_between_cycles(session: Session, users):
+    user = session.get(User, 1)
+    user.start_cycle_day = 25
+    user.end_cycle_day = 10
+    cycles = CycleResolver(session, user)
+    cycle_id = cycles.get_cycle_id(datetime(2024, 10, 18))
+    # The dates between two cycles go to the next one, created only once
+    assert cycles.get_cycle_id(datetime(2024, 10, 20)) == cycle_id
+    assert cycles.get_cycle_id(datetime(2024, 11, 2)) == cycle_id
+    cycle = session.exec(select(Cycle)).one()
+    assert (cycle.start_date, cycle.end_date) == (
+        date(2024, 10, 25), date(2024, 11, 10)
+    )
+
+
+@freeze_time("2024-10-18")
+def test_import_statement_current_cycle(session: Session, users):
+    """
+    Test that the rows of the current period create the cycle through the
+    rollover, so it's active and still gets its recurrent objects
+    """
+    statement_import = StatementImport(
+        filename="statement.csv",
+        statement_format=StatementFormatEnum.csv,
+        user_id=1,
+    )
+    session.add(statement_import)
+    session.commit()
+    import_statement_rows(session, statement_import, [
+        StatementRow(datetime(2024, 9, 20), "Old market", -30),
+        StatementRow(datetime(2024, 10, 15), "Market", -100),
+        StatementRow(datetime(2024, 11, 2), "Next cycle", -10),
+    ])
+    assert statement_import.expenses_created == 2
+    assert statement_import.failed == 1
+    old_cycle, current_cycle = session.exec(
+        select(Cycle).order_by(Cycle.start_date)
+    ).all()
+    assert not old_cycle.is_active
+    assert old_cycle.is_recurrent_expenses_created
+    assert current_cycle.is_active
+    assert current_cycle.start_date == date(2024, 10, 1)
+    assert not current_cycle.is_recurrent_expenses_created
+    assert not current_cycle.is_recurrent_incomes_created
+    # The rollover doesn't create the current cycle again
+    assert create_cycles(session, 1)["created"] == 0
+
+
+def test_import_statement_removes_file_on_error(
+    client: TestClient, cycles, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(imports.tempfile, "tempdir", str(tmp_path))
+
+    def fail():
+        raise RuntimeError("Unavailable settings")
+
+    monkeypatch.setattr(imports, "get_settings", fail)
+    with pytest.raises(RuntimeError):
+        upload(client, CSV_STATEMENT, "statement.csv")
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_import_unsupported_format(client: TestClient, cycles):
+    response = upload(client, CSV_STATEMENT, "statement.xlsx")
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Unsupported statement format"
+
+
+def test_read_import_not_found(client: TestClient, cycles):
+    response = client.get("/imports/999")
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Import not found"
@@ -159,3 +159,14 @@ def test_delete_income_other_user(client: TestClient, incomes):
     assert response.json()["detail"] == "Income not found"
     response = client.get("/incomes/")
     assert len(response.json()) == 2
+
+
+def test_list_incomes_cursor_pagination(client: TestClient, incomes):
+    response = client.get("/incomes/?limit=1")
+    first_page = response.json()
+    next_cursor = response.headers["X-Next-Cursor"]
+    response = client.get(f"/incomes/?limit=1&cursor={next_cursor}")
+    second_page = response.json()
+    assert response.status_code == 200
+    assert first_page[0]["id"] == 2
+    assert second_page[0]["id"] == 1
@@ -1,6 +1,9 @@
 from sqlmodel import Session
 from fastapi.testclient import TestClient
-from ..models import Saving, Cycle, RecurrentSaving, SavingType
+from ..models import (
+    Saving, Cycle, RecurrentSaving, SavingType, SavingTypeTotals
+)
+from ..totals import rebuild_saving_type_totals, verify_saving_type_totals
 from sqlmodel import select
 from datetime import datetime
 import pytest
@@ -220,3 +223,73 @@ def test_delete_saving_other_user(client: TestClient, savings):
     assert response.json()["detail"] == "Saving not found"
     response = client.get("/savings/")
     assert len(response.json()) == 2
+
+
+def test_list_savings_constant_queries(
+    client: TestClient, session: Session, savings, queries
+):
+    for index in range(10):
+        session.add(Saving(
+            val_saving=10, cycle_id=1, saving_type_id=1 + index % 2
+        ))
+    session.commit()
+    session.expunge_all()
+    queries.clear()
+    response = client.get("/savings/")
+    assert response.status_code == 200
+    assert len(response.json()) == 12
+    # One query to resolve the active cycle and one to read the savings
+    assert len(queries) == 2
+
+
+def test_read_grouped_savings(client: TestClient, session: Session, savings):
+    rebuild_saving_type_totals(session)
+    response = client.post("/savings/saving-outcome", json={
+        "saving": "Saving 1",
+        "val_outcome": 50,
+        "date_outcome": "2021-01-20",
+        "description": "Outcome",
+    })
+    assert response.status_code == 201
+    response = client.get("/savings/grouped-savings")
+    assert response.status_code == 200
+    data = {saving["id"]: saving for saving in response.json()}
+    assert set(data) == {1, 2}
+    assert data[1]["total_global"] == 250
+    assert data[1]["total_last_month"] == 250
+    assert data[2]["total_global"] == 300
+    assert data[2]["total_last_month"] == 0
+    assert verify_saving_type_totals(session) == []
+
+
+def test_saving_type_totals_follow_saving_changes(
+    client: TestClient, session: Session, cycles
+):
+    response = client.post("/savings/", json={
+        "description": "Travel", "val_saving": 100, "date_saving": "2021-01-05"
+    })
+    first_id = response.json()["id"]
+    response = client.post("/savings/", json={
+        "description": "Travel", "val_saving": 50, "date_saving": "2021-01-10"
+    })
+    second_id = response.json()["id"]
+    saving_type_id = response.json()["saving_type"]["id"]
+    client.patch(f"/savings/{first_id}", json={"val_saving": 150})
+    client.delete(f"/savings/{second_id}")
+    session.expire_all()
+    totals = session.get(SavingTypeTotals, saving_type_id)
+    assert totals.total_global == 150
+    assert totals.saving_count == 1
+    assert totals.last_saving == datetime(2021, 1, 5)
+    assert verify_saving_type_totals(session) == []
+
+
+def test_verify_saving_type_totals_fixes_drift(
+    session: Session, savings
+):
+    rebuild_saving_type_totals(session)
+    session.get(SavingTypeTotals, 2).total_global = 1
+    session.commit()
+    assert verify_saving_type_totals(session, fix=True) == [2]
+    assert verify_saving_type_totals(session) == []
+    assert session.get(SavingTypeTotals, 2).total_global == 300
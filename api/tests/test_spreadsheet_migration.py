@@ -0,0 +1,144 @@
+from sqlmodel import Session, select
+from datetime import date, datetime
+import pytest
+
+pd = pytest.importorskip("pandas")
+
+from ..models import (  # noqa: E402
+    Budget, BudgetTotals, Cycle, CycleTotals, Expense, Income
+)
+from .. import spreadsheet_migration  # noqa: E402
+
+
+def build_sheet() -> "pd.DataFrame":
+    """
+    Month sheet with the income in C1 and, from the row 8, the recurrent
+    expenses (B:C, until Total), the Salidas expenses (E:F) and the
+    general expenses (H:I)
+    """
+    rows = [[None] * 9 for _ in range(12)]
+    rows[0][2] = 3000
+    for index, (description, value) in enumerate(
+        [("Rent", 1000), ("Internet", 50), ("Total", 1050)]
+    ):
+        rows[7 + index][1:3] = [description, value]
+    for index, (description, value) in enumerate([("Cinema", 20)]):
+        rows[7 + index][4:6] = [description, value]
+    for index, (description, value) in enumerate(
+        [("Gasolina carro", 60), ("Mercado Exito", 200), ("Shoes", 80)]
+    ):
+        rows[7 + index][7:9] = [description, value]
+    return pd.DataFrame(rows)
+
+
+@pytest.mark.parametrize("sheet_name, expected", [
+    ("Enero 2024", date(2024, 1, 1)),
+    (" diciembre 2023 ", date(2023, 12, 1)),
+    ("Resumen", None),
+    ("Mayo", None),
+    ("Foo 2024", None),
+])
+def test_parse_sheet_name(sheet_name, expected):
+    assert spreadsheet_migration.parse_sheet_name(sheet_name) == expected
+
+
+def test_extract_block():
+    sheet = build_sheet()
+    recurrent = spreadsheet_migration._extract_block(
+        sheet, 1, 2, stop_value="Total"
+    )
+    assert recurrent.to_dict("list") == {
+        "description": ["Rent", "Internet"], "value": [1000, 50]
+    }
+    general = spreadsheet_migration._extract_block(sheet, 7, 8)
+    assert list(general["description"]) == [
+        "Gasolina carro", "Mercado Exito", "Shoes"
+    ]
+    # The sheets without the columns of a block have no movements
+    assert spreadsheet_migration._extract_block(sheet, 10, 11).empty
+
+
+def test_extract_block_without_stop_row():
+    sheet = build_sheet()
+    sheet.iloc[9, 1:3] = [None, None]
+    recurrent = spreadsheet_migration._extract_block(
+        sheet, 1, 2, stop_value="Total"
+    )
+    assert recurrent.to_dict("list") == {
+        "description": ["Rent", "Internet"], "value": [1000, 50]
+    }
+
+
+def test_classify_general_expenses():
+    budgets = spreadsheet_migration.classify_general_expenses(
+        pd.Series(["GASOLINA carro", "mercado", "Shoes", None])
+    )
+    assert list(budgets) == ["Gasolina", "Mercado", "General", "General"]
+
+
+def test_extract_sheet():
+    extracted = spreadsheet_migration.extract_sheet(build_sheet())
+    assert extracted["income"] == 3000
+    expenses = extracted["expenses"]
+    assert list(expenses["description"]) == [
+        "Rent", "Internet", "Cinema", "Gasolina carro", "Mercado Exito",
+        "Shoes"
+    ]
+    assert list(expenses["is_recurrent_expense"]) == [
+        True, True, False, False, False, False
+    ]
+    assert list(expenses["budget"]) == [
+        None, None, "Salidas", "Gasolina", "Mercado", "General"
+    ]
+
+
+def test_import_sheet(session: Session, users):
+    cycle_id = spreadsheet_migration.import_sheet(
+        session, 1, date(2024, 1, 1), build_sheet()
+    )
+    session.commit()
+    cycle = session.get(Cycle, cycle_id)
+    assert cycle.description == "Ene 2024"
+    assert (cycle.start_date, cycle.end_date) == (
+        date(2024, 1, 1), date(2024, 1, 31)
+    )
+    assert not cycle.is_active
+    assert session.exec(select(Income)).one().val_income == 3000
+    budgets = {
+        budget.id: budget.description
+        for budget in session.exec(select(Budget))
+    }
+    expenses = {
+        expense.description: expense
+        for expense in session.exec(select(Expense))
+    }
+    assert len(expenses) == 6
+    assert expenses["Rent"].is_recurrent_expense
+    assert expenses["Rent"].budget_id is None
+    assert expenses["Rent"].date_expense == datetime(2024, 1, 1, 5)
+    assert expenses["Cinema"].date_expense == datetime(2024, 1, 1, 6)
+    assert budgets[expenses["Cinema"].budget_id] == "Salidas"
+    assert budgets[expenses["Mercado Exito"].budget_id] == "Mercado"
+    assert expenses["Shoes"].val_expense == 80
+
+    spreadsheet_migration.rebuild_totals(session, [cycle_id])
+    assert session.get(CycleTotals, cycle_id).total_expenses == 360
+    assert session.get(CycleTotals, cycle_id).total_recurrent_expenses == 1050
+    assert session.get(BudgetTotals, (cycle_id, 0)).expense_count == 2
+
+
+def test_import_workbook(session: Session, users, tmp_path):
+    pytest.importorskip("openpyxl")
+    path = tmp_path / "Presupuestos.xlsx"
+    with pd.ExcelWriter(path) as writer:
+        build_sheet().to_excel(writer, sheet_name="Enero 2024", index=False)
+        build_sheet().to_excel(writer, sheet_name="Febrero 2024", index=False)
+        pd.DataFrame([["Summary"]]).to_excel(
+            writer, sheet_name="Resumen", index=False
+        )
+    report = spreadsheet_migration.import_workbook(session, str(path), 1)
+    assert report["cycles"] == 2
+    cycles = session.exec(select(Cycle).order_by(Cycle.start_date)).all()
+    assert [cycle.description for cycle in cycles] == ["Ene 2024", "Feb 2024"]
+    assert len(session.exec(select(Expense)).all()) == 12
+    assert session.get(CycleTotals, cycles[1].id).total_incomes == 3000
@@ -1,10 +1,13 @@
 from sqlmodel import Session, select
-from datetime import datetime
+from datetime import date, datetime
 from freezegun import freeze_time
+from unittest import mock
 from .. import tasks
+from ..totals import verify_saving_type_totals
 from ..models import (
     Cycle, Income, RecurrentIncome, RecurrentExpense, RecurrentSaving,
-    Expense, Saving, RecurrentBudget, Budget, SavingType
+    Expense, Saving, RecurrentBudget, Budget, SavingType, SourceEnum,
+    SavingMovementEnum, User, CycleTotals, BudgetTotals, SavingTypeTotals
 )
 import pytest
 
@@ -256,3 +259,171 @@ def test_create_recurrent_budgets_inactive_cycle(
     cycle = session.exec(select(Cycle)).one()
     assert len(budgets) == 0
     assert cycle.is_recurrent_budgets_created == 0
+
+
+def test_create_recurrent_expenses_values(
+        session: Session, active_cycle, recurrent_expenses
+):
+    tasks.create_recurrent_expenses(session)
+    expense = session.exec(select(Expense).order_by(Expense.id)).first()
+    assert expense.description == 'expense 1'
+    assert expense.val_expense == 1000
+    assert expense.source == SourceEnum.recurrent
+    assert expense.is_recurrent_expense is True
+    assert expense.budget_id is None
+
+
+def test_create_recurrent_savings_values(
+        session: Session, active_cycle, recurrent_savings
+):
+    tasks.create_recurrent_savings(session)
+    saving = session.exec(select(Saving).order_by(Saving.id)).first()
+    assert saving.val_saving == 1000
+    assert saving.saving_type_id == 1
+    assert saving.movement_type == SavingMovementEnum.income
+    assert saving.is_recurrent_saving is True
+
+
+def test_create_recurrent_objects_is_set_based(
+        session: Session, active_cycle, recurrent_incomes,
+        recurrent_expenses, recurrent_savings, recurrent_budgets, queries
+):
+    session.add(Cycle(
+        description="January, 2024",
+        start_date=datetime(2024, 1, 1),
+        end_date=datetime(2024, 1, 31),
+        user_id=3
+    ))
+    session.add(RecurrentIncome(description='Income', val_income=1, user_id=3))
+    session.commit()
+    queries.clear()
+    totals = tasks.create_recurrent_objects(session)
+    # One INSERT ... SELECT and one UPDATE per kind of recurrent object, plus
+    # one upsert of the cycle totals for incomes, expenses and savings, one of
+    # the budget totals for the expenses and one of the saving type totals
+    assert len(queries) == 13
+    assert totals == {"incomes": 3, "expenses": 2, "savings": 2, "budgets": 2}
+    cycles = session.exec(select(Cycle)).all()
+    assert all(cycle.is_recurrent_incomes_created for cycle in cycles)
+    assert all(cycle.is_recurrent_budgets_created for cycle in cycles)
+    # Running it again must not duplicate the recurrent objects
+    tasks.create_recurrent_objects(session)
+    assert len(session.exec(select(Income)).all()) == 3
+
+
+@freeze_time("2024-02-01")
+def test_create_cycles_is_idempotent(session: Session, active_cycle):
+    report = tasks.create_cycles(session)
+    assert report["created"] == 2
+    assert report["deactivated"] == 1
+    report = tasks.create_cycles(session)
+    assert report["created"] == 0
+    assert len(session.exec(select(Cycle)).all()) == 3
+
+
+@freeze_time("2024-02-10")
+def test_create_cycles_honors_cycle_days(session: Session, users):
+    user = session.get(User, 1)
+    user.start_cycle_day = 25
+    user.end_cycle_day = 24
+    session.add(user)
+    session.commit()
+    tasks.create_cycles(session, 1)
+    cycle = session.exec(select(Cycle)).one()
+    assert cycle.start_date == date(2024, 1, 25)
+    assert cycle.end_date == date(2024, 2, 24)
+    assert cycle.description == "January, 2024"
+
+
+@freeze_time("2024-10-18")
+@pytest.mark.parametrize("start_cycle_day, end_cycle_day, start, end", [
+    (25, 10, date(2024, 10, 25), date(2024, 11, 10)),
+    (20, 30, date(2024, 10, 20), date(2024, 10, 30)),
+])
+def test_create_cycles_between_cycles_is_idempotent(
+    session: Session, users, start_cycle_day, end_cycle_day, start, end
+):
+    user = session.get(User, 1)
+    user.start_cycle_day = start_cycle_day
+    user.end_cycle_day = end_cycle_day
+    session.add(user)
+    session.commit()
+    assert tasks.create_cycles(session, 1)["created"] == 1
+    assert tasks.create_cycles(session, 1)["created"] == 0
+    cycle = session.exec(select(Cycle)).one()
+    assert (cycle.start_date, cycle.end_date) == (start, end)
+
+
+def test_get_user_ranges(session: Session, users):
+    assert tasks.get_user_ranges(session, 1) == [(1, 3)]
+    assert tasks.get_user_ranges(session, 2) == [(1, 2), (3, 3)]
+    assert tasks.get_user_ranges(session, 5) == [(1, 1), (2, 2), (3, 3)]
+
+
+def test_get_user_ranges_no_users(session: Session):
+    assert tasks.get_user_ranges(session, 2) == []
+
+
+def test_create_cycles_user_range(session: Session, users):
+    tasks.create_cycles(session, user_range=(2, 3))
+    cycles = session.exec(select(Cycle)).all()
+    assert [cycle.user_id for cycle in cycles] == [3]
+
+
+def test_run_shard(session: Session, users, recurrent_incomes):
+    with mock.patch.object(tasks, "get_session", return_value=session):
+        first_shard = tasks.run_shard((1, 2))
+        second_shard = tasks.run_shard((3, 3))
+    assert first_shard["cycles"]["created"] == 1
+    assert first_shard["recurrent_objects"]["incomes"] == 2
+    assert second_shard["cycles"]["created"] == 1
+    assert second_shard["recurrent_objects"]["incomes"] == 0
+
+
+def test_lambda_handler_shards(session: Session, users, recurrent_incomes):
+    """
+    The ranges are computed once, so the users that sign up while the
+    shards run don't move the ranges of the pending shards (recomputing
+    them would give 1-3 and 4-5, skipping the user 3)
+    """
+    with mock.patch.object(tasks, "get_session", return_value=session):
+        user_ranges = tasks.lambda_handler({"shard_count": 2}, None)[
+            "user_ranges"
+        ]
+        assert user_ranges == [(1, 2), (3, 3)]
+        shards = [tasks.lambda_handler({"user_range": user_ranges[0]}, None)]
+        for user_id in [4, 5]:
+            session.add(User(
+                id=user_id,
+                email=f'test{user_id}@test.com',
+                name='New',
+                auth0_id=f'auth0|{user_id}',
+                is_active=True,
+            ))
+        session.commit()
+        shards.append(
+            tasks.lambda_handler({"user_range": list(user_ranges[1])}, None)
+        )
+    assert [shard["cycles"]["created"] for shard in shards] == [1, 1]
+    cycles = session.exec(select(Cycle)).all()
+    assert sorted(cycle.user_id for cycle in cycles) == [1, 3]
+
+
+def test_create_recurrent_objects_updates_totals(
+        session: Session, active_cycle, recurrent_incomes,
+        recurrent_expenses, recurrent_savings
+):
+    tasks.create_recurrent_objects(session)
+    cycle_totals = session.exec(select(CycleTotals)).one()
+    assert cycle_totals.total_incomes == 41000
+    assert cycle_totals.total_recurrent_expenses == 41000
+    assert cycle_totals.total_expenses == 0
+    assert cycle_totals.total_savings == 41000
+    budget_totals = session.exec(select(BudgetTotals)).one()
+    assert budget_totals.budget_id == 0
+    assert budget_totals.total_spent == 41000
+    assert budget_totals.expense_count == 2
+    saving_type_totals = session.exec(select(SavingTypeTotals)).all()
+    assert sum(totals.total_global for totals in saving_type_totals) == 41000
+    assert all(totals.recurrent_count == 1 for totals in saving_type_totals)
+    assert verify_saving_type_totals(session) == []
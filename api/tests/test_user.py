@@ -1,8 +1,12 @@
 from fastapi.testclient import TestClient
+from sqlmodel import Session
+from unittest import mock
 from ..models import User
 from ..main import app
-from ..dependencies import get_current_user
+from ..dependencies import get_current_user, get_user_cache
 from datetime import datetime
+import asyncio
+import pytest
 
 
 client = TestClient(app)
@@ -62,3 +66,44 @@ def test_inactive_user_deny_access():
     response = client.get('/users/me')
     assert response.status_code == 401
     app.dependency_overrides = {}
+
+
+@pytest.fixture(name="user_cache")
+def user_cache_fixture():
+    user_cache = get_user_cache()
+    user_cache.clear()
+    yield user_cache
+    user_cache.clear()
+
+
+def test_current_user_is_cached(session: Session, users, user_cache):
+    """
+    Test that the user is only looked up in the database the first time
+    """
+    with mock.patch(
+        "api.dependencies.decode_token", return_value={"sub": "auth0|1"}
+    ):
+        user = asyncio.run(get_current_user(token="token", session=session))
+        with mock.patch.object(session, "exec") as exec_mock:
+            cached_user = asyncio.run(
+                get_current_user(token="token", session=session)
+            )
+    exec_mock.assert_not_called()
+    assert cached_user == user
+    assert cached_user.id == 1
+    assert user_cache.stats()["hits"] == 1
+    assert user_cache.stats()["misses"] == 1
+
+
+def test_deactivate_user_invalidates_cache(
+    client: TestClient, session: Session, users, user_cache
+):
+    """
+    Test that deactivating a user removes it from the users cache
+    """
+    user_cache.set("auth0|1", "cached user")
+    response = client.delete('/users/me')
+    db_user = session.get(User, 1)
+    assert response.status_code == 200
+    assert db_user.is_active is False
+    assert user_cache.get("auth0|1") is None
@@ -36,3 +36,43 @@ def test_last_day_month_invalid_date():
 def test_last_day_month_same_date():
     result = utils.get_last_day_month(date(2022, 12, 31))
     assert result == date(2022, 12, 31)
+
+
+def test_cycle_dates_default_days():
+    result = utils.get_cycle_dates(date(2024, 2, 10))
+    assert result == (date(2024, 2, 1), date(2024, 2, 29))
+
+
+def test_cycle_dates_same_month_days():
+    result = utils.get_cycle_dates(date(2024, 2, 10), 5, 30)
+    assert result == (date(2024, 2, 5), date(2024, 2, 29))
+
+
+def test_cycle_dates_between_cycles():
+    result = utils.get_cycle_dates(date(2024, 2, 29), 5, 25)
+    assert result == (date(2024, 3, 5), date(2024, 3, 25))
+
+
+def test_cycle_dates_crossing_month_after_start():
+    result = utils.get_cycle_dates(date(2024, 12, 26), 25, 24)
+    assert result == (date(2024, 12, 25), date(2025, 1, 24))
+
+
+def test_cycle_dates_crossing_month_before_start():
+    result = utils.get_cycle_dates(date(2024, 1, 10), 25, 24)
+    assert result == (date(2023, 12, 25), date(2024, 1, 24))
+
+
+def test_cycle_dates_crossing_month_between_cycles():
+    result = utils.get_cycle_dates(date(2024, 10, 18), 25, 10)
+    assert result == (date(2024, 10, 25), date(2024, 11, 10))
+
+
+def test_cycle_dates_crossing_month_end_day():
+    result = utils.get_cycle_dates(date(2024, 10, 10), 25, 10)
+    assert result == (date(2024, 9, 25), date(2024, 10, 10))
+
+
+def test_cycle_dates_same_month_before_start():
+    result = utils.get_cycle_dates(date(2024, 10, 5), 10, 20)
+    assert result == (date(2024, 10, 10), date(2024, 10, 20))
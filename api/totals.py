@@ -0,0 +1,444 @@
+from api.models import (
+    BudgetTotals, CycleTotals, Expense, Income, Saving, SavingMovementEnum,
+    SavingTypeTotals
+)
+from sqlalchemy import func, literal, case, union_all
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Session, delete, select, col, update
+import logging
+
+
+logger = logging.getLogger("expenses-tracker")
+
+
+def upsert_totals_stmt(stmt, **set_):
+    """
+    Turns an insert into a totals table into an upsert that adds the
+    inserted values to the totals already stored with the same key. The
+    columns given in set_ are updated with their own expression instead
+    """
+    table = stmt.table
+    return stmt.on_conflict_do_update(
+        index_elements=list(table.primary_key.columns),
+        set_={
+            column.name: set_.get(
+                column.name, column + stmt.excluded[column.name]
+            )
+            for column in table.c
+            if not column.primary_key
+        },
+    )
+
+
+def _upsert_saving_type_totals_stmt(stmt):
+    # The date of the last saving is kept as the newest of both dates
+    last_saving = SavingTypeTotals.__table__.c.last_saving
+    return upsert_totals_stmt(
+        stmt,
+        last_saving=func.max(
+            func.coalesce(last_saving, stmt.excluded.last_saving),
+            func.coalesce(stmt.excluded.last_saving, last_saving),
+        ),
+    )
+
+
+def signed_saving_value():
+    """
+    Value of a saving in its saving type balance: the outcomes are
+    subtracted from it
+    """
+    return case(
+        (
+            col(Saving.movement_type) == SavingMovementEnum.outcome,
+            -col(Saving.val_saving),
+        ),
+        else_=col(Saving.val_saving),
+    )
+
+
+def update_cycle_totals(session: Session, cycle_id: int, **deltas: float):
+    """
+    Adds the given deltas to the totals of the cycle, within the current
+    transaction of the session
+    """
+    session.exec(
+        upsert_totals_stmt(insert(CycleTotals).values(
+            cycle_id=cycle_id, **deltas
+        ))
+    )
+
+
+def update_cycle_totals_from_select(
+    session: Session, fields: list[str], totals_stmt
+):
+    """
+    Adds the totals returned by the statement (the cycle id followed by one
+    value per field, one row per cycle) to the totals of each cycle
+    """
+    session.exec(
+        upsert_totals_stmt(insert(CycleTotals).from_select(
+            ["cycle_id", *fields], totals_stmt
+        ))
+    )
+
+
+def update_budget_totals_from_select(session: Session, totals_stmt):
+    """
+    Adds the totals returned by the statement (cycle id, budget id, spent
+    value and number of expenses) to the totals of each budget
+    """
+    session.exec(
+        upsert_totals_stmt(insert(BudgetTotals).from_select(
+            ["cycle_id", "budget_id", "total_spent", "expense_count"],
+            totals_stmt,
+        ))
+    )
+
+
+def apply_expense(session: Session, expense: Expense, sign: int = 1):
+    """
+    Adds (or subtracts, with a negative sign) the expense to the totals of
+    its cycle and of its budget
+    """
+    field = (
+        "total_recurrent_expenses"
+        if expense.is_recurrent_expense
+        else "total_expenses"
+    )
+    update_cycle_totals(
+        session, expense.cycle_id, **{field: sign * expense.val_expense}
+    )
+    session.exec(
+        upsert_totals_stmt(insert(BudgetTotals).values(
+            cycle_id=expense.cycle_id,
+            budget_id=expense.budget_id or 0,
+            total_spent=sign * expense.val_expense,
+            expense_count=sign,
+        ))
+    )
+
+
+def apply_expenses(session: Session, expenses: list[Expense]):
+    """
+    Adds a batch of new expenses to the totals of their cycles and budgets
+    with one statement per totals table
+    """
+    cycle_totals = {}
+    budget_totals = {}
+    for expense in expenses:
+        totals = cycle_totals.setdefault(expense.cycle_id, {
+            "cycle_id": expense.cycle_id,
+            "total_recurrent_expenses": 0,
+            "total_expenses": 0,
+        })
+        field = (
+            "total_recurrent_expenses"
+            if expense.is_recurrent_expense
+            else "total_expenses"
+        )
+        totals[field] += expense.val_expense
+        budget_id = expense.budget_id or 0
+        totals = budget_totals.setdefault((expense.cycle_id, budget_id), {
+            "cycle_id": expense.cycle_id,
+            "budget_id": budget_id,
+            "total_spent": 0,
+            "expense_count": 0,
+        })
+        totals["total_spent"] += expense.val_expense
+        totals["expense_count"] += 1
+    if not expenses:
+        return
+    session.exec(
+        upsert_totals_stmt(insert(CycleTotals)),
+        params=list(cycle_totals.values()),
+    )
+    session.exec(
+        upsert_totals_stmt(insert(BudgetTotals)),
+        params=list(budget_totals.values()),
+    )
+
+
+def apply_income(session: Session, income: Income, sign: int = 1):
+    update_cycle_totals(
+        session, income.cycle_id, total_incomes=sign * income.val_income
+    )
+
+
+def update_saving_type_totals_from_select(session: Session, totals_stmt):
+    """
+    Adds the totals returned by the statement (saving type id, balance,
+    number of savings, number of recurrent savings and date of the last
+    saving) to the totals of each saving type
+    """
+    session.exec(
+        _upsert_saving_type_totals_stmt(insert(SavingTypeTotals).from_select(
+            [
+                "saving_type_id",
+                "total_global",
+                "saving_count",
+                "recurrent_count",
+                "last_saving",
+            ],
+            totals_stmt,
+        ))
+    )
+
+
+def apply_incomes(session: Session, incomes: list[Income]):
+    """
+    Adds a batch of new incomes to the totals of their cycles with a single
+    statement
+    """
+    cycle_totals = {}
+    for income in incomes:
+        totals = cycle_totals.setdefault(
+            income.cycle_id, {"cycle_id": income.cycle_id, "total_incomes": 0}
+        )
+        totals["total_incomes"] += income.val_income
+    if not incomes:
+        return
+    session.exec(
+        upsert_totals_stmt(insert(CycleTotals)),
+        params=list(cycle_totals.values()),
+    )
+
+
+def apply_saving(session: Session, saving: Saving, sign: int = 1):
+    """
+    Adds (or subtracts, with a negative sign) the saving to the totals of
+    its cycle and to the balance of its saving type
+    """
+    update_cycle_totals(
+        session, saving.cycle_id, total_savings=sign * saving.val_saving
+    )
+    if saving.saving_type_id is None:
+        # The saving type has just been created with the saving
+        session.flush()
+    is_income = saving.movement_type == SavingMovementEnum.income
+    session.exec(
+        _upsert_saving_type_totals_stmt(insert(SavingTypeTotals).values(
+            saving_type_id=saving.saving_type_id,
+            total_global=sign * (
+                saving.val_saving if is_income else -saving.val_saving
+            ),
+            saving_count=sign,
+            recurrent_count=sign if saving.is_recurrent_saving else 0,
+            last_saving=saving.date_saving if is_income and sign > 0 else None,
+        ))
+    )
+    if is_income and sign < 0:
+        # The date of the last saving can't be subtracted, so it's searched
+        # again among the other savings of the type when this one was it
+        last_saving = (
+            select(func.max(Saving.date_saving))
+            .where(Saving.saving_type_id == saving.saving_type_id)
+            .where(Saving.movement_type == SavingMovementEnum.income)
+            .where(Saving.id != saving.id)
+            .scalar_subquery()
+        )
+        session.exec(
+            update(SavingTypeTotals)
+            .where(SavingTypeTotals.saving_type_id == saving.saving_type_id)
+            .where(col(SavingTypeTotals.last_saving) <= saving.date_saving)
+            .values(last_saving=last_saving)
+        )
+
+
+def get_unbudgeted_totals(session: Session, cycle_id: int) -> BudgetTotals:
+    unbudgeted_totals = session.get(BudgetTotals, (cycle_id, 0))
+    if not unbudgeted_totals:
+        return BudgetTotals(cycle_id=cycle_id, budget_id=0)
+    return unbudgeted_totals
+
+
+def get_cycle_totals(session: Session, cycle_id: int) -> CycleTotals:
+    cycle_totals = session.get(CycleTotals, cycle_id)
+    if not cycle_totals:
+        # Cycles without movements don't have totals yet
+        return CycleTotals(cycle_id=cycle_id)
+    return cycle_totals
+
+
+def rebuild_cycle_totals(
+    session: Session, cycle_ids: list[int] | None = None
+) -> int:
+    """
+    Recomputes the totals of the given cycles (or of all of them) from the
+    expenses, incomes and savings tables, fixing any drift of the
+    incremental updates. Returns the number of cycles rebuilt
+    """
+    zero = literal(0.0)
+    recurrent = col(Expense.is_recurrent_expense)
+    movements = union_all(
+        select(
+            Expense.cycle_id.label("cycle_id"),
+            case((recurrent, Expense.val_expense), else_=zero)
+            .label("recurrent_expenses"),
+            case((recurrent, zero), else_=Expense.val_expense)
+            .label("expenses"),
+            zero.label("incomes"),
+            zero.label("savings"),
+        ),
+        select(Income.cycle_id, zero, zero, Income.val_income, zero),
+        select(Saving.cycle_id, zero, zero, zero, Saving.val_saving),
+    ).subquery()
+    totals = select(
+        movements.c.cycle_id,
+        func.sum(movements.c.recurrent_expenses),
+        func.sum(movements.c.expenses),
+        func.sum(movements.c.incomes),
+        func.sum(movements.c.savings),
+    ).group_by(movements.c.cycle_id)
+    delete_stmt = delete(CycleTotals)
+    if cycle_ids is not None:
+        totals = totals.where(movements.c.cycle_id.in_(cycle_ids))
+        delete_stmt = delete_stmt.where(
+            col(CycleTotals.cycle_id).in_(cycle_ids)
+        )
+    session.exec(delete_stmt)
+    rebuilt = session.exec(
+        insert(CycleTotals).from_select(
+            [
+                "cycle_id",
+                "total_recurrent_expenses",
+                "total_expenses",
+                "total_incomes",
+                "total_savings",
+            ],
+            totals,
+        )
+    ).rowcount
+    session.commit()
+    logger.info(f"Cycle totals rebuilt for {rebuilt} cycles")
+    return rebuilt
+
+
+def rebuild_budget_totals(
+    session: Session, cycle_ids: list[int] | None = None
+) -> int:
+    """
+    Recomputes the totals of the budgets of the given cycles (or of all of
+    them) from the expenses table. Returns the number of budgets rebuilt
+    """
+    totals = select(
+        Expense.cycle_id,
+        func.coalesce(Expense.budget_id, 0),
+        func.sum(Expense.val_expense),
+        func.count(),
+    ).group_by(Expense.cycle_id, func.coalesce(Expense.budget_id, 0))
+    delete_stmt = delete(BudgetTotals)
+    if cycle_ids is not None:
+        totals = totals.where(col(Expense.cycle_id).in_(cycle_ids))
+        delete_stmt = delete_stmt.where(
+            col(BudgetTotals.cycle_id).in_(cycle_ids)
+        )
+    session.exec(delete_stmt)
+    rebuilt = session.exec(
+        insert(BudgetTotals).from_select(
+            ["cycle_id", "budget_id", "total_spent", "expense_count"],
+            totals,
+        )
+    ).rowcount
+    session.commit()
+    logger.info(f"Budget totals rebuilt for {rebuilt} budgets")
+    return rebuilt
+
+
+def saving_type_totals_stmt():
+    """
+    Statement that computes the totals of every saving type from the
+    savings table
+    """
+    is_income = col(Saving.movement_type) == SavingMovementEnum.income
+    return select(
+        Saving.saving_type_id,
+        func.sum(signed_saving_value()),
+        func.count(),
+        func.count(case((col(Saving.is_recurrent_saving), 1))),
+        func.max(case((is_income, Saving.date_saving))),
+    ).group_by(Saving.saving_type_id)
+
+
+def rebuild_saving_type_totals(session: Session) -> int:
+    """
+    Recomputes the balances of all the saving types from the savings
+    table. Returns the number of saving types rebuilt
+    """
+    session.exec(delete(SavingTypeTotals))
+    rebuilt = session.exec(
+        insert(SavingTypeTotals).from_select(
+            [
+                "saving_type_id",
+                "total_global",
+                "saving_count",
+                "recurrent_count",
+                "last_saving",
+            ],
+            saving_type_totals_stmt(),
+        )
+    ).rowcount
+    session.commit()
+    logger.info(f"Saving type totals rebuilt for {rebuilt} saving types")
+    return rebuilt
+
+
+def verify_saving_type_totals(session: Session, fix: bool = False) -> list:
+    """
+    Compares the stored balances of the saving types with the ones computed
+    from the savings table and returns the ids of the saving types that
+    don't match. With fix, the balances are rebuilt when any of them drifted
+    """
+    expected = {
+        row[0]: row[1:] for row in session.exec(saving_type_totals_stmt())
+    }
+    stored = {
+        totals.saving_type_id: (
+            totals.total_global,
+            totals.saving_count,
+            totals.recurrent_count,
+            totals.last_saving,
+        )
+        for totals in session.exec(select(SavingTypeTotals))
+        # The saving types without savings are the same as a missing row
+        if totals.saving_count or totals.total_global
+    }
+    mismatches = sorted(
+        saving_type_id
+        for saving_type_id in expected.keys() | stored.keys()
+        if not _same_totals(
+            expected.get(saving_type_id), stored.get(saving_type_id)
+        )
+    )
+    if mismatches:
+        logger.warning(f"Saving type totals drifted for {mismatches}")
+        if fix:
+            rebuild_saving_type_totals(session)
+    return mismatches
+
+
+def _same_totals(expected: tuple | None, stored: tuple | None) -> bool:
+    if expected is None or stored is None:
+        return expected == stored
+    total_global, *counts_and_date = expected
+    stored_total_global, *stored_counts_and_date = stored
+    return (
+        round(total_global - stored_total_global, 6) == 0
+        and tuple(counts_and_date) == tuple(stored_counts_and_date)
+    )
+
+
+def rebuild_totals(session: Session, cycle_ids: list[int] | None = None):
+    rebuild_cycle_totals(session, cycle_ids)
+    rebuild_budget_totals(session, cycle_ids)
+    if cycle_ids is None:
+        rebuild_saving_type_totals(session)
+
+
+if __name__ == "__main__":
+    import sys
+    from api.database import get_engine
+    with Session(get_engine()) as session:
+        if sys.argv[1:] == ["verify"]:
+            verify_saving_type_totals(session, fix=True)
+        else:
+            rebuild_totals(session)
@@ -18,3 +18,48 @@ def get_last_day_month(date_: date) -> date:
         month += 1
     next_month_date = date(year, month, 1)
     return next_month_date - timedelta(days=1)
+
+
+def get_month_day(date_: date, day: int) -> date:
+    """
+    Given a date, it'll return the given day of the same month, or the last
+    day of the month if the month is shorter
+    """
+    last_day = get_last_day_month(date_).day
+    return date(date_.year, date_.month, min(day, last_day))
+
+
+def add_months(date_: date, months: int) -> date:
+    """
+    Returns the first day of the month that is the given number of months
+    away from the given date
+    """
+    month_index = date_.year * 12 + date_.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def get_cycle_dates(
+    date_: date, start_cycle_day: int = 1, end_cycle_day: int = 31
+) -> tuple[date, date]:
+    """
+    Given a date and the cycle days configured by the user, it'll return the
+    start and end dates of the cycle that contains the date (or of the next
+    one, if the date falls between two cycles). When the start day is after
+    the end day the cycle ends in the month after it starts
+    """
+    if start_cycle_day <= end_cycle_day:
+        month = date_
+        if date_ > get_month_day(date_, end_cycle_day):
+            month = add_months(date_, 1)
+        return (
+            get_month_day(month, start_cycle_day),
+            get_month_day(month, end_cycle_day),
+        )
+    start_month = date_
+    if date_ <= get_month_day(date_, end_cycle_day):
+        # The cycle started the month before
+        start_month = add_months(date_, -1)
+    return (
+        get_month_day(start_month, start_cycle_day),
+        get_month_day(add_months(start_month, 1), end_cycle_day),
+    )
@@ -1,41 +1,66 @@
+import asyncio
 import os
 import logging
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
-from src import utils
 from src.email_source_mappings import get_all_subjects
-from src.email_providers.outlook_email import OutlookEmail
-from src.cleaning_functions import get_clean_html_body
+from src.email_providers.outlook_email import AsyncOutlookEmail, OutlookEmail
 from src.target_consumers.expenses_tracker_api import ExpensesTrackerAPI
-from src.email_source_mappings import get_cleaning_function
-from src.models import Expense
+from src.email_source_mappings import subject_matcher
+from src.pipeline import EmailPipeline
+from src.sync_state import SyncState
 
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
-def main():
-    load_dotenv()
-    """This should call the email service depending on the config set"""
+async def run():
     email_service = OutlookEmail(
         os.getenv('OUTLOOK_USER', ''), os.getenv('OUTLOOK_TOKEN', ''),
-        os.getenv('INBOX_NAME', 'inbox')
+        os.getenv('INBOX_NAME', 'inbox'),
+        fetch_batch_size=int(os.getenv('IMAP_FETCH_BATCH_SIZE', '50')),
+        connections=int(os.getenv('IMAP_CONNECTIONS', '1')),
+    )
+    mailbox = f'{email_service.email_address}/{email_service.inbox_name}'
+    parse_workers = int(os.getenv('PARSE_WORKERS', '1'))
+    # A single worker parses in a thread, so the emails aren't pickled
+    executor = (
+        ProcessPoolExecutor(max_workers=parse_workers)
+        if parse_workers > 1 else None
+    )
+    sync_state = SyncState(os.getenv('SYNC_STATE_PATH', 'sync_state.db'))
+    et_api = ExpensesTrackerAPI(
+        os.getenv('EXPENSES_TRACKER_API_URL', ''),
+        os.getenv('EXPENSES_TRACKER_API_TOKEN', ''),
+        outbox_path=os.getenv('OUTBOX_PATH', 'outbox.db'),
+        batch_size=int(os.getenv('EXPENSES_TRACKER_API_BATCH_SIZE', '100')),
     )
-    logger.info('Login to email service')
-    email_service.login()
-    logger.info('Getting unseen emails')
-    emails = email_service.get_unseen_emails()
-    logger.info('Found %s emails', len(emails))
-    emails = utils.filter_messages(emails, get_all_subjects())
-    expenses: list[Expense] = []
-    et_api = ExpensesTrackerAPI()
-    for email in emails:
-        body = get_clean_html_body(email.message)
-        expense = get_cleaning_function(email.subject)(body)
-        expenses.append(expense)
-    if et_api.add_expense(expenses=expenses):
-        # Marcar como leídos
-        pass
+    with sync_state, et_api:
+        pipeline = EmailPipeline(
+            AsyncOutlookEmail(email_service),
+            et_api,
+            sync_state,
+            mailbox,
+            subject_matcher,
+            included_subjects=get_all_subjects(),
+            executor=executor,
+            parse_workers=parse_workers,
+            chunk_size=int(os.getenv('PARSE_CHUNK_SIZE', '20')),
+            queue_size=int(os.getenv('PIPELINE_QUEUE_SIZE', '100')),
+            send_batch_size=et_api.batch_size,
+        )
+        try:
+            await pipeline.run()
+        finally:
+            if executor:
+                executor.shutdown()
+
+
+def main():
+    load_dotenv()
+    """This should call the email service depending on the config set"""
+    asyncio.run(run())
 
 
 if __name__ == '__main__':
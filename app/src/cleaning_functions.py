@@ -4,28 +4,55 @@ from src.exceptions import (
 )
 from src.models import Expense, ExpenseSource
 from src import utils
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer, Tag
+from collections.abc import Callable
 from datetime import datetime
 
+# lxml builds a different tree for malformed html, which changes the
+# navigation of the cleaning functions, so the same parser is always used
+HTML_PARSER = 'html.parser'
 
-def get_clean_html_body(raw_message: str) -> str:
+BODY_TAG = re.compile(r'<body', re.IGNORECASE)
+
+
+def parse_html_body(raw_message: str,
+                    parse_only: SoupStrainer | None = None) -> Tag:
+    """
+    Parses the html of the raw email only once. Returns the body tag or,
+    when parse_only is given, a document with just the tags of the strainer
+    """
     html_index = raw_message.find('<html')
     if html_index < 0:
         raise UnableGetBodyMessageException
     html_content = raw_message[html_index:]
-    soup = BeautifulSoup(html_content, 'html.parser')
+    if parse_only is not None:
+        if not BODY_TAG.search(html_content):
+            raise UnableGetBodyMessageException
+        return BeautifulSoup(html_content, HTML_PARSER, parse_only=parse_only)
+    soup = BeautifulSoup(html_content, HTML_PARSER)
     body_tag = soup.find('body')
     if not body_tag:
         raise UnableGetBodyMessageException
-    return str(body_tag)
+    return body_tag
+
+
+def get_clean_html_body(raw_message: str) -> str:
+    return str(parse_html_body(raw_message))
 
 
-def get_itau_cc_expense(message_body: str) -> Expense:
+def _get_soup(message_body: str | Tag) -> Tag:
+    # The bodies that were already parsed are used as they are
+    if isinstance(message_body, Tag):
+        return message_body
+    return BeautifulSoup(message_body, HTML_PARSER)
+
+
+def get_itau_cc_expense(message_body: str | Tag) -> Expense:
     """
     Function to return an expense filtering the info from an Itau
     credit card expense
     """
-    soup = BeautifulSoup(message_body, 'html.parser')
+    soup = _get_soup(message_body)
     expense = Expense(0, '', ExpenseSource.ITAU_CR)
     tables = soup.find_all('table')
     expense_value = ''
@@ -61,12 +88,12 @@ def get_itau_cc_expense(message_body: str) -> Expense:
     return expense
 
 
-def get_bancolombia_pse_expense(message_body: str) -> Expense:
+def get_bancolombia_pse_expense(message_body: str | Tag) -> Expense:
     """
     Function to return an expense, cleaning the info from Bancolombia
     pse payments
     """
-    soup = BeautifulSoup(message_body, 'html.parser')
+    soup = _get_soup(message_body)
     raw_tx_value = soup.find(string=re.compile('Valor de la'))
     # No longer use (for now)
     # tx_status = clean_string(str(soup.find(string=re.compile('Estado de'))))
@@ -100,3 +127,22 @@ def get_bancolombia_pse_expense(message_body: str) -> Expense:
 
 def clean_string(str_to_clean: str):
     return re.sub(r'\s+', ' ', str_to_clean.replace('\n', ' ').strip())
+
+
+# Tags that each cleaning function needs, so the rest of the html isn't
+# built. The functions that walk the whole body aren't here
+PARSE_ONLY: dict[Callable, SoupStrainer] = {
+    get_itau_cc_expense: SoupStrainer('table'),
+}
+
+
+def clean_expense(raw_message: str,
+                  cleaning_function: Callable[[str | Tag], Expense]
+                  ) -> Expense:
+    """
+    Parses the html of the email once, limited to the tags the cleaning
+    function needs, and returns the expense it extracts
+    """
+    return cleaning_function(parse_html_body(
+        raw_message, PARSE_ONLY.get(cleaning_function)
+    ))
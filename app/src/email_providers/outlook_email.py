@@ -1,16 +1,83 @@
+import asyncio
 import email
 import imaplib
 import logging
-from dataclasses import dataclass
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from collections.abc import AsyncIterator
+from itertools import batched, repeat
 from src.exceptions import (
     UnableRetrieveEmailsException, UnableRetrieveSubjectException,
 )
-from email.header import decode_header
+from email.header import decode_header, make_header
 from datetime import datetime, timedelta
-from src.models import EmailMessage
+from src.models import EmailMessage, SyncCheckpoint
+from src import utils
 
 
 logger = logging.getLogger(__name__)
+IMAP_HOST = 'outlook.office365.com'
+SUBJECT_QUERY = '(BODY.PEEK[HEADER.FIELDS (SUBJECT)])'
+BODY_QUERY = '(BODY.PEEK[])'
+FETCH_RESPONSE_UID = re.compile(rb'UID (\d+)')
+
+
+def decode_subject(subject: str | None) -> str:
+    # A subject can be made of several chunks, each with its own encoding
+    return str(make_header(decode_header(subject or '')))
+
+
+def _quote(value: str) -> bytes:
+    escaped = value.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'.encode('utf-8')
+
+
+def build_subject_search(
+    criteria: str, included_subjects: list[str]
+) -> bytes:
+    """
+    Builds the criteria of an IMAP SEARCH for the emails that match the
+    given criteria and whose subject contains any of the included subjects.
+    OR only takes two keys, so the subjects are chained as OR a OR b c
+    """
+    subject_criteria = b'SUBJECT ' + _quote(included_subjects[-1])
+    for included_subject in reversed(included_subjects[:-1]):
+        subject_criteria = (
+            b'OR SUBJECT ' + _quote(included_subject) + b' ' + subject_criteria
+        )
+    return b'(' + criteria.encode('utf-8') + b' ' + subject_criteria + b')'
+
+
+def decode_message(message_id: str, email_bytes: bytes) -> EmailMessage:
+    """
+    Parses the raw email only once to get its subject, its html body and
+    its Message-ID, used as the idempotency key of the expense
+    """
+    idempotency_key = ''
+    try:
+        parsed_email = email.message_from_bytes(email_bytes)
+        idempotency_key = (parsed_email['Message-ID'] or '').strip()
+        html_parts = [
+            part for part in parsed_email.walk()
+            if part.get_content_type() == 'text/html'
+        ]
+        if not html_parts:
+            raise UnableRetrieveSubjectException
+        subject = decode_subject(parsed_email['Subject'])
+        message_content = html_parts[-1].get_payload(decode=True) \
+                                        .decode('utf-8')
+    except Exception as ex:
+        logger.error(ex)
+        return EmailMessage(
+            id=message_id,
+            subject=f'Unreadable subject message [{message_id}]',
+            message='',
+            idempotency_key=idempotency_key,
+        )
+    return EmailMessage(id=message_id, subject=subject,
+                        message=message_content,
+                        idempotency_key=idempotency_key)
 
 
 @dataclass
@@ -18,58 +85,313 @@ class OutlookEmail:
     email_address: str
     token: str
     inbox_name: str
+    # Number of messages requested by each FETCH command
+    fetch_batch_size: int = 50
+    # Number of IMAP connections used to fetch the batches in parallel
+    connections: int = 1
+    # UIDVALIDITY of the inbox and highest UID seen by the last search
+    checkpoint: SyncCheckpoint | None = None
+    _server: imaplib.IMAP4_SSL | None = field(
+        default=None, init=False, repr=False
+    )
+    # Connections of the fetch workers, opened on the first parallel fetch
+    # and kept until logout
+    _workers: list[imaplib.IMAP4_SSL] = field(
+        default_factory=list, init=False, repr=False
+    )
+
+    def _connect(self) -> imaplib.IMAP4_SSL:
+        server = imaplib.IMAP4_SSL(IMAP_HOST, timeout=3)
+        logger.info('Stablishing connection to Outlook Server: %s', server)
+        server.login(self.email_address, self.token)
+        return server
 
     def login(self):
         logger.info('Starting connection to Outlook imap')
-        self._server = imaplib.IMAP4_SSL('outlook.office365.com', timeout=3)
-        logger.info('Stablishing connection to Outlook Server: %s',
-                    self._server)
-        self._server.login(self.email_address, self.token)
+        self._server = self._connect()
+
+    def logout(self):
+        servers = [self._server, *self._workers] if self._server else []
+        self._server, self._workers = None, []
+        for server in servers:
+            try:
+                server.logout()
+            except (imaplib.IMAP4.error, OSError) as ex:
+                logger.warning('Unable to close an IMAP connection: %s', ex)
 
-    def get_unseen_emails(self) -> list[EmailMessage]:
+    def _select_inbox(self) -> SyncCheckpoint:
+        """
+        Selects the inbox and returns its UIDVALIDITY with the UID of its
+        last email, taken from the UIDNEXT of the response
+        """
         self._server.select(self.inbox_name, readonly=True)
-        messages: list[EmailMessage] = []
-        since = (datetime.now() - timedelta(weeks=3)).strftime("%d-%b-%Y")
-        status, b_messages = self._server.search(
-            None, f'(UNSEEN SINCE {since})'
+        _, uid_validity = self._server.response('UIDVALIDITY')
+        _, uid_next = self._server.response('UIDNEXT')
+        return SyncCheckpoint(
+            uid_validity=int(uid_validity[0]) if uid_validity[0] else 0,
+            last_uid=int(uid_next[0]) - 1 if uid_next[0] else 0,
+        )
+
+    def get_unseen_emails(
+        self,
+        included_subjects: list[str] | None = None,
+        checkpoint: SyncCheckpoint | None = None,
+    ) -> list[EmailMessage]:
+        """
+        Returns the emails received after the checkpoint or, without it (or
+        when the UIDVALIDITY of the inbox changed), the unseen emails of the
+        last three weeks. The ids of the emails are their UIDs and the new
+        checkpoint is left in the checkpoint attribute
+        """
+        return self.fetch_emails(
+            self.search_unseen_emails(included_subjects, checkpoint)
         )
-        if status != 'OK':
-            raise UnableRetrieveEmailsException
-        for message_id in b_messages[0].split():
-            subject, message = self.get_decoded_message(message_id=message_id)
-            messages.append(EmailMessage(
-                id=message_id.decode('utf-8'),
-                message=message,
-                subject=subject
-            ))
+
+    def search_unseen_emails(
+        self,
+        included_subjects: list[str] | None = None,
+        checkpoint: SyncCheckpoint | None = None,
+    ) -> list[bytes]:
+        """
+        Returns the UIDs of the emails that get_unseen_emails returns. When
+        the included subjects are given, the server is asked only for the
+        emails with those subjects. If it can't search by subject, only the
+        subjects are downloaded first and just the UIDs of the emails that
+        match are returned
+        """
+        self.checkpoint = self._select_inbox()
+        after_uid = None
+        if checkpoint and \
+                checkpoint.uid_validity == self.checkpoint.uid_validity:
+            after_uid = checkpoint.last_uid
+            criteria = f'UID {after_uid + 1}:*'
+        else:
+            since = (datetime.now() - timedelta(weeks=3)).strftime("%d-%b-%Y")
+            criteria = f'UNSEEN SINCE {since}'
+        message_ids = None
+        if included_subjects:
+            message_ids = self._search_subjects(criteria, included_subjects)
+        subjects_searched = message_ids is not None
+        if message_ids is None:
+            status, b_messages = self._server.uid('SEARCH', f'({criteria})')
+            if status != 'OK':
+                raise UnableRetrieveEmailsException
+            message_ids = b_messages[0].split()
+        if after_uid is not None:
+            # n:* always matches the last email, even when its UID is lower
+            message_ids = [
+                message_id for message_id in message_ids
+                if int(message_id) > after_uid
+            ]
+        self.checkpoint.last_uid = max(
+            [self.checkpoint.last_uid, *map(int, message_ids)]
+        )
+        if included_subjects is not None and not subjects_searched:
+            message_ids = self._filter_by_subject(
+                message_ids, included_subjects
+            )
+        return message_ids
+
+    def fetch_emails(self, message_ids: list[bytes]) -> list[EmailMessage]:
+        """Downloads and decodes the emails of the UIDs, in the same order"""
+        bodies = self._fetch(message_ids, BODY_QUERY)
+        messages = [
+            decode_message(message_id.decode('utf-8'), bodies[message_id])
+            for message_id in message_ids
+            if message_id in bodies
+        ]
+        for message in messages:
+            # A UID is unique in the inbox while its UIDVALIDITY is the same
+            message.idempotency_key = message.idempotency_key or (
+                f'{self.inbox_name}:{self.checkpoint.uid_validity}:'
+                f'{message.id}'
+            )
         return messages
 
-    def get_decoded_message(self, message_id) -> tuple:
-        status, message = self._server.fetch(message_id, '(RFC822)')
-        encoding = 'utf-8'
-        message_content = ''
-        if status != 'OK':
-            raise UnableRetrieveSubjectException
+    def _search_subjects(
+        self, criteria: str, included_subjects: list[str]
+    ) -> list[bytes] | None:
+        """
+        Searches the emails with the included subjects in the server, so
+        only their UIDs are returned. Most servers reject 8-bit data in a
+        quoted string, so the ASCII subjects are searched together and each
+        of the others on its own, sent as a UTF-8 literal. Returns None
+        when the server rejects a query, so the emails can be filtered on
+        our side
+        """
+        ascii_subjects = [
+            subject for subject in included_subjects if subject.isascii()
+        ]
+        message_ids: set[bytes] = set()
         try:
-            email_bytes = message[0][1]
-            for parte in email.message_from_bytes(email_bytes).walk():
-                if parte.get_content_type() == 'text/html':
-                    message_content = parte.get_payload(decode=True)
-            subject = email.message_from_bytes(email_bytes)['Subject']
-            subject_to_decode, _ = decode_header(subject)[0]
-            message_content = message_content.decode('utf-8')
-        except Exception as ex:
-            logger.error(ex)
-            return (f'Unreadable subject message [{message_id}]', '')
-        subject_decoded = (
-            subject_to_decode
-            if type(subject_to_decode) is str
-            else subject_to_decode.decode(encoding)
+            if ascii_subjects:
+                status, b_messages = self._server.uid(
+                    'SEARCH', build_subject_search(criteria, ascii_subjects)
+                )
+                if status != 'OK':
+                    raise imaplib.IMAP4.error(b_messages)
+                message_ids.update(b_messages[0].split())
+            for subject in included_subjects:
+                if subject.isascii():
+                    continue
+                # imaplib sends the literal after the rest of the command
+                self._server.literal = subject.encode('utf-8')
+                status, b_messages = self._server.uid(
+                    'SEARCH', 'CHARSET', 'UTF-8', f'{criteria} SUBJECT'
+                )
+                if status != 'OK':
+                    raise imaplib.IMAP4.error(b_messages)
+                message_ids.update(b_messages[0].split())
+        except imaplib.IMAP4.error as ex:
+            logger.warning('Subject search rejected by the server: %s', ex)
+            return None
+        return sorted(message_ids, key=int)
+
+    def _filter_by_subject(
+        self, message_ids: list[bytes], included_subjects: list[str]
+    ) -> list[bytes]:
+        """
+        Downloads only the subjects of the emails and keeps the UIDs of the
+        ones that match the included subjects
+        """
+        subjects = self._fetch(message_ids, SUBJECT_QUERY)
+        matcher = utils.SubjectMatcher(included_subjects)
+        return [
+            message_id for message_id in message_ids
+            if matcher.matches(
+                decode_subject(email.message_from_bytes(
+                    subjects.get(message_id, b'')
+                )['Subject'])
+            )
+        ]
+
+    def get_decoded_message(self, message_id) -> tuple:
+        message = decode_message(
+            message_id.decode('utf-8'),
+            self._fetch([message_id], BODY_QUERY).get(message_id, b'')
         )
-        return subject_decoded, message_content
+        return message.subject, message.message
+
+    def _fetch(self, message_ids: list[bytes], query: str) -> dict:
+        """
+        Fetches the messages in batches of fetch_batch_size ids, using
+        several connections at the same time when configured. Returns the
+        fetched content by message id
+        """
+        batches = [
+            message_ids[index:index + self.fetch_batch_size]
+            for index in range(0, len(message_ids), self.fetch_batch_size)
+        ]
+        workers = min(self.connections, len(batches))
+        if workers <= 1:
+            return self._fetch_batches(self._server, batches, query)
+        fetched: dict = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(
+                self._fetch_batches,
+                self._worker_connections(workers),
+                [batches[index::workers] for index in range(workers)],
+                repeat(query),
+            ):
+                fetched.update(result)
+        return fetched
+
+    def _worker_connections(self, count: int) -> list[imaplib.IMAP4_SSL]:
+        """
+        Returns count connections for the fetch workers, opening only the
+        missing ones. imaplib connections can't be shared between threads,
+        so every worker has its own, kept open until logout so a sync logs
+        in once per worker instead of once per batch
+        """
+        while len(self._workers) < count:
+            server = self._connect()
+            server.select(self.inbox_name, readonly=True)
+            self._workers.append(server)
+        return self._workers[:count]
+
+    @staticmethod
+    def _fetch_batches(server, batches: list, query: str) -> dict:
+        fetched = {}
+        for batch in batches:
+            status, response = server.uid('FETCH', b','.join(batch), query)
+            if status != 'OK':
+                raise UnableRetrieveSubjectException
+            # Every message comes as a
+            # (b'<seq> (UID <uid> <item> {<size>}', content) tuple followed
+            # by a closing b')', which holds the UID when the server sends
+            # it after the content
+            for index, part in enumerate(response):
+                if not isinstance(part, tuple):
+                    continue
+                match = FETCH_RESPONSE_UID.search(part[0])
+                if not match and index + 1 < len(response) and \
+                        isinstance(response[index + 1], bytes):
+                    match = FETCH_RESPONSE_UID.search(response[index + 1])
+                if match:
+                    fetched[match.group(1)] = part[1]
+        return fetched
 
     def mark_as_read(self, message_id: str):
         # Set up readonly flag to False to mark as read the emails that are
         # fetched
         self._server.select(self.inbox_name, readonly=False)
-        self._server.fetch(message_id, '(RFC822)')
+        self._server.uid('FETCH', message_id, '(RFC822)')
+
+
+class AsyncOutlookEmail:
+    """
+    Async variant of OutlookEmail. The blocking IMAP commands run in a
+    thread and the emails are yielded as each batch is downloaded, so the
+    next stages can work while the rest are still being fetched
+    """
+
+    def __init__(self, outlook_email: OutlookEmail):
+        self._outlook_email = outlook_email
+
+    @property
+    def checkpoint(self) -> SyncCheckpoint | None:
+        return self._outlook_email.checkpoint
+
+    async def login(self):
+        await asyncio.to_thread(self._outlook_email.login)
+
+    async def logout(self):
+        await asyncio.to_thread(self._outlook_email.logout)
+
+    async def get_unseen_emails(
+        self,
+        included_subjects: list[str] | None = None,
+        checkpoint: SyncCheckpoint | None = None,
+    ) -> AsyncIterator[EmailMessage]:
+        message_ids = await asyncio.to_thread(
+            self._outlook_email.search_unseen_emails,
+            included_subjects,
+            checkpoint,
+        )
+        async for message in self._fetch_emails(message_ids):
+            yield message
+
+    async def get_emails(
+        self, message_ids: list[str]
+    ) -> AsyncIterator[EmailMessage]:
+        """Fetches the emails with the given UIDs that still exist"""
+        async for message in self._fetch_emails(
+            [message_id.encode('utf-8') for message_id in message_ids]
+        ):
+            yield message
+
+    async def _fetch_emails(
+        self, message_ids: list[bytes]
+    ) -> AsyncIterator[EmailMessage]:
+        batch_size = (
+            self._outlook_email.fetch_batch_size
+            * self._outlook_email.connections
+        )
+        for batch in batched(message_ids, batch_size):
+            for message in await asyncio.to_thread(
+                self._outlook_email.fetch_emails, list(batch)
+            ):
+                yield message
+
+    async def mark_as_read(self, message_id: str):
+        await asyncio.to_thread(self._outlook_email.mark_as_read, message_id)
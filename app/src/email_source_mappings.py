@@ -4,6 +4,7 @@ from .exceptions import CleaningFunctionNotImplementedException
 from .cleaning_functions import (
     get_bancolombia_pse_expense, get_itau_cc_expense
 )
+from .utils import SubjectMatcher
 
 
 maps = {
@@ -19,18 +20,34 @@ maps = {
 }
 
 
+# Compiled once from maps, it finds the source of a subject in one pass
+subject_matcher = SubjectMatcher({
+    subject: (source, val["function"])
+    for source, val in maps.items()
+    for subject in val["subjects"]
+})
+
+
 def get_all_subjects() -> list:
     return [subject for _, val in maps.items() for subject in val["subjects"]]
 
 
+def get_source(subject: str) -> tuple[str, Callable[[str], Expense]]:
+    """
+    Returns the key of the source in maps of the email subject and its
+    cleaning function. Subjects are matched ignoring case, like
+    utils.filter_messages does
+    """
+    source = subject_matcher.match(subject)
+    if source is None:
+        raise CleaningFunctionNotImplementedException
+    return source
+
+
 def get_cleaning_function(subject: str) -> Callable[[str], Expense]:
     """
     Function that receives an email subject and returns the function
     that can clean the email body of the email that contains that subject
     and that function will return the Expense
     """
-    for _, val in maps.items():
-        for filter_subject in val['subjects']:
-            if filter_subject in subject:
-                return val["function"]
-    raise CleaningFunctionNotImplementedException
+    return get_source(subject)[1]
@@ -20,3 +20,11 @@ class EmailSourceException(Exception):
 
 class CleaningFunctionNotImplementedException(Exception):
     pass
+
+
+class ExpensesTrackerAPIException(Exception):
+    pass
+
+
+class ExpensesTrackerAPIRejectedException(ExpensesTrackerAPIException):
+    pass
@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
 from typing import Optional
 from enum import Enum
@@ -20,6 +20,14 @@ class EmailMessage:
     id: str
     subject: str
     message: str
+    # Key that identifies the email even if it's fetched again
+    idempotency_key: str = ''
+
+
+@dataclass
+class SyncCheckpoint:
+    uid_validity: int
+    last_uid: int
 
 
 @dataclass
@@ -28,3 +36,20 @@ class Expense:
     description: str
     expense_source: ExpenseSource
     date_expense: Optional[datetime] = None
+    idempotency_key: Optional[str] = None
+
+
+@dataclass
+class ParseFailure:
+    email_id: str
+    subject: str
+    error: str
+
+
+@dataclass
+class PipelineReport:
+    emails: int = 0
+    expenses: int = 0
+    failures: list[ParseFailure] = field(default_factory=list)
+    # False when some expenses couldn't be saved to be sent
+    complete: bool = True
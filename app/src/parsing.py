@@ -0,0 +1,47 @@
+import logging
+from src.cleaning_functions import clean_expense
+from src.email_source_mappings import get_cleaning_function
+from src.models import EmailMessage, Expense, ParseFailure
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_email(email: EmailMessage) -> Expense | ParseFailure:
+    """
+    Cleans the html of the email and extracts its expense. The errors are
+    returned instead of raised, so one bad email doesn't stop the others
+    """
+    try:
+        expense = clean_expense(
+            email.message, get_cleaning_function(email.subject)
+        )
+    except Exception as ex:
+        return ParseFailure(
+            email_id=email.id,
+            subject=email.subject,
+            error=repr(ex),
+        )
+    expense.idempotency_key = email.idempotency_key
+    return expense
+
+
+def parse_emails(
+    emails: list[EmailMessage]
+) -> tuple[list[Expense], list[ParseFailure]]:
+    """
+    Parses the emails in the same order they come. The pipeline runs it in
+    its executor, once per chunk of emails. Returns the expenses and the
+    emails that couldn't be parsed
+    """
+    results = [parse_email(email) for email in emails]
+    expenses: list[Expense] = []
+    failures: list[ParseFailure] = []
+    for result in results:
+        if isinstance(result, ParseFailure):
+            logger.warning('Unable to parse email %s (%s): %s',
+                           result.email_id, result.subject, result.error)
+            failures.append(result)
+        else:
+            expenses.append(result)
+    return expenses, failures
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+from concurrent.futures import Executor
+from src.models import Expense, PipelineReport
+from src.parsing import parse_emails
+from src.protocols import AsyncEmailReceiver
+from src.sync_state import SyncState
+from src.target_consumers.expenses_tracker_api import ExpensesTrackerAPI
+from src.utils import SubjectMatcher
+
+
+logger = logging.getLogger(__name__)
+# Put in a queue after its last item
+DONE = None
+
+
+class EmailPipeline:
+    """
+    Runs the fetch, filter, parse and send stages at the same time,
+    connected by bounded queues, so a stage waits when the next one falls
+    behind and a run takes as long as its slowest stage. The parsing runs
+    in the executor (a process pool for several workers) in chunks of up
+    to chunk_size emails, to pay the pickling once per chunk, and the
+    expenses are sent in batches from a thread
+    """
+
+    def __init__(
+        self,
+        receiver: AsyncEmailReceiver,
+        consumer: ExpensesTrackerAPI,
+        sync_state: SyncState,
+        mailbox: str,
+        matcher: SubjectMatcher,
+        included_subjects: list[str] | None = None,
+        executor: Executor | None = None,
+        parse_workers: int = 1,
+        chunk_size: int = 20,
+        queue_size: int = 100,
+        send_batch_size: int = 100,
+    ):
+        self.receiver = receiver
+        self.consumer = consumer
+        self.sync_state = sync_state
+        self.mailbox = mailbox
+        self.matcher = matcher
+        self.included_subjects = included_subjects
+        self.executor = executor
+        self.parse_workers = parse_workers
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.send_batch_size = send_batch_size
+
+    async def run(self) -> PipelineReport:
+        """
+        Runs every stage until all the emails are sent. The checkpoint of
+        the mailbox is saved only when every expense was saved to be sent,
+        along with the emails that couldn't be parsed, which are fetched
+        again in the next run
+        """
+        report = PipelineReport()
+        emails: asyncio.Queue = asyncio.Queue(self.queue_size)
+        to_parse: asyncio.Queue = asyncio.Queue(self.queue_size)
+        to_send: asyncio.Queue = asyncio.Queue(self.queue_size)
+        async with asyncio.TaskGroup() as group:
+            group.create_task(self._fetch(emails, report))
+            group.create_task(self._filter(emails, to_parse))
+            for _ in range(self.parse_workers):
+                group.create_task(self._parse(to_parse, to_send, report))
+            group.create_task(self._send(to_send, report))
+        if report.complete:
+            checkpoint = self.receiver.checkpoint
+            self.sync_state.save_failed(
+                self.mailbox, checkpoint.uid_validity, report.failures
+            )
+            self.sync_state.save_checkpoint(self.mailbox, checkpoint)
+        logger.info('Pipeline finished: %s emails, %s expenses sent, '
+                    '%s failures', report.emails, report.expenses,
+                    len(report.failures))
+        return report
+
+    async def _fetch(self, emails: asyncio.Queue, report: PipelineReport):
+        await self.receiver.login()
+        try:
+            await self._fetch_emails(emails, report)
+        finally:
+            await self.receiver.logout()
+        await emails.put(DONE)
+
+    async def _fetch_emails(self, emails: asyncio.Queue,
+                            report: PipelineReport):
+        fetched = set()
+        async for email in self.receiver.get_unseen_emails(
+            self.included_subjects,
+            self.sync_state.get_checkpoint(self.mailbox),
+        ):
+            fetched.add(email.id)
+            report.emails += 1
+            await emails.put(email)
+        # The checkpoint is already past the emails that couldn't be parsed
+        # in the last runs, so they are fetched by their ids
+        failed_ids = [
+            message_id for message_id in self.sync_state.get_failed(
+                self.mailbox, self.receiver.checkpoint.uid_validity
+            )
+            if message_id not in fetched
+        ]
+        if failed_ids:
+            logger.info('Parsing again %s emails', len(failed_ids))
+            async for email in self.receiver.get_emails(failed_ids):
+                report.emails += 1
+                await emails.put(email)
+
+    async def _filter(self, emails: asyncio.Queue, to_parse: asyncio.Queue):
+        while (email := await emails.get()) is not DONE:
+            # The subjects that couldn't be decoded are filtered out
+            if not self.matcher.matches(email.subject):
+                continue
+            if self.sync_state.get_processed([email.idempotency_key]):
+                logger.info('Skipping already processed email %s', email.id)
+                continue
+            await to_parse.put(email)
+        for _ in range(self.parse_workers):
+            await to_parse.put(DONE)
+
+    async def _next_chunk(self, to_parse: asyncio.Queue) -> list:
+        """
+        Waits for the next email and takes the ones already queued after it,
+        up to chunk_size. The chunk ends with DONE when it was taken
+        """
+        chunk = [await to_parse.get()]
+        while chunk[-1] is not DONE and len(chunk) < self.chunk_size \
+                and not to_parse.empty():
+            chunk.append(to_parse.get_nowait())
+        return chunk
+
+    async def _parse(self, to_parse: asyncio.Queue, to_send: asyncio.Queue,
+                     report: PipelineReport):
+        loop = asyncio.get_running_loop()
+        done = False
+        while not done:
+            chunk = await self._next_chunk(to_parse)
+            done = chunk[-1] is DONE
+            emails = chunk[:-1] if done else chunk
+            if not emails:
+                continue
+            expenses, failures = await loop.run_in_executor(
+                self.executor, parse_emails, emails
+            )
+            report.failures.extend(failures)
+            for expense in expenses:
+                await to_send.put(expense)
+        await to_send.put(DONE)
+
+    async def _send(self, to_send: asyncio.Queue, report: PipelineReport):
+        running_parsers = self.parse_workers
+        batch: list[Expense] = []
+        while running_parsers:
+            expense = await to_send.get()
+            if expense is DONE:
+                running_parsers -= 1
+            else:
+                batch.append(expense)
+            if batch and (
+                len(batch) >= self.send_batch_size or not running_parsers
+            ):
+                await self._send_batch(batch, report)
+                batch = []
+
+    async def _send_batch(self, batch: list[Expense],
+                          report: PipelineReport):
+        if not await asyncio.to_thread(self.consumer.add_expense, batch):
+            report.complete = False
+            return
+        self.sync_state.mark_processed(
+            [expense.idempotency_key for expense in batch]
+        )
+        report.expenses += len(batch)
@@ -1,18 +1,60 @@
 from abc import abstractmethod
+from collections.abc import AsyncIterator
 from typing import Protocol
-from src.models import EmailMessage
+from src.models import EmailMessage, SyncCheckpoint
 
 
 class EmailReceiver(Protocol):
+    # Checkpoint reached by the last call to get_unseen_emails
+    checkpoint: SyncCheckpoint | None
 
     @abstractmethod
     def login(self):
         ...
 
     @abstractmethod
-    def get_unseen_emails(self) -> list[EmailMessage]:
+    def logout(self):
+        ...
+
+    @abstractmethod
+    def get_unseen_emails(
+        self,
+        included_subjects: list[str] | None = None,
+        checkpoint: SyncCheckpoint | None = None,
+    ) -> list[EmailMessage]:
         ...
 
     @abstractmethod
     def mark_as_read(self, message_id: str) -> str:
         ...
+
+
+class AsyncEmailReceiver(Protocol):
+    # Checkpoint reached by the last call to get_unseen_emails
+    checkpoint: SyncCheckpoint | None
+
+    @abstractmethod
+    async def login(self):
+        ...
+
+    @abstractmethod
+    async def logout(self):
+        ...
+
+    @abstractmethod
+    def get_unseen_emails(
+        self,
+        included_subjects: list[str] | None = None,
+        checkpoint: SyncCheckpoint | None = None,
+    ) -> AsyncIterator[EmailMessage]:
+        ...
+
+    @abstractmethod
+    def get_emails(
+        self, message_ids: list[str]
+    ) -> AsyncIterator[EmailMessage]:
+        ...
+
+    @abstractmethod
+    async def mark_as_read(self, message_id: str):
+        ...
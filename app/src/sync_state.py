@@ -0,0 +1,113 @@
+import sqlite3
+from itertools import batched
+from src.models import ParseFailure, SyncCheckpoint
+
+
+# SQLite allows up to 999 variables per statement in old versions
+MAX_VARIABLES = 500
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sync_checkpoint (
+    mailbox TEXT PRIMARY KEY,
+    uid_validity INTEGER NOT NULL,
+    last_uid INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS processed_message (
+    idempotency_key TEXT PRIMARY KEY,
+    processed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS failed_message (
+    mailbox TEXT NOT NULL,
+    uid_validity INTEGER NOT NULL,
+    message_id TEXT NOT NULL,
+    error TEXT NOT NULL,
+    PRIMARY KEY (mailbox, message_id)
+);
+'''
+
+
+class SyncState:
+    """
+    Keeps in a local SQLite file the checkpoint of every synced mailbox,
+    the idempotency keys of the emails already sent as expenses and the
+    emails that couldn't be parsed, so a run only fetches the new emails
+    and the failed ones, and never sends an expense twice
+    """
+
+    def __init__(self, path: str):
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def get_checkpoint(self, mailbox: str) -> SyncCheckpoint | None:
+        row = self._connection.execute(
+            'SELECT uid_validity, last_uid FROM sync_checkpoint '
+            'WHERE mailbox = ?',
+            (mailbox,)
+        ).fetchone()
+        return SyncCheckpoint(*row) if row else None
+
+    def save_checkpoint(self, mailbox: str, checkpoint: SyncCheckpoint):
+        with self._connection:
+            self._connection.execute(
+                'INSERT INTO sync_checkpoint (mailbox, uid_validity, last_uid)'
+                ' VALUES (?, ?, ?) ON CONFLICT (mailbox) DO UPDATE SET '
+                'uid_validity = excluded.uid_validity, '
+                'last_uid = excluded.last_uid',
+                (mailbox, checkpoint.uid_validity, checkpoint.last_uid)
+            )
+
+    def get_processed(self, idempotency_keys: list[str]) -> set[str]:
+        """Returns the given keys that were already processed"""
+        processed = set()
+        for keys in batched(idempotency_keys, MAX_VARIABLES):
+            processed.update(key for key, in self._connection.execute(
+                'SELECT idempotency_key FROM processed_message '
+                f'WHERE idempotency_key IN ({", ".join("?" * len(keys))})',
+                keys
+            ))
+        return processed
+
+    def mark_processed(self, idempotency_keys: list[str]):
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO processed_message (idempotency_key) '
+                'VALUES (?)',
+                [(key,) for key in idempotency_keys]
+            )
+
+    def get_failed(self, mailbox: str, uid_validity: int) -> list[str]:
+        """
+        Returns the ids of the emails of the mailbox that couldn't be parsed.
+        The ids saved with another UIDVALIDITY point to other emails, so
+        they aren't returned
+        """
+        return [message_id for message_id, in self._connection.execute(
+            'SELECT message_id FROM failed_message '
+            'WHERE mailbox = ? AND uid_validity = ? ORDER BY rowid',
+            (mailbox, uid_validity)
+        )]
+
+    def save_failed(self, mailbox: str, uid_validity: int,
+                    failures: list[ParseFailure]):
+        """Replaces the emails of the mailbox that couldn't be parsed"""
+        with self._connection:
+            self._connection.execute(
+                'DELETE FROM failed_message WHERE mailbox = ?', (mailbox,)
+            )
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO failed_message '
+                '(mailbox, uid_validity, message_id, error) '
+                'VALUES (?, ?, ?, ?)',
+                [
+                    (mailbox, uid_validity, failure.email_id, failure.error)
+                    for failure in failures
+                ]
+            )
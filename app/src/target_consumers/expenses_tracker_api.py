@@ -1,15 +1,215 @@
+import json
 import logging
+import sqlite3
+import time
+import uuid
+from itertools import batched
+import httpx
+from ..exceptions import (
+    ExpensesTrackerAPIException,
+    ExpensesTrackerAPIRejectedException,
+)
 from ..models import Expense
 
 
 logger = logging.getLogger(__name__)
+BULK_PATH = '/expenses/bulk'
+EXPENSE_SOURCE = 'Email'
+# Responses worth sending the same batch again
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# Responses that every batch would get, so the rest isn't sent either
+AUTH_STATUS_CODES = {401, 403}
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    -- Detail of the API when it rejected the expense, which isn't sent again
+    rejected_detail TEXT
+);
+'''
+
+
+def expense_payload(expense: Expense, idempotency_key: str) -> dict:
+    # The API doesn't create again the expenses with a key already sent, so
+    # a batch can be sent again safely
+    payload = {
+        'description': expense.description,
+        'val_expense': expense.expense_value,
+        'source': EXPENSE_SOURCE,
+        'idempotency_key': idempotency_key,
+    }
+    if expense.date_expense:
+        payload['date_expense'] = expense.date_expense.isoformat()
+    return payload
 
 
 class ExpensesTrackerAPI:
+    """
+    Sends the expenses to the bulk endpoint of the Expenses Tracker API.
+    The expenses are saved first in a local SQLite outbox and removed from
+    it only when the API creates them, so an outage or a crash never loses
+    them. Every expense is sent with its idempotency key, so the API never
+    creates it twice. The same keep-alive HTTP client is used for every
+    request
+    """
+
+    def __init__(
+        self,
+        base_url: str = '',
+        token: str = '',
+        outbox_path: str = 'outbox.db',
+        batch_size: int = 100,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 10,
+        transport: httpx.BaseTransport | None = None,
+    ):
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._client = httpx.Client(
+            base_url=base_url,
+            headers={'Authorization': f'Bearer {token}'},
+            timeout=timeout,
+            transport=transport,
+        )
+        # The async pipeline sends the batches from a worker thread, one at
+        # a time
+        self._outbox = sqlite3.connect(outbox_path, check_same_thread=False)
+        self._outbox.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._client.close()
+        self._outbox.close()
 
     def login(self):
         ...
 
     def add_expense(self, expenses: list[Expense]) -> bool:
+        """
+        Saves the expenses in the outbox and sends every pending expense of
+        the outbox. Returns True once the expenses are safe in the outbox,
+        even if the API couldn't take them yet, as they are sent again in
+        the next run
+        """
         logger.info("Expenses to send %s", expenses)
+        try:
+            self.enqueue(expenses)
+        except sqlite3.Error as ex:
+            logger.error('Unable to save the expenses in the outbox: %s', ex)
+            return False
+        try:
+            self.flush()
+        except (ExpensesTrackerAPIException, httpx.HTTPError) as ex:
+            logger.error('Unable to send the expenses: %s', ex)
         return True
+
+    def enqueue(self, expenses: list[Expense]):
+        rows = []
+        for expense in expenses:
+            idempotency_key = expense.idempotency_key or str(uuid.uuid4())
+            rows.append((
+                idempotency_key,
+                json.dumps(expense_payload(expense, idempotency_key)),
+            ))
+        with self._outbox:
+            self._outbox.executemany(
+                'INSERT OR IGNORE INTO outbox (idempotency_key, payload) '
+                'VALUES (?, ?)',
+                rows
+            )
+
+    def pending(self) -> list[tuple[int, dict]]:
+        return [
+            (outbox_id, json.loads(payload))
+            for outbox_id, payload in self._outbox.execute(
+                'SELECT id, payload FROM outbox '
+                'WHERE rejected_detail IS NULL ORDER BY id'
+            )
+        ]
+
+    def flush(self) -> int:
+        """
+        Sends the pending expenses of the outbox in batches of batch_size.
+        Returns the number of expenses created
+        """
+        return sum(
+            self._send_batch(list(batch))
+            for batch in batched(self.pending(), self.batch_size)
+        )
+
+    def _send_batch(self, batch: list[tuple[int, dict]]) -> int:
+        """
+        Sends a batch and removes its created expenses from the outbox. A
+        batch rejected as a whole is split in halves and sent again until
+        its invalid expenses are found, so they are marked as rejected
+        instead of keeping the next expenses in the outbox forever
+        """
+        try:
+            results = self._post_batch([payload for _, payload in batch])
+        except ExpensesTrackerAPIRejectedException as ex:
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                return (self._send_batch(batch[:middle])
+                        + self._send_batch(batch[middle:]))
+            results = [{'detail': str(ex)}]
+        sent_ids = []
+        rejected = []
+        for (outbox_id, _), result in zip(batch, results):
+            if result.get('detail'):
+                logger.warning('Expense %s rejected by the API: %s',
+                               outbox_id, result['detail'])
+                rejected.append((result['detail'], outbox_id))
+            else:
+                sent_ids.append((outbox_id,))
+        with self._outbox:
+            self._outbox.executemany(
+                'DELETE FROM outbox WHERE id = ?', sent_ids
+            )
+            self._outbox.executemany(
+                'UPDATE outbox SET rejected_detail = ? WHERE id = ?',
+                rejected
+            )
+        return len(sent_ids)
+
+    def _post_batch(self, payloads: list[dict]) -> list[dict]:
+        """
+        Posts a batch of expenses, retrying with exponential backoff when
+        the API can't be reached or is temporarily unavailable. Retrying is
+        safe even if the API created the batch, as the idempotency keys of
+        the expenses are sent. Returns the result of each expense, or raises
+        ExpensesTrackerAPIRejectedException when the API rejects the batch
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self._client.post(BULK_PATH, json=payloads)
+            except httpx.TransportError as ex:
+                error = repr(ex)
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    break
+                error = f'{response.status_code} {response.text}'
+            if attempt == self.max_retries:
+                raise ExpensesTrackerAPIException(error)
+            delay = self.backoff * 2 ** attempt
+            logger.warning('Error sending expenses (%s), retrying in %ss',
+                           error, delay)
+            time.sleep(delay)
+        if response.is_client_error \
+                and response.status_code not in AUTH_STATUS_CODES:
+            raise ExpensesTrackerAPIRejectedException(
+                f'{response.status_code} {response.text}'
+            )
+        if response.is_error:
+            raise ExpensesTrackerAPIException(
+                f'{response.status_code} {response.text}'
+            )
+        return sorted(response.json()['results'],
+                      key=lambda result: result['index'])
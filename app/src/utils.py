@@ -1,4 +1,6 @@
 import re
+from collections.abc import Iterable, Mapping
+from typing import Any
 from src.models import EmailMessage
 
 
@@ -8,14 +10,46 @@ def remove_spaces(str_to_clean: str) -> str:
     return " ".join(cleaner_str.split())
 
 
-def filter_messages(messages: list[EmailMessage],
-                    included_subjects: list[str]) -> list[EmailMessage]:
-    filtered_messages: list[EmailMessage] = []
-    # We could simplify this nested loop with list comprenhensions and the
-    # any function, but this is more readable
-    for message in messages:
-        for included_subject in included_subjects:
-            if included_subject.lower() in message.subject.lower():
-                filtered_messages.append(message)
-                break
-    return filtered_messages
+class SubjectMatcher:
+    """
+    Finds which of the included subjects a subject contains, ignoring case,
+    with a single regex compiled once, so a subject is scanned only once no
+    matter how many subjects are included. The included subjects can be a
+    mapping to the value returned when they match
+    """
+
+    def __init__(self, included_subjects: Iterable[str] | Mapping[str, Any]):
+        if not isinstance(included_subjects, Mapping):
+            included_subjects = {
+                subject: subject for subject in included_subjects
+            }
+        self._values: dict[str, Any] = {}
+        for subject, value in included_subjects.items():
+            self._values.setdefault(subject.lower(), value)
+        # The longest subjects go first, so they win over their prefixes
+        self._pattern = re.compile('|'.join(
+            re.escape(subject)
+            for subject in sorted(self._values, key=len, reverse=True)
+        ), re.IGNORECASE) if self._values else None
+
+    def match(self, subject: str) -> Any | None:
+        """Returns the value of the included subject found in the subject"""
+        if self._pattern is None:
+            return None
+        found = self._pattern.search(subject)
+        return self._values.get(found.group().lower()) if found else None
+
+    def matches(self, subject: str) -> bool:
+        return self.match(subject) is not None
+
+
+def filter_messages(
+    messages: list[EmailMessage],
+    included_subjects: list[str] | SubjectMatcher,
+) -> list[EmailMessage]:
+    matcher = included_subjects
+    if not isinstance(matcher, SubjectMatcher):
+        matcher = SubjectMatcher(included_subjects)
+    return [
+        message for message in messages if matcher.matches(message.subject)
+    ]
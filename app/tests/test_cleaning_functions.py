@@ -2,8 +2,11 @@ import re
 import pytest
 import src.exceptions as exceptions
 import tests.mocks.email_mocks as mocks
+from unittest import mock
+from src import cleaning_functions
 from src.cleaning_functions import (
-    get_clean_html_body, get_itau_cc_expense, get_bancolombia_pse_expense
+    get_clean_html_body, get_itau_cc_expense, get_bancolombia_pse_expense,
+    clean_expense
 )
 from src.models import Expense, ExpenseSource
 from datetime import datetime
@@ -133,3 +136,29 @@ def test_bancolombia_pse_incomplete_structure():
     """
     with pytest.raises(exceptions.UnableGetExpenseException):
         get_bancolombia_pse_expense(mocks.BANCOLOMBIA_PSE_INCOMPLETE_DATA)
+
+
+@pytest.mark.parametrize("raw_message, cleaning_function", [
+    (mocks.ITAU_GOOD_TABLE_STRUCTURE, get_itau_cc_expense),
+    ('<html><body>' + mocks.BANCOLOMBIA_PSE_GOOD + '</body></html>',
+     get_bancolombia_pse_expense),
+])
+def test_clean_expense_parses_once(raw_message, cleaning_function):
+    """
+    Test that the email is parsed only once and the cleaning function gets
+    the same expense that it gets from the html string
+    """
+    expected = cleaning_function(get_clean_html_body(raw_message))
+    with mock.patch.object(cleaning_functions, 'BeautifulSoup',
+                           wraps=cleaning_functions.BeautifulSoup) as soup:
+        assert clean_expense(raw_message, cleaning_function) == expected
+    assert soup.call_count == 1
+
+
+def test_clean_expense_missing_body():
+    """
+    Test that the body is still required when the html is parsed only for
+    the tags the cleaning function needs
+    """
+    with pytest.raises(exceptions.UnableGetBodyMessageException):
+        clean_expense(mocks.MISSING_HTML_BODY_EMAIL, get_itau_cc_expense)
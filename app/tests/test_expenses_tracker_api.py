@@ -0,0 +1,154 @@
+import json
+import httpx
+import pytest
+from datetime import datetime
+from src.models import Expense, ExpenseSource
+from src.target_consumers.expenses_tracker_api import ExpensesTrackerAPI
+
+
+class FakeAPI:
+    """
+    In process stand-in of the bulk endpoint of the Expenses Tracker API,
+    that can fail the first requests it receives and rejects the whole
+    batches with an expense of reject_value
+    """
+
+    def __init__(self, failures: int = 0, status_code: int = 503,
+                 fail_after_create: bool = False,
+                 reject_value: float | None = None):
+        self.failures = failures
+        self.reject_value = reject_value
+        self.status_code = status_code
+        # Creates the expenses before failing, like a timeout after commit
+        self.fail_after_create = fail_after_create
+        self.requests: list = []
+        self.expenses: list = []
+        self.keys: dict = {}
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        payloads = json.loads(request.content)
+        self.requests.append((request.headers['Authorization'], payloads))
+        if self.failures and not self.fail_after_create:
+            self.failures -= 1
+            return httpx.Response(self.status_code, json={'detail': 'Down'})
+        if any(p['val_expense'] == self.reject_value for p in payloads):
+            return httpx.Response(422, json={'detail': 'Invalid payload'})
+        results = []
+        for index, payload in enumerate(payloads):
+            if payload['val_expense'] <= 0:
+                results.append({'index': index, 'detail': 'Invalid value'})
+                continue
+            if payload['idempotency_key'] not in self.keys:
+                self.expenses.append(payload)
+                self.keys[payload['idempotency_key']] = len(self.expenses)
+            results.append({
+                'index': index, 'id': self.keys[payload['idempotency_key']]
+            })
+        if self.failures:
+            self.failures -= 1
+            return httpx.Response(self.status_code, json={'detail': 'Down'})
+        return httpx.Response(200, json={
+            'created': len([r for r in results if 'id' in r]),
+            'failed': len([r for r in results if 'detail' in r]),
+            'results': results,
+        })
+
+
+def build_expenses(count: int) -> list[Expense]:
+    return [
+        Expense(
+            expense_value=index,
+            description=f'Expense {index}',
+            expense_source=ExpenseSource.ITAU_CR,
+            date_expense=datetime(2024, 1, 1, 10, 0, 0),
+            idempotency_key=f'<{index}@itau>',
+        )
+        for index in range(count)
+    ]
+
+
+def build_consumer(api: FakeAPI, tmp_path, **kwargs) -> ExpensesTrackerAPI:
+    return ExpensesTrackerAPI(
+        'http://api.test', 'token', str(tmp_path / 'outbox.db'),
+        backoff=0, transport=httpx.MockTransport(api), **kwargs
+    )
+
+
+def test_add_expense_sends_in_batches(tmp_path):
+    api = FakeAPI()
+    with build_consumer(api, tmp_path, batch_size=2) as consumer:
+        assert consumer.add_expense(build_expenses(5))
+        # Expense 0 is rejected, so it isn't sent again
+        assert consumer.pending() == []
+        assert consumer.flush() == 0
+    assert [len(payloads) for _, payloads in api.requests] == [2, 2, 1]
+    assert api.requests[0][0] == 'Bearer token'
+    assert [expense['description'] for expense in api.expenses] == [
+        'Expense 1', 'Expense 2', 'Expense 3', 'Expense 4'
+    ]
+    assert api.expenses[0] == {
+        'description': 'Expense 1',
+        'val_expense': 1,
+        'source': 'Email',
+        'idempotency_key': '<1@itau>',
+        'date_expense': '2024-01-01T10:00:00',
+    }
+
+
+def test_add_expense_retries_after_created(tmp_path):
+    """
+    Test that a batch created by the API before it failed is sent again
+    without creating its expenses twice
+    """
+    api = FakeAPI(failures=1, fail_after_create=True)
+    with build_consumer(api, tmp_path) as consumer:
+        assert consumer.add_expense(build_expenses(3)[1:])
+        assert consumer.pending() == []
+    assert len(api.requests) == 2
+    assert len(api.expenses) == 2
+
+
+def test_add_expense_retries(tmp_path):
+    api = FakeAPI(failures=2)
+    with build_consumer(api, tmp_path, max_retries=2) as consumer:
+        assert consumer.add_expense(build_expenses(3)[1:])
+        assert consumer.pending() == []
+    assert len(api.requests) == 3
+    assert len(api.expenses) == 2
+
+
+def test_add_expense_isolates_rejected_batch(tmp_path):
+    """
+    Test that a batch rejected as a whole doesn't keep the next batches in
+    the outbox, and only its invalid expense is marked as rejected
+    """
+    api = FakeAPI(reject_value=2)
+    with build_consumer(api, tmp_path, batch_size=4) as consumer:
+        assert consumer.add_expense(build_expenses(9)[1:])
+        assert consumer.pending() == []
+        rejected = consumer._outbox.execute(
+            'SELECT idempotency_key, rejected_detail FROM outbox'
+        ).fetchall()
+    assert [key for key, _ in rejected] == ['<2@itau>']
+    assert rejected[0][1].startswith('422 ')
+    assert [len(payloads) for _, payloads in api.requests] == [
+        4, 2, 1, 1, 2, 4
+    ]
+    assert [expense['val_expense'] for expense in api.expenses] == [
+        1, 3, 4, 5, 6, 7, 8
+    ]
+
+
+@pytest.mark.parametrize("status_code", [503, 401])
+def test_add_expense_keeps_expenses_in_outbox(tmp_path, status_code):
+    api = FakeAPI(failures=10, status_code=status_code)
+    with build_consumer(api, tmp_path, max_retries=1) as consumer:
+        assert consumer.add_expense(build_expenses(3)[1:])
+        assert len(consumer.pending()) == 2
+    assert len(api.requests) == (2 if status_code == 503 else 1)
+    # The next run sends the expenses left in the outbox
+    api.failures = 0
+    with build_consumer(api, tmp_path) as consumer:
+        assert consumer.flush() == 2
+        assert consumer.pending() == []
+    assert len(api.expenses) == 2
@@ -3,13 +3,14 @@ from src.cleaning_functions import (
     get_bancolombia_pse_expense, get_itau_cc_expense
 )
 from src.exceptions import CleaningFunctionNotImplementedException
-from src.email_source_mappings import get_cleaning_function
+from src.email_source_mappings import get_cleaning_function, get_source
 
 
 @pytest.mark.parametrize("subject, expected_function", [
     ("Confirmación Transacción PSE", get_bancolombia_pse_expense),
     ("PSE Transacción Aprobada", get_bancolombia_pse_expense),
     ("Notificaciones Itau", get_itau_cc_expense),
+    ("RE: notificaciones ITAU", get_itau_cc_expense),
 ])
 def test_get_cleaning_function(subject, expected_function):
     """
@@ -25,3 +26,12 @@ def test_get_cleaning_function_not_implemented():
     """
     with pytest.raises(CleaningFunctionNotImplementedException):
         get_cleaning_function("Subject no implemented")
+
+
+def test_get_source():
+    """
+    Test that the function returns the key of the source with its function
+    """
+    assert get_source("Fwd: PSE Transacción Aprobada") == (
+        "bancolombia_pse", get_bancolombia_pse_expense
+    )
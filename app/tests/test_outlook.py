@@ -0,0 +1,287 @@
+import asyncio
+import email
+import imaplib
+import re
+import pytest
+from email.message import EmailMessage as RawEmail
+from unittest import mock
+from src.email_providers import outlook_email
+from src.email_providers.outlook_email import (
+    AsyncOutlookEmail, OutlookEmail, build_subject_search, decode_message,
+    decode_subject
+)
+from src.exceptions import UnableRetrieveEmailsException
+from src.models import SyncCheckpoint
+
+
+def build_email(subject: str, html: str = '<html><body>Hi</body></html>',
+                message_id: str | None = None):
+    raw_email = RawEmail()
+    raw_email['Subject'] = subject
+    if message_id:
+        raw_email['Message-ID'] = message_id
+    raw_email.set_content(html, subtype='html')
+    return raw_email.as_bytes()
+
+
+class FakeIMAP:
+    """
+    In memory IMAP server that records the commands it receives. Like most
+    servers, it rejects 8-bit data in quoted strings
+    """
+
+    def __init__(self, emails: dict, search_status: str = 'OK',
+                 subject_search: bool = True, uid_validity: int = 1):
+        self.emails = emails
+        self.uid_validity = uid_validity
+        self.search_status = search_status
+        self.subject_search = subject_search
+        self.searches: list = []
+        self.fetches: list = []
+        self.literal: bytes | None = None
+        self.logouts = 0
+
+    def login(self, user, password):
+        return 'OK', []
+
+    def logout(self):
+        self.logouts += 1
+        return 'BYE', []
+
+    def select(self, inbox_name, readonly=False):
+        return 'OK', [str(len(self.emails)).encode()]
+
+    def response(self, code):
+        if code == 'UIDVALIDITY':
+            return code, [str(self.uid_validity).encode()]
+        return code, [str(max(map(int, self.emails), default=0) + 1).encode()]
+
+    def uid(self, command, *args):
+        return getattr(self, f'_uid_{command.lower()}')(*args)
+
+    def _uid_search(self, *args):
+        criteria = args[-1]
+        literal, self.literal = self.literal, None
+        self.searches.append(
+            (args[1] if len(args) == 3 else None, criteria, literal)
+        )
+        if isinstance(criteria, str):
+            criteria = criteria.encode()
+        if not criteria.isascii():
+            raise imaplib.IMAP4.error('SEARCH command error: BAD')
+        message_ids = list(self.emails)
+        uid_range = re.search(rb'UID (\d+):\*', criteria)
+        if uid_range:
+            # Like real servers, n:* includes the last UID even if it's lower
+            message_ids = [
+                message_id for message_id in message_ids
+                if int(message_id) >= int(uid_range.group(1))
+            ] or message_ids[-1:]
+        subjects = re.findall(rb'SUBJECT "([^"]*)"', criteria)
+        if literal is not None:
+            subjects.append(literal)
+        if not subjects:
+            return self.search_status, [b' '.join(message_ids)]
+        if not self.subject_search:
+            raise imaplib.IMAP4.error('SEARCH command error: BAD')
+        message_ids = [
+            message_id for message_id in message_ids
+            if any(
+                subject.decode().lower() in decode_subject(
+                    email.message_from_bytes(
+                        self.emails[message_id]
+                    )['Subject']
+                ).lower()
+                for subject in subjects
+            )
+        ]
+        return 'OK', [b' '.join(message_ids)]
+
+    def _uid_fetch(self, message_set, query):
+        message_ids = message_set.split(b',')
+        self.fetches.append((message_ids, query))
+        sequence = {message_id: index for index, message_id in enumerate(
+            self.emails, start=1
+        )}
+        response = []
+        for message_id in message_ids:
+            # The deleted emails aren't in the response
+            if message_id not in self.emails:
+                continue
+            content = self.emails[message_id]
+            if 'HEADER.FIELDS' in query:
+                content = content.split(b'\n\n')[0] + b'\r\n\r\n'
+                # Some servers send the UID after the content
+                response.append((
+                    b'%d (BODY[HEADER] {%d}' % (
+                        sequence[message_id], len(content)
+                    ),
+                    content
+                ))
+                response.append(b' UID ' + message_id + b')')
+                continue
+            response.append((
+                b'%d (UID %s BODY[] {%d}' % (
+                    sequence[message_id], message_id, len(content)
+                ),
+                content
+            ))
+            response.append(b')')
+        return 'OK', response
+
+
+@pytest.fixture
+def emails():
+    return {
+        b'1': build_email('Notificaciones Itau'),
+        b'2': build_email('Newsletter'),
+        b'3': build_email('PSE Transacción Aprobada'),
+        b'4': build_email('Notificaciones Itau'),
+    }
+
+
+def connect(server, **kwargs) -> OutlookEmail:
+    outlook = OutlookEmail('user', 'token', 'inbox', **kwargs)
+    with mock.patch.object(outlook_email.imaplib, 'IMAP4_SSL',
+                           return_value=server):
+        outlook.login()
+    return outlook
+
+
+def test_get_unseen_emails_batched(emails):
+    server = FakeIMAP(emails)
+    outlook = connect(server, fetch_batch_size=3)
+    messages = outlook.get_unseen_emails()
+    assert [message.id for message in messages] == ['1', '2', '3', '4']
+    assert messages[2].subject == 'PSE Transacción Aprobada'
+    assert '<body>Hi</body>' in messages[2].message
+    assert [len(message_ids) for message_ids, _ in server.fetches] == [3, 1]
+
+
+def test_get_unseen_emails_searches_subjects_in_server(emails):
+    server = FakeIMAP(emails)
+    outlook = connect(server)
+    messages = outlook.get_unseen_emails(
+        ['notificaciones itau', 'PSE Transacción']
+    )
+    assert [message.id for message in messages] == ['1', '3', '4']
+    # The non-ASCII subject is sent as a literal in its own search
+    assert [(charset, literal) for charset, _, literal in server.searches] \
+        == [(None, None), ('UTF-8', 'PSE Transacción'.encode())]
+    assert server.searches[0][1].endswith(b'SUBJECT "notificaciones itau")')
+    assert server.searches[1][1].endswith(' SUBJECT')
+    # Only the bodies of the emails found are downloaded
+    assert server.fetches == [([b'1', b'3', b'4'], outlook_email.BODY_QUERY)]
+
+
+def test_get_unseen_emails_filters_subjects_when_search_rejected(emails):
+    server = FakeIMAP(emails, subject_search=False)
+    outlook = connect(server)
+    messages = outlook.get_unseen_emails(['notificaciones itau'])
+    assert [message.id for message in messages] == ['1', '4']
+    body_fetches = [
+        message_ids for message_ids, query in server.fetches
+        if query == outlook_email.BODY_QUERY
+    ]
+    assert body_fetches == [[b'1', b'4']]
+
+
+def test_build_subject_search():
+    criteria = build_subject_search(
+        'UNSEEN SINCE 01-Jan-2024', ['A', 'B "C"', 'D']
+    )
+    assert criteria == (
+        b'(UNSEEN SINCE 01-Jan-2024 OR SUBJECT "A" '
+        b'OR SUBJECT "B \\"C\\"" SUBJECT "D")'
+    )
+
+
+def test_get_unseen_emails_parallel_connections(emails):
+    server = FakeIMAP(emails)
+    outlook = connect(server, fetch_batch_size=1, connections=2)
+    with mock.patch.object(outlook_email.imaplib, 'IMAP4_SSL',
+                           return_value=server) as imap:
+        messages = outlook.get_unseen_emails()
+        assert len(outlook.get_unseen_emails()) == 4
+    # The connections of the workers are opened once and reused
+    assert imap.call_count == 2
+    assert [message.id for message in messages] == ['1', '2', '3', '4']
+    outlook.logout()
+    assert server.logouts == 3
+
+
+def test_get_unseen_emails_after_checkpoint(emails):
+    emails[b'7'] = build_email('Notificaciones Itau', message_id='<a@b>')
+    server = FakeIMAP(emails, uid_validity=9)
+    outlook = connect(server)
+    messages = outlook.get_unseen_emails(
+        ['Notificaciones Itau'], SyncCheckpoint(uid_validity=9, last_uid=3)
+    )
+    assert [message.id for message in messages] == ['4', '7']
+    assert [message.idempotency_key for message in messages] == [
+        'inbox:9:4', '<a@b>'
+    ]
+    assert outlook.checkpoint == SyncCheckpoint(uid_validity=9, last_uid=7)
+    # Nothing new since the last run
+    assert outlook.get_unseen_emails(
+        ['Notificaciones Itau'], outlook.checkpoint
+    ) == []
+    assert outlook.checkpoint.last_uid == 7
+
+
+def test_get_unseen_emails_checkpoint_with_other_uid_validity(emails):
+    server = FakeIMAP(emails, uid_validity=2)
+    outlook = connect(server)
+    messages = outlook.get_unseen_emails(
+        checkpoint=SyncCheckpoint(uid_validity=1, last_uid=3)
+    )
+    assert [message.id for message in messages] == ['1', '2', '3', '4']
+    assert b'UNSEEN SINCE' in server.searches[0][1].encode()
+    assert outlook.checkpoint == SyncCheckpoint(uid_validity=2, last_uid=4)
+
+
+def test_async_get_unseen_emails_by_batches(emails):
+    server = FakeIMAP(emails)
+    outlook = AsyncOutlookEmail(connect(server, fetch_batch_size=3))
+
+    async def get_ids():
+        return [
+            message.id
+            async for message in outlook.get_unseen_emails(
+                ['Notificaciones Itau']
+            )
+        ]
+
+    assert asyncio.run(get_ids()) == ['1', '4']
+    assert outlook.checkpoint == SyncCheckpoint(uid_validity=1, last_uid=4)
+    assert server.fetches == [([b'1', b'4'], outlook_email.BODY_QUERY)]
+
+
+def test_async_get_emails(emails):
+    server = FakeIMAP(emails)
+    outlook = AsyncOutlookEmail(connect(server))
+    # Like in the pipeline, the inbox is selected by the search first
+    outlook._outlook_email.search_unseen_emails()
+
+    async def get_ids():
+        return [
+            message.id async for message in outlook.get_emails(['3', '9'])
+        ]
+
+    assert asyncio.run(get_ids()) == ['3']
+    assert server.fetches == [([b'3', b'9'], outlook_email.BODY_QUERY)]
+
+
+def test_get_unseen_emails_search_error(emails):
+    outlook = connect(FakeIMAP(emails, search_status='NO'))
+    with pytest.raises(UnableRetrieveEmailsException):
+        outlook.get_unseen_emails()
+
+
+def test_decode_message_without_html():
+    raw_email = RawEmail()
+    raw_email['Subject'] = 'Plain'
+    raw_email.set_content('Only text')
+    message = decode_message('7', raw_email.as_bytes())
+    assert message.subject == 'Unreadable subject message [7]'
+    assert message.message == ''
@@ -0,0 +1,34 @@
+import pytest
+import tests.mocks.email_mocks as mocks
+from datetime import datetime
+from src.models import EmailMessage, ParseFailure
+from src.parsing import parse_emails
+
+
+@pytest.fixture
+def emails():
+    return [
+        EmailMessage('1', 'Notificaciones Itau',
+                     mocks.ITAU_GOOD_TABLE_STRUCTURE, '<1@itau>'),
+        EmailMessage('2', 'Notificaciones Itau',
+                     mocks.ITAU_BAD_EXPENSE_VALUE, '<2@itau>'),
+        EmailMessage('3', 'Unknown subject', mocks.GOOD_FULL_EMAIL, '<3@x>'),
+        EmailMessage('4', 'Notificaciones Itau',
+                     mocks.ITAU_GOOD_TABLE_STRUCTURE, '<4@itau>'),
+    ]
+
+
+def test_parse_emails_collects_failures(emails):
+    """
+    Test that the emails that can't be parsed are returned as failures
+    without stopping the rest, keeping the order of the emails
+    """
+    expenses, failures = parse_emails(emails)
+    assert [expense.idempotency_key for expense in expenses] == [
+        '<1@itau>', '<4@itau>'
+    ]
+    assert expenses[0].date_expense == datetime(2023, 2, 14, 18, 25, 12)
+    assert [failure.email_id for failure in failures] == ['2', '3']
+    assert all(isinstance(failure, ParseFailure) for failure in failures)
+    assert 'UnableGetExpenseException' in failures[0].error
+    assert 'CleaningFunctionNotImplementedException' in failures[1].error
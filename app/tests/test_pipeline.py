@@ -0,0 +1,185 @@
+import asyncio
+import pytest
+import tests.mocks.email_mocks as mocks
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+from src import pipeline
+from src.email_source_mappings import subject_matcher
+from src.models import EmailMessage, PipelineReport, SyncCheckpoint
+from src.parsing import parse_emails
+from src.pipeline import EmailPipeline
+from src.sync_state import SyncState
+
+
+class FakeReceiver:
+    """Async receiver that yields the emails it has after the checkpoint"""
+
+    def __init__(self, emails: list[EmailMessage]):
+        self.emails = emails
+        self.checkpoint: SyncCheckpoint | None = None
+        self.received_checkpoint: SyncCheckpoint | None = None
+        self.requested_ids: list[str] = []
+        self.logged_out = False
+
+    async def login(self):
+        ...
+
+    async def logout(self):
+        self.logged_out = True
+
+    async def get_unseen_emails(self, included_subjects=None,
+                                checkpoint=None):
+        self.received_checkpoint = checkpoint
+        for email in self.emails[checkpoint.last_uid if checkpoint else 0:]:
+            # Give the other stages the chance to run
+            await asyncio.sleep(0)
+            yield email
+        self.checkpoint = SyncCheckpoint(1, len(self.emails))
+
+    async def get_emails(self, message_ids):
+        self.requested_ids = message_ids
+        for email in self.emails:
+            if email.id in message_ids:
+                yield email
+
+    async def mark_as_read(self, message_id: str):
+        ...
+
+
+class FakeConsumer:
+    def __init__(self, sent: bool = True):
+        self.sent = sent
+        self.batches: list = []
+
+    def add_expense(self, expenses) -> bool:
+        self.batches.append(expenses)
+        return self.sent
+
+
+def build_emails(count: int) -> list[EmailMessage]:
+    emails = [
+        EmailMessage(str(index), 'Notificaciones Itau',
+                     mocks.ITAU_GOOD_TABLE_STRUCTURE, f'<{index}@itau>')
+        for index in range(count)
+    ]
+    emails.append(EmailMessage('bad', 'Notificaciones Itau',
+                               mocks.ITAU_BAD_DATE_VALUE, '<bad@itau>'))
+    emails.append(EmailMessage('other', 'Newsletter', '', '<other@x>'))
+    return emails
+
+
+def run_pipeline(receiver, consumer, sync_state, **kwargs):
+    return asyncio.run(EmailPipeline(
+        receiver, consumer, sync_state, 'user/inbox', subject_matcher,
+        queue_size=2, send_batch_size=3, **kwargs
+    ).run())
+
+
+@pytest.mark.parametrize("parse_workers", [1, 2])
+def test_pipeline_sends_expenses(tmp_path, parse_workers):
+    sync_state = SyncState(str(tmp_path / 'sync_state.db'))
+    sync_state.mark_processed(['<0@itau>'])
+    receiver = FakeReceiver(build_emails(8))
+    consumer = FakeConsumer()
+    with ProcessPoolExecutor(parse_workers) as executor:
+        report = run_pipeline(receiver, consumer, sync_state,
+                              executor=executor, parse_workers=parse_workers)
+    assert report.emails == 10
+    assert report.expenses == 7
+    assert report.complete
+    assert [failure.email_id for failure in report.failures] == ['bad']
+    assert [len(batch) for batch in consumer.batches] == [3, 3, 1]
+    keys = {
+        expense.idempotency_key
+        for batch in consumer.batches for expense in batch
+    }
+    assert keys == {f'<{index}@itau>' for index in range(1, 8)}
+    assert sync_state.get_processed(sorted(keys)) == keys
+    assert sync_state.get_checkpoint('user/inbox') == SyncCheckpoint(1, 10)
+    assert receiver.logged_out
+    # The next run starts from the checkpoint and sends nothing again
+    consumer = FakeConsumer()
+    report = run_pipeline(receiver, consumer, sync_state)
+    assert receiver.received_checkpoint == SyncCheckpoint(1, 10)
+    assert consumer.batches == []
+    sync_state.close()
+
+
+def test_pipeline_parses_failed_emails_again(tmp_path):
+    """
+    Test that the emails that couldn't be parsed are fetched again in the
+    next runs, even though the checkpoint is already past them
+    """
+    sync_state = SyncState(str(tmp_path / 'sync_state.db'))
+    receiver = FakeReceiver(build_emails(2))
+    report = run_pipeline(receiver, FakeConsumer(), sync_state)
+    assert [failure.email_id for failure in report.failures] == ['bad']
+    assert sync_state.get_checkpoint('user/inbox') == SyncCheckpoint(1, 4)
+    assert sync_state.get_failed('user/inbox', 1) == ['bad']
+    # The email keeps failing until its cleaning function is fixed
+    report = run_pipeline(receiver, FakeConsumer(), sync_state)
+    assert receiver.requested_ids == ['bad']
+    assert [failure.email_id for failure in report.failures] == ['bad']
+    receiver.emails[2].message = mocks.ITAU_GOOD_TABLE_STRUCTURE
+    consumer = FakeConsumer()
+    report = run_pipeline(receiver, consumer, sync_state)
+    assert report.failures == []
+    assert [
+        expense.idempotency_key
+        for batch in consumer.batches for expense in batch
+    ] == ['<bad@itau>']
+    assert sync_state.get_failed('user/inbox', 1) == []
+    sync_state.close()
+
+
+def test_pipeline_keeps_checkpoint_when_expenses_not_saved(tmp_path):
+    sync_state = SyncState(str(tmp_path / 'sync_state.db'))
+    report = run_pipeline(
+        FakeReceiver(build_emails(2)), FakeConsumer(sent=False), sync_state
+    )
+    assert report.expenses == 0
+    assert not report.complete
+    assert sync_state.get_checkpoint('user/inbox') is None
+    assert sync_state.get_processed(['<0@itau>', '<1@itau>']) == set()
+    sync_state.close()
+
+
+def test_pipeline_parses_in_chunks(tmp_path):
+    """
+    Test that the emails already queued are sent to the executor together,
+    up to the chunk size
+    """
+    sync_state = SyncState(str(tmp_path / 'sync_state.db'))
+    # The Itau emails, without the one filtered out by its subject
+    emails = build_emails(8)[:9]
+    chunks = []
+
+    def parse_chunk(emails):
+        chunks.append([email.id for email in emails])
+        return parse_emails(emails)
+
+    async def parse():
+        pipeline_ = EmailPipeline(
+            FakeReceiver(emails), FakeConsumer(), sync_state, 'user/inbox',
+            subject_matcher, chunk_size=3,
+        )
+        to_parse = asyncio.Queue()
+        to_send = asyncio.Queue()
+        # Every email is queued before the parse stage runs
+        for email in emails:
+            to_parse.put_nowait(email)
+        to_parse.put_nowait(pipeline.DONE)
+        report = PipelineReport()
+        await pipeline_._parse(to_parse, to_send, report)
+        sent = [to_send.get_nowait() for _ in range(to_send.qsize())]
+        return report, sent
+
+    with mock.patch.object(pipeline, 'parse_emails', parse_chunk):
+        report, sent = asyncio.run(parse())
+    assert chunks == [
+        ['0', '1', '2'], ['3', '4', '5'], ['6', '7', 'bad']
+    ]
+    assert [failure.email_id for failure in report.failures] == ['bad']
+    assert len(sent) == 9
+    assert sent[-1] is pipeline.DONE
+    sync_state.close()
@@ -0,0 +1,40 @@
+from src.models import ParseFailure, SyncCheckpoint
+from src.sync_state import SyncState
+
+
+def test_checkpoint(tmp_path):
+    path = str(tmp_path / 'sync_state.db')
+    with SyncState(path) as sync_state:
+        assert sync_state.get_checkpoint('user/inbox') is None
+        sync_state.save_checkpoint('user/inbox', SyncCheckpoint(1, 10))
+        sync_state.save_checkpoint('user/inbox', SyncCheckpoint(1, 15))
+    with SyncState(path) as sync_state:
+        assert sync_state.get_checkpoint('user/inbox') == \
+            SyncCheckpoint(uid_validity=1, last_uid=15)
+        assert sync_state.get_checkpoint('user/other') is None
+
+
+def test_processed_messages(tmp_path):
+    with SyncState(str(tmp_path / 'sync_state.db')) as sync_state:
+        sync_state.mark_processed(['<a@b>', 'inbox:1:4'])
+        sync_state.mark_processed(['<a@b>'])
+        keys = [f'key-{index}' for index in range(1200)] + ['<a@b>']
+        assert sync_state.get_processed(keys) == {'<a@b>'}
+
+
+def test_failed_messages(tmp_path):
+    with SyncState(str(tmp_path / 'sync_state.db')) as sync_state:
+        assert sync_state.get_failed('user/inbox', 1) == []
+        sync_state.save_failed('user/inbox', 1, [
+            ParseFailure('7', 'Subject', 'ValueError()'),
+            ParseFailure('3', 'Subject', 'ValueError()'),
+        ])
+        sync_state.save_failed('user/other', 1, [
+            ParseFailure('5', 'Subject', 'ValueError()'),
+        ])
+        assert sync_state.get_failed('user/inbox', 1) == ['7', '3']
+        # The ids of another UIDVALIDITY aren't the same emails
+        assert sync_state.get_failed('user/inbox', 2) == []
+        sync_state.save_failed('user/inbox', 1, [])
+        assert sync_state.get_failed('user/inbox', 1) == []
+        assert sync_state.get_failed('user/other', 1) == ['5']
@@ -1,4 +1,4 @@
-from src.utils import remove_spaces, filter_messages
+from src.utils import remove_spaces, filter_messages, SubjectMatcher
 from src.models import EmailMessage
 
 
@@ -114,3 +114,17 @@ def test_filter_messages_matching_subjects_case_insensitive():
     assert filtered_messages[0].id == '1'
     assert filtered_messages[1].id == '2'
     assert all(msg in messages for msg in filtered_messages)
+
+
+def test_subject_matcher_values():
+    """
+    Test that the matcher returns the value of the included subject found,
+    preferring the longest one when several match
+    """
+    matcher = SubjectMatcher({'PSE': 'short', 'PSE Transacción': 'long',
+                              'a.b': 'escaped'})
+    assert matcher.match('Re: pse transacción aprobada') == 'long'
+    assert matcher.match('Pago PSE') == 'short'
+    assert matcher.match('a.b') == 'escaped'
+    assert matcher.match('axb') is None
+    assert SubjectMatcher([]).match('Anything') is None